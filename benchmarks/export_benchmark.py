@@ -0,0 +1,146 @@
+"""
+Пиковая память, время и размер файла потокового экспорта во всех форматах на синтетических данных (без БД).
+Функции exports (write_excel, write_csv, write_parquet) читают строки только через db.iter_query_chunks,
+поэтому вместо БД подставляется источник, который генерирует порции строк на лету.
+Каждый замер (формат и размер) идет в отдельном процессе: ru_maxrss — пик за всю жизнь процесса.
+
+    python benchmarks/export_benchmark.py --rows 10000 100000 1000000 --formats xlsx csv parquet
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Описание колонки как в cursor.description psycopg2
+Column = namedtuple('Column', ['name', 'type_code', 'display_size', 'internal_size', 'precision', 'scale', 'null_ok'])
+
+USER_COLUMNS = [
+    Column('id', 23, None, 4, None, None, None),
+    Column('telegram_id', 20, None, 8, None, None, None),
+    Column('username', 1043, None, 100, None, None, None),
+    Column('first_name', 1043, None, 100, None, None, None),
+    Column('last_name', 1043, None, 100, None, None, None),
+    Column('patronymic', 1043, None, 100, None, None, None),
+    Column('email', 1043, None, 120, None, None, None),
+    Column('phone', 1043, None, 20, None, None, None),
+    Column('referral_code', 1043, None, 50, None, None, None),
+    Column('registration_date', 1114, None, 8, None, None, None),
+    Column('bonus_balance', 1700, None, None, 10, 2, None),
+    Column('is_active', 16, None, 1, None, None, None),
+]
+
+REFERRAL_COLUMNS = [
+    Column('id', 23, None, 4, None, None, None),
+    Column('referrer_id', 23, None, 4, None, None, None),
+    Column('referred_user_id', 23, None, 4, None, None, None),
+    Column('referral_code_used', 1043, None, 50, None, None, None),
+    Column('discount_applied', 16, None, 1, None, None, None),
+    Column('bonus_paid', 16, None, 1, None, None, None),
+    Column('referral_date', 1114, None, 8, None, None, None),
+    Column('bonus_paid_at', 1114, None, 8, None, None, None),
+    Column('referrer_name', 1043, None, 100, None, None, None),
+    Column('referred_name', 1043, None, 100, None, None, None),
+]
+
+STARTED_AT = datetime(2024, 1, 1)
+
+
+def user_row(i):
+    return (
+        i, 1000000000 + i, f"user_{i}", "Иван", "Иванов", "Иванович", f"user{i}@example.com",
+        f"+7900{i:07d}", f"CODE{i:08d}", STARTED_AT + timedelta(seconds=i), Decimal(i % 1000), True,
+    )
+
+
+def referral_row(i):
+    paid = i % 3 == 0
+    return (
+        i, i // 2 + 1, i + 1, f"CODE{i // 2 + 1:08d}", False, paid, STARTED_AT + timedelta(seconds=i),
+        STARTED_AT + timedelta(seconds=i, days=1) if paid else None, f"user_{i // 2 + 1}", f"user_{i + 1}",
+    )
+
+
+class SyntheticSource:
+    """Заменяет DatabaseManager для exports: по rows строк в каждом наборе данных, генерируемых порциями"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def iter_query_chunks(self, query, params=None, chunk_size=5000):
+        if 'FROM referrals' in query:
+            columns, make_row = REFERRAL_COLUMNS, referral_row
+        else:
+            columns, make_row = USER_COLUMNS, user_row
+        start = 0
+        while True:
+            rows = [make_row(i) for i in range(start, min(start + chunk_size, self.rows))]
+            if rows or start == 0:
+                yield columns, rows
+            if not rows:
+                break
+            start += chunk_size
+
+
+def measure(rows, export_format):
+    """Один замер в текущем процессе: время, пик RSS и суммарный размер файлов"""
+    import exports
+
+    writer, _ = exports.EXPORT_FORMATS[export_format]
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    files = writer(SyntheticSource(rows))
+    elapsed = time.perf_counter() - started
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    size = 0
+    for export_file in files:
+        export_file.file.seek(0, os.SEEK_END)
+        size += export_file.file.tell()
+        export_file.file.close()
+    return {'rows': rows * 2, 'seconds': elapsed, 'peak_rss_mb': peak_kb / 1024,
+            'baseline_rss_mb': baseline_kb / 1024, 'size_mb': size / 1024 / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="строк в каждом наборе данных (users и referrals)")
+    parser.add_argument('--formats', nargs='+', default=['xlsx', 'csv', 'parquet'],
+                        help="форматы из exports.EXPORT_FORMATS")
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(measure(args.rows[0], args.formats[0])))
+        return
+
+    print(f"{'format':>8} {'rows':>10} {'seconds':>8} {'rows/s':>9} {'peak RSS, MB':>13} "
+          f"{'baseline, MB':>13} {'file, MB':>9}")
+    for rows in args.rows:
+        for export_format in args.formats:
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--single', '--rows', str(rows),
+                 '--formats', export_format],
+                capture_output=True, text=True
+            )
+            if completed.returncode != 0:
+                # Например, для Parquet без установленного pyarrow
+                error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed'
+                print(f"{export_format:>8} {rows * 2:>10,} {error}")
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            print(f"{export_format:>8} {result['rows']:>10,} {result['seconds']:>8.2f} "
+                  f"{result['rows'] / result['seconds']:>9,.0f} {result['peak_rss_mb']:>13.1f} "
+                  f"{result['baseline_rss_mb']:>13.1f} {result['size_mb']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Пакетная выплата бонусов на данных реалистичного размера (по умолчанию 14 000 невыплаченных бонусов)
+во временной схеме базы из DB_*. Пока идет pay_bonuses_batch, в отдельном потоке регистрируются
+пользователи: их задержка показывает, сколько регистрации ждут блокировку stats_counters.
+
+    DB_HOST=... DB_NAME=... python benchmarks/payout_benchmark.py --bonuses 14000 --max-seconds 1
+
+Код выхода 1, если выплата дольше --max-seconds или счетчики stats_counters разошлись с таблицами.
+"""
+import argparse
+import logging
+import secrets
+import threading
+import time
+
+from scratch_db import scratch_schema
+
+
+def seed(manager, bonuses, referrers):
+    """Пригласившие, приглашенные пользователи и невыплаченные бонусы одним запросом на таблицу"""
+    with manager.get_cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO users (telegram_id, username, referral_code)
+            SELECT 1000000000 + g, 'bench_' || g, 'BENCH' || g
+            FROM generate_series(1, %s) g
+        ''', (referrers + bonuses,))
+        cursor.execute('''
+            INSERT INTO referrals (referrer_id, referred_user_id, referral_code_used)
+            SELECT referrer.id, referred.id, referrer.referral_code
+            FROM generate_series(1, %(bonuses)s) g
+            JOIN users referrer ON referrer.telegram_id = 1000000000 + 1 + (g %% %(referrers)s)
+            JOIN users referred ON referred.telegram_id = 1000000000 + %(referrers)s + g
+        ''', {'bonuses': bonuses, 'referrers': referrers})
+
+
+def counters_match(manager):
+    with manager.get_cursor() as cursor:
+        cursor.execute('''
+            SELECT SUM(s.total_users) = (SELECT COUNT(*) FROM users)
+                   AND SUM(s.total_referrals) = (SELECT COUNT(*) FROM referrals)
+                   AND SUM(s.unpaid_bonuses) = (SELECT COUNT(*) FROM referrals WHERE bonus_paid = FALSE)
+                   AND SUM(s.paid_bonuses) = (SELECT COUNT(*) FROM referrals WHERE bonus_paid = TRUE)
+                   AND SUM(s.total_bonus_balance) = (SELECT COALESCE(SUM(bonus_balance), 0) FROM users) as ok
+            FROM stats_counters s
+        ''')
+        return cursor.fetchone()['ok']
+
+
+def register_while(manager, running, latencies):
+    """Регистрирует пользователей, пока идет выплата, и записывает время каждого register_user"""
+    telegram_id = 2000000000
+    while running.is_set():
+        telegram_id += 1
+        started = time.perf_counter()
+        manager.register_user(telegram_id, f"concurrent_{telegram_id}")
+        latencies.append(time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bonuses', type=int, default=14000)
+    parser.add_argument('--referrers', type=int, default=2000)
+    parser.add_argument('--max-seconds', type=float, default=1.0)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with scratch_schema() as manager:
+        seed(manager, args.bonuses, args.referrers)
+        preview = manager.get_payout_preview()
+
+        running = threading.Event()
+        running.set()
+        latencies = []
+        registrations = threading.Thread(target=register_while, args=(manager, running, latencies))
+        registrations.start()
+        time.sleep(0.2)
+
+        started = time.perf_counter()
+        result = manager.pay_bonuses_batch(0, secrets.token_hex(16), preview['max_referral_id'])
+        elapsed = time.perf_counter() - started
+
+        time.sleep(0.2)
+        running.clear()
+        registrations.join()
+        consistent = counters_match(manager)
+
+    print(f"paid {result['referral_count']} bonuses to {result['referrer_count']} referrers "
+          f"in {elapsed:.3f} s ({result['referral_count'] / elapsed:,.0f} bonuses/s)")
+    if latencies:
+        print(f"concurrent register_user: {len(latencies)} calls, max {max(latencies) * 1000:.1f} ms")
+    print(f"stats_counters consistent: {consistent}")
+
+    failed = False
+    if elapsed > args.max_seconds:
+        print(f"FAIL: batch took longer than {args.max_seconds} s")
+        failed = True
+    if not consistent:
+        print("FAIL: stats_counters do not match the tables")
+        failed = True
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
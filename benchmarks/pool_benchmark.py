@@ -0,0 +1,80 @@
+"""
+Запросов в секунду: новое соединение на каждый запрос (как до пула) против DatabaseManager.get_cursor
+с пулом соединений. База берется из DB_*; выполняется только короткий запрос чтения, таблицы не меняются.
+
+    DB_HOST=... DB_NAME=... python benchmarks/pool_benchmark.py --threads 1 8 --seconds 3
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DatabaseManager
+
+QUERY = 'SELECT COUNT(*) as count FROM pg_class WHERE relkind = %s'
+
+
+def query_with_new_connection(manager):
+    """Поведение до пула: connect, запрос, commit, close"""
+    conn = manager.get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(QUERY, ('r',))
+            cursor.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def query_with_pool(manager):
+    with manager.get_cursor() as cursor:
+        cursor.execute(QUERY, ('r',))
+        cursor.fetchone()
+
+
+def run(query, manager, threads, seconds):
+    """Запускает query в threads потоках на seconds секунд; возвращает число запросов в секунду"""
+    counts = [0] * threads
+    deadline = time.monotonic() + seconds
+
+    def worker(index):
+        while time.monotonic() < deadline:
+            query(manager)
+            counts[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    started = time.monotonic()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(counts) / (time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--seconds', type=float, default=3.0)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    manager = DatabaseManager()
+    try:
+        manager.pool.warmup()
+        print(f"{'threads':>7} {'connect per query, q/s':>23} {'pool, q/s':>10} {'speedup':>8}")
+        for threads in args.threads:
+            before = run(query_with_new_connection, manager, threads, args.seconds)
+            after = run(query_with_pool, manager, threads, args.seconds)
+            print(f"{threads:>7} {before:>23,.0f} {after:>10,.0f} {after / before:>7.1f}x")
+        print(f"pool stats: {manager.get_pool_stats()}")
+    finally:
+        manager.close()
+
+
+if __name__ == '__main__':
+    main()
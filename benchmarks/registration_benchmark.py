@@ -0,0 +1,176 @@
+"""
+Регистрация через сессию в PostgreSQL (SESSION_BACKEND=postgres): запросы, транзакции и время
+на каждом шаге диалога. «До» — последовательность запросов исходных обработчиков
+(сессия читается, сливается в Python и перезаписывается; пользователь, реферальная связь
+и удаление сессии — отдельными транзакциями), «после» — текущие upsert_user_session и register_user.
+Замер идет во временной схеме базы из DB_* (см. scratch_db.py).
+
+    DB_HOST=... DB_NAME=... python benchmarks/registration_benchmark.py --users 200
+"""
+import argparse
+import logging
+import secrets
+import statistics
+import time
+
+from psycopg2.extras import Json, RealDictCursor
+
+from scratch_db import scratch_schema
+
+from config import DB_POOL_CONFIG
+from db_pool import ConnectionPool
+
+STEPS = ['start', 'name', 'email', 'phone', 'complete']
+
+
+class CountingCursor(RealDictCursor):
+    """Курсор, который считает выполненные запросы"""
+    executed = 0
+
+    def execute(self, query, params=None):
+        CountingCursor.executed += 1
+        return super().execute(query, params)
+
+
+def old_get_session(manager, telegram_id):
+    with manager.get_cursor() as cursor:
+        cursor.execute('SELECT * FROM user_sessions WHERE telegram_id = %s', (telegram_id,))
+        return cursor.fetchone()
+
+
+def old_update_session(manager, telegram_id, current_step=None, registration_data=None):
+    """Исходный update_user_session: чтение, слияние в Python и запись"""
+    with manager.get_cursor() as cursor:
+        cursor.execute('SELECT * FROM user_sessions WHERE telegram_id = %s', (telegram_id,))
+        session = cursor.fetchone()
+        if session:
+            data = session['registration_data'] or {}
+            data.update(registration_data or {})
+            cursor.execute('''
+                UPDATE user_sessions
+                SET current_step = %s, registration_data = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE telegram_id = %s
+                RETURNING *
+            ''', (current_step or session['current_step'], Json(data), telegram_id))
+            return cursor.fetchone()
+
+
+def old_flow(manager, telegram_id, referrer_code):
+    def start():
+        with manager.get_cursor() as cursor:
+            cursor.execute('SELECT * FROM users WHERE telegram_id = %s', (telegram_id,))
+        if not old_get_session(manager, telegram_id):
+            with manager.get_cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO user_sessions (telegram_id, current_step, registration_data)
+                    VALUES (%s, %s, %s)
+                ''', (telegram_id, 'start', Json({})))
+        old_update_session(manager, telegram_id, registration_data={'referral_code': referrer_code})
+
+    def step(next_step, piece):
+        def run():
+            session = old_get_session(manager, telegram_id) or {}
+            data = session.get('registration_data') or {}
+            data.update(piece)
+            old_update_session(manager, telegram_id, next_step, data)
+            if next_step == 'COMPLETE':
+                old_get_session(manager, telegram_id)
+        return run
+
+    def complete():
+        data = old_get_session(manager, telegram_id)['registration_data']
+        with manager.get_cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO users (telegram_id, username, first_name, last_name, email, phone, referral_code)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (telegram_id, f"user_{telegram_id}", data.get('first_name'), data.get('last_name'),
+                  data.get('email'), data.get('phone'), secrets.token_hex(4).upper()))
+            user_id = cursor.fetchone()['id']
+        with manager.get_cursor() as cursor:
+            cursor.execute('SELECT * FROM users WHERE referral_code = %s', (data['referral_code'],))
+            referrer = cursor.fetchone()
+        with manager.get_cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO referrals (referrer_id, referred_user_id, referral_code_used)
+                VALUES (%s, %s, %s)
+            ''', (referrer['id'], user_id, data['referral_code']))
+        with manager.get_cursor() as cursor:
+            cursor.execute('DELETE FROM user_sessions WHERE telegram_id = %s', (telegram_id,))
+
+    return [start, step('EMAIL', {'first_name': 'Иван', 'last_name': 'Иванов'}),
+            step('PHONE', {'email': 'ivan@example.com'}), step('COMPLETE', {'phone': '+79001234567'}), complete]
+
+
+def new_flow(manager, telegram_id, referrer_code):
+    """Те же вызовы, что делают обработчики через PostgresSessionStore и register_user"""
+
+    def start():
+        manager.user_exists(telegram_id)
+        manager.upsert_user_session(telegram_id, registration_data={'referral_code': referrer_code})
+
+    def step(next_step, piece):
+        return lambda: manager.upsert_user_session(telegram_id, next_step, piece)
+
+    def complete():
+        data = manager.get_user_session(telegram_id)['registration_data']
+        manager.register_user(
+            telegram_id, f"user_{telegram_id}", first_name=data.get('first_name'), last_name=data.get('last_name'),
+            email=data.get('email'), phone=data.get('phone'), referral_code_used=data.get('referral_code')
+        )
+
+    return [start, step('EMAIL', {'first_name': 'Иван', 'last_name': 'Иванов'}),
+            step('PHONE', {'email': 'ivan@example.com'}), step('COMPLETE', {'phone': '+79001234567'}), complete]
+
+
+def measure(manager, flow, users, first_telegram_id, referrer_code):
+    """Для каждого шага: запросов и транзакций на одну регистрацию и медиана времени шага"""
+    statements = {step: 0 for step in STEPS}
+    transactions = {step: 0 for step in STEPS}
+    timings = {step: [] for step in STEPS}
+    for telegram_id in range(first_telegram_id, first_telegram_id + users):
+        for step, run in zip(STEPS, flow(manager, telegram_id, referrer_code)):
+            executed = CountingCursor.executed
+            checkouts = manager.pool.stats()['checkouts']
+            started = time.perf_counter()
+            run()
+            timings[step].append(time.perf_counter() - started)
+            statements[step] += CountingCursor.executed - executed
+            transactions[step] += manager.pool.stats()['checkouts'] - checkouts
+    return {
+        step: (statements[step] / users, transactions[step] / users, statistics.median(timings[step]) * 1000)
+        for step in STEPS
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with scratch_schema() as manager:
+        def counting_connect():
+            conn = manager.get_connection()
+            conn.cursor_factory = CountingCursor
+            return conn
+
+        manager.pool.closeall()
+        manager.pool = ConnectionPool(counting_connect, **DB_POOL_CONFIG)
+        referrer_code = manager.register_user(1, 'referrer')['referral_code']
+
+        old = measure(manager, old_flow, args.users, 1000000, referrer_code)
+        new = measure(manager, new_flow, args.users, 2000000, referrer_code)
+
+    print(f"{'step':>9} | {'before: queries':>15} {'tx':>4} {'ms':>6} | {'after: queries':>14} {'tx':>4} {'ms':>6}")
+    totals = [0, 0, 0, 0, 0, 0]
+    for step in STEPS:
+        row = old[step] + new[step]
+        totals = [total + value for total, value in zip(totals, row)]
+        print(f"{step:>9} | {row[0]:>15.0f} {row[1]:>4.0f} {row[2]:>6.2f} | {row[3]:>14.0f} {row[4]:>4.0f} {row[5]:>6.2f}")
+    print(f"{'total':>9} | {totals[0]:>15.0f} {totals[1]:>4.0f} {totals[2]:>6.2f} | "
+          f"{totals[3]:>14.0f} {totals[4]:>4.0f} {totals[5]:>6.2f}")
+
+
+if __name__ == '__main__':
+    main()
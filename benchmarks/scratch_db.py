@@ -0,0 +1,55 @@
+"""
+Временная схема для бенчмарков с БД: схема создается в базе из DB_* (config.DB_CONFIG),
+миграции применяются в нее, а после замера она удаляется вместе с данными.
+Рабочие таблицы public при этом не затрагиваются.
+"""
+import os
+import secrets
+import sys
+from contextlib import contextmanager
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+
+from config import DB_CONFIG
+
+
+def connect(**kwargs):
+    return psycopg2.connect(
+        host=DB_CONFIG['host'], port=DB_CONFIG['port'], database=DB_CONFIG['database'],
+        user=DB_CONFIG['user'], password=DB_CONFIG['password'], **kwargs
+    )
+
+
+@contextmanager
+def scratch_schema():
+    """
+    Создает схему bench_<случайный суффикс> и через PGOPTIONS делает ее search_path для всех
+    соединений процесса, открытых внутри блока. Отдает DatabaseManager с примененными миграциями.
+    """
+    schema = f"bench_{secrets.token_hex(4)}"
+    admin = connect()
+    admin.autocommit = True
+    previous_options = os.environ.get('PGOPTIONS')
+    manager = None
+    try:
+        with admin.cursor() as cursor:
+            cursor.execute(f'CREATE SCHEMA {schema}')
+        os.environ['PGOPTIONS'] = f'-c search_path={schema}'
+
+        from database import DatabaseManager
+        manager = DatabaseManager()
+        manager.init_database()
+        yield manager
+    finally:
+        if manager is not None:
+            manager.close()
+        if previous_options is None:
+            os.environ.pop('PGOPTIONS', None)
+        else:
+            os.environ['PGOPTIONS'] = previous_options
+        with admin.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        admin.close()
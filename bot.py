@@ -1,8 +1,12 @@
 import logging
+from telegram import Update
 from telegram.ext import Application
-from config import TELEGRAM_BOT_TOKEN
+from config import TELEGRAM_BOT_TOKEN, BOT_CONCURRENT_UPDATES, BOT_MODE, WEBHOOK_CONFIG, SESSION_CONFIG
 from handlers import BotHandlers
-from database import db_manager
+from database import db_manager, async_db
+from update_processor import PerUserUpdateProcessor
+from outbox import outbox
+from qr_codes import qr_cache
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -11,6 +15,67 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def webhook_options(config=WEBHOOK_CONFIG):
+    """Параметры для run_webhook/start_webhook; None, если настройки webhook неполные"""
+    if not config['url']:
+        logger.error("WEBHOOK_URL must be set when BOT_MODE=webhook")
+        return None
+    if not config['secret_token']:
+        # Без общего секрета запросы от Telegram нельзя отличить от поддельных,
+        # а у нескольких реплик должен быть один и тот же секрет
+        logger.error("WEBHOOK_SECRET_TOKEN must be set when BOT_MODE=webhook")
+        return None
+
+    url_path = config['path'].strip('/')
+    # Обновления, пришедшие во время перезапуска, не отбрасываем — иначе теряются /start с реферальным кодом
+    return {
+        'listen': config['listen'],
+        'port': config['port'],
+        'url_path': url_path,
+        'webhook_url': f"{config['url'].rstrip('/')}/{url_path}",
+        'secret_token': config['secret_token'],
+        'allowed_updates': Update.ALL_TYPES,
+        'drop_pending_updates': False,
+    }
+
+
+def session_backend_warning(session_config=SESSION_CONFIG):
+    """
+    Предупреждение для режима webhook, если сессии регистрации хранятся в памяти процесса
+    и не видны другим репликам за балансировщиком; None, если хранилище общее.
+    """
+    if session_config['backend'] != 'memory':
+        return None
+    if session_config['persist']:
+        return ("SESSION_BACKEND=memory keeps a per-replica copy of registration sessions in front of PostgreSQL: "
+                "with several webhook replicas a replica can read a stale session; use SESSION_BACKEND=redis")
+    return ("SESSION_BACKEND=memory keeps registration sessions in this process only: with several webhook "
+            "replicas they are not shared and are lost on restart; use SESSION_BACKEND=redis or postgres")
+
+
+def run_webhook(application):
+    """Запуск бота в режиме webhook"""
+    options = webhook_options()
+    if options is None:
+        return
+    warning = session_backend_warning()
+    if warning:
+        logger.warning(warning)
+    # Состояние диалога регистрации и порядок обновлений пользователя — в памяти процесса (см. config.BOT_MODE)
+    logger.info("Webhook replicas must receive all updates of a user on the same replica (sticky routing by user)")
+    logger.info(f"Starting webhook on {options['listen']}:{options['port']}/{options['url_path']}")
+    application.run_webhook(**options)
+
+
+async def post_init(application):
+    """Запуск фоновых служб, которым нужен цикл событий приложения"""
+    outbox.start(application.bot)
+
+
+async def post_shutdown(application):
+    await outbox.stop()
+
+
 def main():
     if TELEGRAM_BOT_TOKEN == 'your-telegram-bot-token':
         logger.error("TELEGRAM_BOT_TOKEN not set in environment variables")
@@ -23,18 +88,30 @@ def main():
         logger.info("Database initialized successfully")
 
         # Создаем приложение и передаем ему токен
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        builder = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+        if BOT_CONCURRENT_UPDATES > 0:
+            # Разные пользователи обрабатываются параллельно, один пользователь — последовательно
+            builder = builder.concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES))
+        application = builder.build()
 
         # Создаем экземпляр обработчиков и настраиваем их
         bot_handlers = BotHandlers(application)
         bot_handlers.setup_handlers()
 
         # Запускаем бота
-        logger.info("Starting Telegram bot...")
-        application.run_polling(drop_pending_updates=True)
+        logger.info(f"Starting Telegram bot in {BOT_MODE} mode...")
+        if BOT_MODE == 'webhook':
+            run_webhook(application)
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=False)
 
     except Exception as e:
         logger.error(f"Failed to start bot: {e}")
+    finally:
+        logger.info(f"Database pool stats: {db_manager.get_pool_stats()}")
+        logger.info(f"User cache stats: {db_manager.get_user_cache_stats()}")
+        qr_cache.close()
+        async_db.close()
 
 
 if __name__ == '__main__':
@@ -3,6 +3,27 @@ import os
 # Настройки Telegram бота
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '7852718537:AAGTPfDPxBpxPD7drDQTI-FflH4CYHTnXcY')
 ADMIN_ID = 5321942267 # Ваш Telegram ID
+# Сколько обновлений от разных пользователей обрабатывать параллельно (0 — последовательно)
+BOT_CONCURRENT_UPDATES = int(os.environ.get('BOT_CONCURRENT_UPDATES', '32'))
+
+# Режим получения обновлений: 'polling' или 'webhook'
+# Несколько реплик за балансировщиком в режиме webhook: состояние ConversationHandler и порядок
+# обработки обновлений одного пользователя (PerUserUpdateProcessor) хранятся в памяти процесса, поэтому
+# балансировщик должен направлять все обновления пользователя в одну реплику (например, по хэшу from.id).
+# Сессии регистрации при этом должны быть общими: SESSION_BACKEND=redis или postgres (не memory).
+# При падении реплики незавершенная регистрация продолжается с /start — шаг диалога в другую реплику не переносится.
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+
+# Настройки webhook (используются при BOT_MODE=webhook)
+WEBHOOK_CONFIG = {
+    # Публичный адрес, на который Telegram отправляет обновления, например https://bot.example.com
+    'url': os.environ.get('WEBHOOK_URL', ''),
+    'listen': os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'),
+    'port': int(os.environ.get('WEBHOOK_PORT', '8443')),
+    'path': os.environ.get('WEBHOOK_PATH', 'telegram'),
+    # Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+    'secret_token': os.environ.get('WEBHOOK_SECRET_TOKEN', ''),
+}
 
 # Настройки PostgreSQL
 DB_CONFIG = {
@@ -13,6 +34,104 @@ DB_CONFIG = {
     'password': os.environ.get('DB_PASSWORD', 'mirzoev1217')
 }
 
+# Настройки пула соединений PostgreSQL
+DB_POOL_CONFIG = {
+    'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', '2')),
+    'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', '10')),
+    # Соединения старше max_lifetime или простаивающие дольше max_idle пересоздаются (секунды)
+    'max_lifetime': float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800')),
+    'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', '300')),
+    'checkout_timeout': float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+    # Соединение пингуется при выдаче, если простаивало дольше этого времени
+    'health_check_after': float(os.environ.get('DB_POOL_HEALTH_CHECK_AFTER', '30')),
+}
+
+# Кэш профилей пользователей: максимальное число записей и время жизни записи (секунды)
+USER_CACHE_CONFIG = {
+    'max_size': int(os.environ.get('USER_CACHE_SIZE', '50000')),
+    'ttl': float(os.environ.get('USER_CACHE_TTL', '300')),
+}
+
+# Как часто перечитывать таблицу admins (секунды)
+ADMIN_CACHE_TTL = float(os.environ.get('ADMIN_CACHE_TTL', '60'))
+# Через сколько секунд повторять загрузку admins после ошибки (до этого используется прошлый снимок)
+ADMIN_CACHE_RETRY = float(os.environ.get('ADMIN_CACHE_RETRY', '5'))
+
 # Настройки бонусов
 REFERRAL_BONUS_AMOUNT = 100
 REFERRAL_DISCOUNT_PERCENT = 10
+
+# Реферальные коды: длина и алфавит (по умолчанию base32 Крокфорда), число попыток при совпадении
+# с уже выданным кодом и размер блока заранее резервируемых кодов (0 — коды не резервируются)
+REFERRAL_CODE_CONFIG = {
+    'length': int(os.environ.get('REFERRAL_CODE_LENGTH', '8')),
+    'alphabet': os.environ.get('REFERRAL_CODE_ALPHABET', '0123456789ABCDEFGHJKMNPQRSTVWXYZ'),
+    'max_attempts': int(os.environ.get('REFERRAL_CODE_MAX_ATTEMPTS', '5')),
+    'block_size': int(os.environ.get('REFERRAL_CODE_BLOCK_SIZE', '0')),
+}
+
+# Кэш QR-кодов: количество картинок в памяти и необязательный каталог для хранения на диске
+QR_CACHE_CONFIG = {
+    'max_items': int(os.environ.get('QR_CACHE_SIZE', '1024')),
+    'cache_dir': os.environ.get('QR_CACHE_DIR', ''),
+    # Сколько PNG хранить в QR_CACHE_DIR (0 — без ограничения); давно не читавшиеся удаляются
+    'max_disk_items': int(os.environ.get('QR_CACHE_DISK_SIZE', '100000')),
+    # Количество процессов для генерации QR-кодов
+    'workers': int(os.environ.get('QR_WORKERS', '2')),
+    # Сколько реферальных кодов читать из БД за один шаг предварительной генерации
+    'prerender_batch_size': int(os.environ.get('QR_PRERENDER_BATCH_SIZE', '500')),
+    'render_options': {
+        'box_size': int(os.environ.get('QR_BOX_SIZE', '10')),
+        'border': int(os.environ.get('QR_BORDER', '4')),
+        # Уровень коррекции ошибок: L, M, Q или H
+        'error_correction': os.environ.get('QR_ERROR_CORRECTION', 'L'),
+        # Режим изображения: '1' (однобитное), 'P' (палитра) или 'RGB'
+        'image_mode': os.environ.get('QR_IMAGE_MODE', '1'),
+        'optimize': os.environ.get('QR_PNG_OPTIMIZE', '0') == '1',
+    },
+}
+
+# Настройки экспорта
+EXPORT_CONFIG = {
+    # Сколько строк читать из БД за один раз
+    'chunk_size': int(os.environ.get('EXPORT_CHUNK_SIZE', '5000')),
+    # Каталог для временных файлов экспорта (по умолчанию — системный)
+    'tmp_dir': os.environ.get('EXPORT_TMP_DIR', ''),
+    # Сколько фоновых экспортов может выполняться одновременно
+    'max_concurrent_jobs': int(os.environ.get('EXPORT_MAX_CONCURRENT_JOBS', '1')),
+    # Как часто обновлять сообщение с прогрессом (секунды)
+    'progress_interval': float(os.environ.get('EXPORT_PROGRESS_INTERVAL', '3')),
+    # Инкрементальный экспорт не берет строки моложе этого времени (секунды),
+    # чтобы не пропустить данные еще не завершенных транзакций
+    'delta_lag': float(os.environ.get('EXPORT_DELTA_LAG', '60')),
+}
+
+# Хранилище сессий регистрации
+SESSION_CONFIG = {
+    # 'memory' — в памяти процесса, 'redis' — общий Redis для нескольких экземпляров, 'postgres' — таблица user_sessions
+    'backend': os.environ.get('SESSION_BACKEND', 'memory'),
+    # Время жизни сессии без активности (секунды)
+    'ttl': int(os.environ.get('SESSION_TTL', '86400')),
+    'cache_size': int(os.environ.get('SESSION_CACHE_SIZE', '10000')),
+    'redis_url': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+    # Дополнительно сохранять сессии в PostgreSQL (user_sessions) как постоянный уровень
+    'persist': os.environ.get('SESSION_PERSIST', '0') == '1',
+    # Как часто удалять просроченные сессии (секунды) и сколько строк удалять за один запрос
+    'sweep_interval': int(os.environ.get('SESSION_SWEEP_INTERVAL', '3600')),
+    'sweep_batch_size': int(os.environ.get('SESSION_SWEEP_BATCH_SIZE', '1000')),
+}
+
+# Очередь исходящих сообщений (рассылки админ-панели): лимиты Telegram — около 30 сообщений
+# в секунду на бота и 1 сообщение в секунду в один чат
+OUTBOX_CONFIG = {
+    # Сообщений в секунду на всего бота и размер допустимого всплеска
+    'global_rate': float(os.environ.get('OUTBOX_GLOBAL_RATE', '25')),
+    'global_burst': int(os.environ.get('OUTBOX_GLOBAL_BURST', '25')),
+    # Сообщений в секунду в один чат и размер допустимого всплеска
+    'chat_rate': float(os.environ.get('OUTBOX_CHAT_RATE', '1')),
+    'chat_burst': int(os.environ.get('OUTBOX_CHAT_BURST', '3')),
+    # Количество обработчиков очереди; сообщения одного чата всегда идут через один обработчик по порядку
+    'workers': int(os.environ.get('OUTBOX_WORKERS', '4')),
+    # Сколько раз повторять отправку после 429 (RetryAfter) или сетевой ошибки
+    'max_retries': int(os.environ.get('OUTBOX_MAX_RETRIES', '5')),
+}
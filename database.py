@@ -1,23 +1,50 @@
+import asyncio
+import functools
 import logging
 import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json
 from contextlib import contextmanager
-import openpyxl
-from io import BytesIO
-from config import DB_CONFIG, REFERRAL_BONUS_AMOUNT
+import exports
+import migrations
+from cache import LRUCache
+from config import (
+    DB_CONFIG, DB_POOL_CONFIG, USER_CACHE_CONFIG, ADMIN_CACHE_TTL, ADMIN_CACHE_RETRY, REFERRAL_BONUS_AMOUNT,
+    REFERRAL_CODE_CONFIG
+)
+from db_pool import ConnectionPool
+from referral_codes import ReferralCodeBlock, generate_referral_code, normalize_referral_code
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Уровни прав админов: 'view' — просмотр, 'full' — в том числе выплаты и изменение данных
+ADMIN_PERMISSION_LEVELS = {'view': 1, 'full': 2}
+
 
 class DatabaseManager:
     def __init__(self):
         self.db_config = DB_CONFIG
         self.referral_bonus_amount = REFERRAL_BONUS_AMOUNT
+        # Соединения открываются лениво при первом запросе
+        self.pool = ConnectionPool(self.get_connection, **DB_POOL_CONFIG)
+        # Кэш профилей пользователей по telegram_id и referral_code
+        self.user_cache = LRUCache(USER_CACHE_CONFIG['max_size'], ttl=USER_CACHE_CONFIG['ttl'])
+        # Снимок таблицы admins, перечитывается раз в ADMIN_CACHE_TTL секунд
+        self._admins = None
+        self._admins_next_load = 0
+        self._admins_lock = threading.Lock()
+        # Необязательный блок заранее зарезервированных реферальных кодов
+        self.referral_code_block = None
+        if REFERRAL_CODE_CONFIG['block_size'] > 0:
+            self.referral_code_block = ReferralCodeBlock(self.reserve_referral_codes, REFERRAL_CODE_CONFIG['block_size'])
         logger.info("DatabaseManager initialized")
 
     def get_connection(self):
+        """Открывает новое физическое соединение (используется пулом)"""
         try:
             # Явно указываем кодировку UTF-8
             conn = psycopg2.connect(
@@ -39,167 +66,257 @@ class DatabaseManager:
 
     @contextmanager
     def get_cursor(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        conn = self.pool.getconn()
+        cursor = None
+        broken = False
         try:
+            # Курсор создается внутри try: если conn.cursor() упадет, соединение все равно вернется в пул
+            cursor = conn.cursor()
             yield cursor
             conn.commit()
         except Exception as e:
-            conn.rollback()
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                broken = True
             logger.error(f"Database error: {e}")
             raise
         finally:
-            cursor.close()
-            conn.close()
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except psycopg2.Error:
+                    broken = True
+            self.pool.putconn(conn, discard=broken)
+
+    def close(self):
+        """Снимаем резерв с невыданных кодов и закрываем все соединения пула"""
+        if self.referral_code_block:
+            self.release_referral_codes(self.referral_code_block.drain())
+        self.pool.closeall()
+
+    def get_pool_stats(self):
+        return self.pool.stats()
 
     def init_database(self):
-        """Проверяем и создаем таблицы если их нет"""
+        """Приводим схему базы к последней версии (см. каталог migrations)"""
         try:
+            self.pool.warmup()
             with self.get_cursor() as cursor:
-                # Проверяем существование таблиц и создаем если нужно
-                cursor.execute("""
-                    SELECT EXISTS (
-                        SELECT FROM information_schema.tables 
-                        WHERE table_name = 'users'
-                    );
-                """)
-                users_exists = cursor.fetchone()['exists']
-
-                if not users_exists:
-                    logger.info("Creating database tables...")
-                    self.create_tables(cursor)
-                else:
-                    logger.info("Database tables already exist")
-
+                migrations.migrate(cursor)
         except Exception as e:
             logger.error(f"Database initialization error: {e}")
             raise
 
-    def create_tables(self, cursor):
-        """Создание всех таблиц"""
-        cursor.execute('''
-            CREATE TABLE users (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT UNIQUE NOT NULL,
-                username VARCHAR(100) NOT NULL,
-                first_name VARCHAR(100),
-                last_name VARCHAR(100),
-                patronymic VARCHAR(100),
-                email VARCHAR(120),
-                phone VARCHAR(20),
-                referral_code VARCHAR(50) UNIQUE NOT NULL,
-                registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                bonus_balance DECIMAL(10,2) DEFAULT 0.00,
-                is_active BOOLEAN DEFAULT TRUE
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE referrals (
-                id SERIAL PRIMARY KEY,
-                referrer_id INTEGER NOT NULL REFERENCES users(id),
-                referred_user_id INTEGER NOT NULL REFERENCES users(id),
-                referral_code_used VARCHAR(50) NOT NULL,
-                discount_applied BOOLEAN DEFAULT FALSE,
-                bonus_paid BOOLEAN DEFAULT FALSE,
-                referral_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE admins (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT UNIQUE NOT NULL,
-                username VARCHAR(100),
-                full_name VARCHAR(200),
-                permissions VARCHAR(50) DEFAULT 'view',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT TRUE
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE payouts (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL REFERENCES users(id),
-                amount DECIMAL(10,2) NOT NULL,
-                status VARCHAR(20) DEFAULT 'pending',
-                payout_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                admin_telegram_id BIGINT
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE user_sessions (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT NOT NULL,
-                current_step VARCHAR(50) DEFAULT 'start',
-                registration_data JSONB,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Создаем индексы
-        cursor.execute('CREATE INDEX idx_users_telegram_id ON users(telegram_id)')
-        cursor.execute('CREATE INDEX idx_users_referral_code ON users(referral_code)')
-        cursor.execute('CREATE INDEX idx_admins_telegram_id ON admins(telegram_id)')
-        cursor.execute('CREATE INDEX idx_user_sessions_telegram_id ON user_sessions(telegram_id)')
-
-        # Добавляем администратора по умолчанию
-        cursor.execute('''
-            INSERT INTO admins (telegram_id, username, full_name, permissions) 
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (telegram_id) DO NOTHING
-        ''', (5321942267, 'm3irzoev_f1', 'Мирзоев Фирдавс', 'full'))
+    def register_user(self, telegram_id, username, first_name=None, last_name=None, patronymic=None, email=None,
+                      phone=None, referral_code_used=None, referral_code=None):
+        """
+        Регистрация одним запросом в одной транзакции: создает пользователя, находит пригласившего
+        по referral_code_used, создает реферальную связь и удаляет сессию регистрации из user_sessions.
+        Если сгенерированный код уже занят, запрос повторяется с новым кодом в той же транзакции.
+        referral_code — код, заранее зарезервированный через reserve_referral_codes (например, при импорте).
+        Возвращает словарь id, referral_code, referrer_id, referrer_username (последние два — None,
+        если связь не создана) или None при ошибке.
+        """
+        if referral_code_used:
+            referral_code_used = normalize_referral_code(referral_code_used)
+        # Код из блока берем до открытия транзакции: пополнение блока занимает свое соединение пула
+        reserved_code = referral_code if referral_code is not None else self._take_reserved_code()
+        registered = self._insert_user(
+            telegram_id, username, first_name, last_name, patronymic, email, phone, referral_code_used, reserved_code
+        )
+        if registered is None and referral_code is None and reserved_code is not None:
+            # Транзакция откатилась (например, telegram_id уже зарегистрирован) — код из блока
+            # остался в referral_code_reservations, снимаем с него резерв
+            self.release_referral_codes([reserved_code])
+        return registered
+
+    def _insert_user(self, telegram_id, username, first_name, last_name, patronymic, email, phone,
+                     referral_code_used, reserved_code):
+        """Транзакция регистрации для register_user; None, если пользователь не создан"""
+        try:
+            with self.get_cursor() as cursor:
+                for attempt in range(REFERRAL_CODE_CONFIG['max_attempts']):
+                    code = self._pick_referral_code(cursor, attempt, reserved_code)
+                    cursor.execute('''
+                        WITH new_user AS (
+                            INSERT INTO users (telegram_id, username, first_name, last_name, patronymic,
+                                               email, phone, referral_code)
+                            SELECT %(telegram_id)s, %(username)s, %(first_name)s, %(last_name)s, %(patronymic)s,
+                                   %(email)s, %(phone)s, %(code)s
+                            WHERE NOT EXISTS (
+                                SELECT 1 FROM referral_code_reservations WHERE referral_code = %(code)s
+                            )
+                            ON CONFLICT (referral_code) DO NOTHING
+                            RETURNING id, referral_code
+                        ),
+                        referrer AS (
+                            SELECT id, username FROM users
+                            WHERE referral_code = %(referral_code_used)s AND telegram_id <> %(telegram_id)s
+                        ),
+                        new_referral AS (
+                            INSERT INTO referrals (referrer_id, referred_user_id, referral_code_used)
+                            SELECT referrer.id, new_user.id, %(referral_code_used)s
+                            FROM new_user, referrer
+                            ON CONFLICT (referred_user_id) DO NOTHING
+                            RETURNING referrer_id
+                        ),
+                        deleted_session AS (
+                            DELETE FROM user_sessions
+                            WHERE telegram_id = %(telegram_id)s AND EXISTS (SELECT 1 FROM new_user)
+                        )
+                        SELECT new_user.id, new_user.referral_code,
+                               referrer.id as referrer_id, referrer.username as referrer_username
+                        FROM new_user
+                        LEFT JOIN new_referral ON TRUE
+                        LEFT JOIN referrer ON referrer.id = new_referral.referrer_id
+                    ''', {
+                        'telegram_id': telegram_id, 'username': username, 'first_name': first_name,
+                        'last_name': last_name, 'patronymic': patronymic, 'email': email, 'phone': phone,
+                        'code': code, 'referral_code_used': referral_code_used,
+                    })
+                    result = cursor.fetchone()
+                    if result:
+                        logger.info(f"User registered: {username} (ID: {result['id']}, referrer: {result['referrer_id']})")
+                        self.invalidate_user(telegram_id=telegram_id, referral_code=code)
+                        return dict(result)
+                    logger.warning(f"Referral code collision for {username}, retrying")
+            logger.error(f"Could not generate a free referral code for {username}")
+            return None
+        except Exception as e:
+            logger.error(f"User registration error: {e}")
+            return None
 
-        logger.info("Database tables created successfully")
+    def _take_reserved_code(self):
+        """
+        Следующий код из блока зарезервированных или None. Вызывается вне транзакции:
+        при пустом блоке reserve_referral_codes берет из пула отдельное соединение.
+        """
+        return self.referral_code_block.take() if self.referral_code_block else None
+
+    def _pick_referral_code(self, cursor, attempt, reserved_code=None):
+        """
+        Код для очередной попытки вставки пользователя: зарезервированный (только на первой попытке,
+        резерв снимается в текущей транзакции) или случайный. Других соединений не использует.
+        """
+        if attempt == 0 and reserved_code is not None:
+            cursor.execute('DELETE FROM referral_code_reservations WHERE referral_code = %s', (reserved_code,))
+            return reserved_code
+        return generate_referral_code()
+
+    def reserve_referral_codes(self, count):
+        """
+        Резервирует до count свободных реферальных кодов (одна вставка на попытку) и возвращает их.
+        Зарезервированные коды передаются в register_user и не конфликтуют при вставке пользователей.
+        """
+        codes = []
+        try:
+            with self.get_cursor() as cursor:
+                for _ in range(REFERRAL_CODE_CONFIG['max_attempts']):
+                    candidates = list({generate_referral_code() for _ in range(count - len(codes))})
+                    cursor.execute('''
+                        INSERT INTO referral_code_reservations (referral_code)
+                        SELECT code FROM unnest(%s::varchar[]) as code
+                        WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.referral_code = code)
+                        ON CONFLICT (referral_code) DO NOTHING
+                        RETURNING referral_code
+                    ''', (candidates,))
+                    codes.extend(row['referral_code'] for row in cursor.fetchall())
+                    if len(codes) >= count:
+                        break
+            return codes
+        except Exception as e:
+            logger.error(f"Error reserving referral codes: {e}")
+            return []
 
-    def create_user(self, telegram_id, username, first_name=None, last_name=None, patronymic=None, email=None,
-                    phone=None):
-        referral_code = secrets.token_hex(4).upper()
+    def release_referral_codes(self, codes):
+        """Снимает резерв с неиспользованных кодов"""
+        if not codes:
+            return 0
         try:
             with self.get_cursor() as cursor:
-                cursor.execute('''
-                    INSERT INTO users (telegram_id, username, first_name, last_name, patronymic, email, phone, referral_code)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id, referral_code
-                ''', (telegram_id, username, first_name, last_name, patronymic, email, phone, referral_code))
-                result = cursor.fetchone()
-                if result:
-                    logger.info(f"User created: {username} (ID: {result['id']})")
-                    return result['id'], referral_code
-            return None, None
-        except Exception as e:
-            logger.error(f"User creation error: {e}")
-            return None, None
+                cursor.execute('DELETE FROM referral_code_reservations WHERE referral_code = ANY(%s)', (list(codes),))
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Error releasing referral codes: {e}")
+            return 0
+
+    def _get_cached_user(self, column, value):
+        """Чтение пользователя через кэш: при промахе запрос в БД и сохранение под обоими ключами"""
+        user = self.user_cache.get((column, value))
+        if user is not None:
+            return dict(user)
+
+        with self.get_cursor() as cursor:
+            cursor.execute(f'SELECT * FROM users WHERE {column} = %s', (value,))
+            user = cursor.fetchone()
+        if user:
+            user = dict(user)
+            self.user_cache.set(('telegram_id', user['telegram_id']), user)
+            self.user_cache.set(('referral_code', user['referral_code']), user)
+            return dict(user)
+        return None
+
+    def invalidate_user(self, telegram_id=None, referral_code=None):
+        """Сбрасывает закэшированную запись пользователя (по любому из ключей — удаляются оба)"""
+        for key in (('telegram_id', telegram_id), ('referral_code', referral_code)):
+            if key[1] is None:
+                continue
+            user = self.user_cache.pop(key)
+            if user:
+                self.user_cache.pop(('telegram_id', user['telegram_id']))
+                self.user_cache.pop(('referral_code', user['referral_code']))
+
+    def get_user_cache_stats(self):
+        return self.user_cache.stats()
 
     def get_user_by_telegram_id(self, telegram_id):
         try:
-            with self.get_cursor() as cursor:
-                cursor.execute('SELECT * FROM users WHERE telegram_id = %s', (telegram_id,))
-                return cursor.fetchone()
+            return self._get_cached_user('telegram_id', telegram_id)
         except Exception as e:
             logger.error(f"Error getting user by telegram_id: {e}")
             return None
 
     def get_user_by_referral_code(self, referral_code):
         try:
-            with self.get_cursor() as cursor:
-                cursor.execute('SELECT * FROM users WHERE referral_code = %s', (referral_code,))
-                return cursor.fetchone()
+            return self._get_cached_user('referral_code', normalize_referral_code(referral_code))
         except Exception as e:
             logger.error(f"Error getting user by referral_code: {e}")
             return None
 
-    def user_exists(self, telegram_id):
+    def get_all_users(self, limit=None):
+        """Пользователи от новых к старым; limit — сколько вернуть (без limit — все)"""
         try:
             with self.get_cursor() as cursor:
-                cursor.execute('SELECT 1 FROM users WHERE telegram_id = %s', (telegram_id,))
-                return cursor.fetchone() is not None
+                cursor.execute('''
+                    SELECT * FROM users
+                    ORDER BY registration_date DESC, id DESC
+                    LIMIT %s
+                ''', (limit,))
+                return cursor.fetchall()
         except Exception as e:
-            logger.error(f"Error checking user existence: {e}")
-            return False
+            logger.error(f"Error getting users: {e}")
+            return []
+
+    def get_referral_codes_batch(self, after_id=0, limit=500):
+        """Порция реферальных кодов по возрастанию id пользователя (после after_id): список (id, referral_code)"""
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute('''
+                    SELECT id, referral_code FROM users
+                    WHERE id > %s
+                    ORDER BY id
+                    LIMIT %s
+                ''', (after_id, limit))
+                return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting referral codes: {e}")
+            return []
+
+    def user_exists(self, telegram_id):
+        return self.get_user_by_telegram_id(telegram_id) is not None
 
     def get_user_session(self, telegram_id):
         try:
@@ -217,34 +334,56 @@ class DatabaseManager:
                     INSERT INTO user_sessions (telegram_id, current_step, registration_data)
                     VALUES (%s, %s, %s)
                     RETURNING *
-                ''', (telegram_id, current_step, registration_data or {}))
+                ''', (telegram_id, current_step, Json(registration_data or {})))
                 return cursor.fetchone()
         except Exception as e:
             logger.error(f"Error creating user session: {e}")
             return None
 
     def update_user_session(self, telegram_id, current_step=None, registration_data=None):
+        """Атомарно обновляет существующую сессию: registration_data дописывается на сервере (JSONB ||)"""
         try:
             with self.get_cursor() as cursor:
-                cursor.execute('SELECT * FROM user_sessions WHERE telegram_id = %s', (telegram_id,))
-                session = cursor.fetchone()
-                if session:
-                    new_step = current_step if current_step else session['current_step']
-                    new_data = session['registration_data'] or {}
-                    if registration_data:
-                        new_data.update(registration_data)
-                    cursor.execute('''
-                        UPDATE user_sessions 
-                        SET current_step = %s, registration_data = %s, updated_at = CURRENT_TIMESTAMP
-                        WHERE telegram_id = %s
-                        RETURNING *
-                    ''', (new_step, new_data, telegram_id))
-                    return cursor.fetchone()
-            return None
+                cursor.execute('''
+                    UPDATE user_sessions
+                    SET current_step = COALESCE(%s::varchar, current_step),
+                        registration_data = COALESCE(registration_data, '{}'::jsonb) || %s::jsonb,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE telegram_id = %s
+                    RETURNING *
+                ''', (current_step, Json(registration_data or {}), telegram_id))
+                return cursor.fetchone()
         except Exception as e:
             logger.error(f"Error updating user session: {e}")
             return None
 
+    def upsert_user_session(self, telegram_id, current_step=None, registration_data=None):
+        """
+        Создает сессию или атомарно обновляет существующую одним запросом.
+        registration_data объединяется с сохраненными данными на сервере, поэтому
+        два быстрых сообщения пользователя не затирают изменения друг друга.
+        """
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO user_sessions (telegram_id, current_step, registration_data)
+                    VALUES (%(telegram_id)s, COALESCE(%(current_step)s::varchar, 'start'), %(registration_data)s::jsonb)
+                    ON CONFLICT (telegram_id) DO UPDATE
+                    SET current_step = COALESCE(%(current_step)s::varchar, user_sessions.current_step),
+                        registration_data = COALESCE(user_sessions.registration_data, '{}'::jsonb)
+                                            || EXCLUDED.registration_data,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING *
+                ''', {
+                    'telegram_id': telegram_id,
+                    'current_step': current_step,
+                    'registration_data': Json(registration_data or {}),
+                })
+                return cursor.fetchone()
+        except Exception as e:
+            logger.error(f"Error upserting user session: {e}")
+            return None
+
     def delete_user_session(self, telegram_id):
         try:
             with self.get_cursor() as cursor:
@@ -252,12 +391,41 @@ class DatabaseManager:
         except Exception as e:
             logger.error(f"Error deleting user session: {e}")
 
+    def delete_expired_sessions(self, idle_ttl, batch_size=1000):
+        """
+        Удаляет сессии без активности дольше idle_ttl секунд порциями по batch_size,
+        чтобы не держать долгие блокировки. Возвращает количество удаленных сессий.
+        """
+        total_deleted = 0
+        try:
+            while True:
+                with self.get_cursor() as cursor:
+                    cursor.execute('''
+                        DELETE FROM user_sessions
+                        WHERE id IN (
+                            SELECT id FROM user_sessions
+                            WHERE updated_at < LOCALTIMESTAMP - make_interval(secs => %s)
+                            ORDER BY updated_at
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                    ''', (idle_ttl, batch_size))
+                    deleted = cursor.rowcount
+                total_deleted += deleted
+                if deleted < batch_size:
+                    break
+        except Exception as e:
+            logger.error(f"Error deleting expired sessions: {e}")
+        return total_deleted
+
     def create_referral(self, referrer_id, referred_user_id, referral_code):
+        """Реферальная связь; None, если пользователь уже был приглашен (или при ошибке)"""
         try:
             with self.get_cursor() as cursor:
                 cursor.execute('''
                     INSERT INTO referrals (referrer_id, referred_user_id, referral_code_used)
                     VALUES (%s, %s, %s)
+                    ON CONFLICT (referred_user_id) DO NOTHING
                     RETURNING *
                 ''', (referrer_id, referred_user_id, referral_code))
                 return cursor.fetchone()
@@ -265,38 +433,123 @@ class DatabaseManager:
             logger.error(f"Error creating referral: {e}")
             return None
 
-    def get_user_referrals(self, user_id):
+    def _get_referrals_page(self, select, conditions, params, limit=None, after_id=None, before_id=None):
+        """
+        Рефералы (таблица referrals с псевдонимом r) от новых к старым по ключу (referral_date, id).
+        select — SELECT ... FROM ... без WHERE, conditions и params — условия отбора.
+        after_id — следующая страница после реферала с этим id, before_id — предыдущая страница перед ним.
+        Без limit возвращается весь список. Ошибки запроса пробрасываются вызывающему.
+        """
+        conditions = list(conditions)
+        params = list(params)
+        descending = True
+        anchor = after_id if after_id is not None else before_id
+        if anchor is not None:
+            descending = after_id is not None
+            conditions.append(f'''(r.referral_date, r.id) {'<' if descending else '>'} (
+                SELECT referral_date, id FROM referrals WHERE id = %s
+            )''')
+            params.append(anchor)
+        order = 'DESC' if descending else 'ASC'
+        query = f'''
+            {select}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY r.referral_date {order}, r.id {order}
+        '''
+        if limit is not None:
+            query += ' LIMIT %s'
+            params.append(limit)
+        with self.get_cursor() as cursor:
+            cursor.execute(query, params)
+            referrals = cursor.fetchall()
+        # Предыдущая страница читается в обратном порядке — возвращаем ее от новых к старым
+        return referrals if descending else referrals[::-1]
+
+    def get_user_referrals(self, user_id, limit=None, after_id=None, before_id=None):
+        """
+        Рефералы пользователя, от новых к старым (по referral_date, id).
+        Постраничное чтение по ключу: after_id — следующая страница после реферала с этим id,
+        before_id — предыдущая страница перед ним. Без limit возвращается весь список.
+        """
         try:
-            with self.get_cursor() as cursor:
-                cursor.execute('''
-                    SELECT r.*, u.username as referred_username
-                    FROM referrals r
-                    JOIN users u ON r.referred_user_id = u.id
-                    WHERE r.referrer_id = %s
-                    ORDER BY r.referral_date DESC
-                ''', (user_id,))
-                return cursor.fetchall()
+            return self._get_referrals_page(
+                '''
+                SELECT r.*, u.username as referred_username
+                FROM referrals r
+                JOIN users u ON r.referred_user_id = u.id
+                ''',
+                ['r.referrer_id = %s'], [user_id], limit, after_id, before_id
+            )
         except Exception as e:
             logger.error(f"Error getting user referrals: {e}")
             return []
 
-    def get_unpaid_referrals(self):
+    def get_user_balance_summary(self, telegram_id):
+        """
+        Профиль пользователя и агрегаты по его рефералам одним запросом:
+        total_referrals, paid_referrals, unpaid_referrals и pending_bonus_amount.
+        Список рефералов при этом не загружается.
+        """
         try:
             with self.get_cursor() as cursor:
                 cursor.execute('''
-                    SELECT r.*, u1.username as referrer_name, u2.username as referred_name,
-                           u1.telegram_id as referrer_telegram
-                    FROM referrals r
-                    JOIN users u1 ON r.referrer_id = u1.id
-                    JOIN users u2 ON r.referred_user_id = u2.id
-                    WHERE r.bonus_paid = FALSE
-                    ORDER BY r.referral_date DESC
-                ''')
-                return cursor.fetchall()
+                    SELECT u.*, r.total_referrals, r.paid_referrals, r.unpaid_referrals
+                    FROM users u
+                    CROSS JOIN LATERAL (
+                        SELECT COUNT(*) as total_referrals,
+                               COUNT(*) FILTER (WHERE bonus_paid) as paid_referrals,
+                               COUNT(*) FILTER (WHERE NOT bonus_paid) as unpaid_referrals
+                        FROM referrals
+                        WHERE referrer_id = u.id
+                    ) r
+                    WHERE u.telegram_id = %s
+                ''', (telegram_id,))
+                summary = cursor.fetchone()
+            if summary:
+                summary = dict(summary)
+                summary['pending_bonus_amount'] = summary['unpaid_referrals'] * self.referral_bonus_amount
+            return summary
+        except Exception as e:
+            logger.error(f"Error getting user balance summary: {e}")
+            return None
+
+    def get_unpaid_referrals(self, limit=None, after_id=None, before_id=None):
+        """
+        Невыплаченные бонусы от новых к старым (по referral_date, id) — по частичному индексу
+        idx_referrals_unpaid. Постраничное чтение по ключу, как в get_user_referrals:
+        after_id — следующая страница после реферала с этим id, before_id — предыдущая.
+        """
+        try:
+            return self._get_referrals_page(
+                '''
+                SELECT r.*, u1.username as referrer_name, u2.username as referred_name,
+                       u1.telegram_id as referrer_telegram
+                FROM referrals r
+                JOIN users u1 ON r.referrer_id = u1.id
+                JOIN users u2 ON r.referred_user_id = u2.id
+                ''',
+                ['r.bonus_paid = FALSE'], [], limit, after_id, before_id
+            )
         except Exception as e:
             logger.error(f"Error getting unpaid referrals: {e}")
             return []
 
+    def update_user_phone(self, telegram_id, phone):
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute('''
+                    UPDATE users SET phone = %s WHERE telegram_id = %s
+                    RETURNING referral_code
+                ''', (phone, telegram_id))
+                user = cursor.fetchone()
+            if user:
+                self.invalidate_user(telegram_id=telegram_id, referral_code=user['referral_code'])
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"Error updating user phone: {e}")
+            return False
+
     def update_bonus_balance(self, user_id, amount):
         try:
             with self.get_cursor() as cursor:
@@ -304,100 +557,355 @@ class DatabaseManager:
                     UPDATE users 
                     SET bonus_balance = bonus_balance + %s
                     WHERE id = %s
+                    RETURNING telegram_id, referral_code
                 ''', (amount, user_id))
-                return cursor.rowcount > 0
+                user = cursor.fetchone()
+            if user:
+                self.invalidate_user(telegram_id=user['telegram_id'], referral_code=user['referral_code'])
+                return True
+            return False
         except Exception as e:
             logger.error(f"Error updating bonus balance: {e}")
             return False
 
     def mark_bonus_paid(self, referral_id, admin_telegram_id):
+        """
+        Выплата одного бонуса одним запросом: отметка в referrals, запись в payouts и начисление
+        на баланс пригласившего. Уже выплаченный бонус повторно не выплачивается (возвращается False).
+        """
         try:
             with self.get_cursor() as cursor:
-                cursor.execute('SELECT referrer_id FROM referrals WHERE id = %s', (referral_id,))
-                referral = cursor.fetchone()
-                if referral:
-                    cursor.execute('UPDATE referrals SET bonus_paid = TRUE WHERE id = %s', (referral_id,))
-                    cursor.execute('''
+                cursor.execute('''
+                    WITH paid AS (
+                        UPDATE referrals SET bonus_paid = TRUE, bonus_paid_at = CURRENT_TIMESTAMP
+                        WHERE id = %(referral_id)s AND bonus_paid = FALSE
+                        RETURNING referrer_id
+                    ),
+                    payout AS (
                         INSERT INTO payouts (user_id, amount, status, admin_telegram_id)
-                        VALUES (%s, %s, %s, %s)
-                    ''', (referral['referrer_id'], self.referral_bonus_amount, 'paid', admin_telegram_id))
-                    return True
+                        SELECT referrer_id, %(amount)s, 'paid', %(admin_telegram_id)s FROM paid
+                    )
+                    UPDATE users u
+                    SET bonus_balance = COALESCE(u.bonus_balance, 0) + %(amount)s
+                    FROM paid
+                    WHERE u.id = paid.referrer_id
+                    RETURNING u.telegram_id, u.referral_code
+                ''', {'referral_id': referral_id, 'amount': self.referral_bonus_amount,
+                      'admin_telegram_id': admin_telegram_id})
+                user = cursor.fetchone()
+            if user:
+                self.invalidate_user(telegram_id=user['telegram_id'], referral_code=user['referral_code'])
+                return True
             return False
         except Exception as e:
             logger.error(f"Error marking bonus as paid: {e}")
             return False
 
-    def is_admin(self, telegram_id):
+    def get_payout_preview(self, referrer_id=None):
+        """
+        Сводка для пакетной выплаты без изменений в БД: число бонусов и пригласивших, сумма
+        и max_referral_id — снимок, по которому pay_bonuses_batch выплатит ровно эти бонусы.
+        """
         try:
             with self.get_cursor() as cursor:
-                cursor.execute('SELECT 1 FROM admins WHERE telegram_id = %s AND is_active = TRUE', (telegram_id,))
-                return cursor.fetchone() is not None
+                cursor.execute('''
+                    SELECT COUNT(*) as referral_count,
+                           COUNT(DISTINCT referrer_id) as referrer_count,
+                           COUNT(*) * %(amount)s as total_amount,
+                           MAX(id) as max_referral_id
+                    FROM referrals
+                    WHERE bonus_paid = FALSE AND (%(referrer_id)s::integer IS NULL OR referrer_id = %(referrer_id)s)
+                ''', {'amount': self.referral_bonus_amount, 'referrer_id': referrer_id})
+                return cursor.fetchone()
         except Exception as e:
-            logger.error(f"Error checking admin status: {e}")
-            return False
+            logger.error(f"Error getting payout preview: {e}")
+            return None
 
-    def get_admin_stats(self):
-        stats = {}
+    def pay_bonuses_batch(self, admin_telegram_id, token, max_referral_id, referrer_id=None):
+        """
+        Выплачивает невыплаченные бонусы с id <= max_referral_id (все или одного пригласившего)
+        одним запросом в одной транзакции: бонусы отмечаются выплаченными, на каждого пригласившего
+        создается одна запись в payouts на общую сумму и пополняется баланс.
+        token — идентификатор пакета: повторная отправка того же пакета ничего не выплачивает.
+        Возвращает словарь batch_id, referral_count, referrer_count, total_amount, already_processed
+        или None при ошибке. batch_id = None, если пакет уже был обработан (already_processed)
+        или платить нечего (referral_count = 0): пустой пакет в payout_batches не сохраняется.
+        """
         try:
             with self.get_cursor() as cursor:
-                cursor.execute('SELECT COUNT(*) as count FROM users')
-                stats['total_users'] = cursor.fetchone()['count']
+                cursor.execute('''
+                    WITH batch AS (
+                        INSERT INTO payout_batches (token, admin_telegram_id)
+                        VALUES (%(token)s, %(admin_telegram_id)s)
+                        ON CONFLICT (token) DO NOTHING
+                        RETURNING id
+                    ),
+                    paid AS (
+                        UPDATE referrals r SET bonus_paid = TRUE, bonus_paid_at = CURRENT_TIMESTAMP
+                        FROM batch
+                        WHERE r.bonus_paid = FALSE AND r.id <= %(max_referral_id)s
+                          AND (%(referrer_id)s::integer IS NULL OR r.referrer_id = %(referrer_id)s)
+                        RETURNING r.referrer_id
+                    ),
+                    totals AS (
+                        SELECT referrer_id, COUNT(*) * %(amount)s as amount
+                        FROM paid
+                        GROUP BY referrer_id
+                    ),
+                    payout AS (
+                        INSERT INTO payouts (user_id, amount, status, admin_telegram_id, batch_id)
+                        SELECT totals.referrer_id, totals.amount, 'paid', %(admin_telegram_id)s, batch.id
+                        FROM totals, batch
+                    ),
+                    balances AS (
+                        UPDATE users u
+                        SET bonus_balance = COALESCE(u.bonus_balance, 0) + totals.amount
+                        FROM totals
+                        WHERE u.id = totals.referrer_id
+                        RETURNING u.telegram_id, u.referral_code
+                    )
+                    SELECT (SELECT id FROM batch) as batch_id,
+                           (SELECT COUNT(*) FROM paid) as referral_count,
+                           (SELECT COUNT(*) FROM totals) as referrer_count,
+                           (SELECT COALESCE(SUM(amount), 0) FROM totals) as total_amount,
+                           (SELECT COALESCE(json_agg(json_build_array(telegram_id, referral_code)), '[]')
+                            FROM balances) as credited_users
+                ''', {'token': token, 'admin_telegram_id': admin_telegram_id, 'max_referral_id': max_referral_id,
+                      'referrer_id': referrer_id, 'amount': self.referral_bonus_amount})
+                result = dict(cursor.fetchone())
+                result['already_processed'] = result['batch_id'] is None
+                if not result['already_processed'] and not result['referral_count']:
+                    # Бонусы из сводки уже выплачены другим пакетом: удаляем пустой пакет в той же транзакции
+                    cursor.execute('DELETE FROM payout_batches WHERE id = %s', (result['batch_id'],))
+                    result['batch_id'] = None
+            for telegram_id, referral_code in result.pop('credited_users'):
+                self.invalidate_user(telegram_id=telegram_id, referral_code=referral_code)
+            if result['already_processed']:
+                logger.info(f"Payout batch {token} was already processed")
+            elif result['batch_id'] is None:
+                logger.info(f"Payout batch {token} had nothing to pay")
+            else:
+                logger.info(f"Payout batch {result['batch_id']}: {result['referral_count']} bonuses, "
+                            f"{result['referrer_count']} referrers, {result['total_amount']} total")
+            return result
+        except Exception as e:
+            logger.error(f"Error paying bonuses batch: {e}")
+            return None
 
-                cursor.execute('SELECT COUNT(*) as count FROM referrals')
-                stats['total_referrals'] = cursor.fetchone()['count']
+    def load_admins(self):
+        """Загружает таблицу admins в память: {telegram_id: permissions}"""
+        with self._admins_lock:
+            return self._load_admins()
 
-                cursor.execute('SELECT COUNT(*) as count FROM referrals WHERE bonus_paid = FALSE')
-                stats['unpaid_bonuses'] = cursor.fetchone()['count']
+    def _load_admins(self):
+        """Перечитывает admins; вызывается под _admins_lock, чтобы таблицу загружал один поток"""
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute('SELECT telegram_id, permissions FROM admins WHERE is_active = TRUE')
+                admins = {row['telegram_id']: row['permissions'] or 'view' for row in cursor.fetchall()}
+            self._admins = admins
+            self._admins_next_load = time.monotonic() + ADMIN_CACHE_TTL
+            logger.info(f"Admin cache loaded: {len(admins)} admins")
+            return True
+        except Exception as e:
+            # При ошибке продолжаем пользоваться прошлым снимком и повторяем загрузку
+            # не раньше чем через ADMIN_CACHE_RETRY секунд, а не на каждой проверке прав
+            self._admins_next_load = time.monotonic() + ADMIN_CACHE_RETRY
+            logger.error(f"Error loading admins: {e}")
+            return False
+
+    def get_admin_permissions(self, telegram_id):
+        """Уровень прав админа ('view' или 'full') или None, если пользователь не админ"""
+        with self._admins_lock:
+            if time.monotonic() >= self._admins_next_load:
+                self._load_admins()
+            admins = self._admins or {}
+        return admins.get(telegram_id)
+
+    def is_admin(self, telegram_id):
+        return self.get_admin_permissions(telegram_id) is not None
 
-                cursor.execute('SELECT COUNT(*) as count FROM referrals WHERE bonus_paid = TRUE')
-                stats['total_bonus_paid'] = cursor.fetchone()['count']
+    def has_admin_permission(self, telegram_id, required='view'):
+        permissions = self.get_admin_permissions(telegram_id)
+        if permissions is None:
+            return False
+        return ADMIN_PERMISSION_LEVELS.get(permissions, 1) >= ADMIN_PERMISSION_LEVELS[required]
+
+    def get_admin_stats(self):
+        """
+        Все счетчики админ-панели одним запросом. Счетчики хранятся в слотах stats_counters
+        и поддерживаются триггерами, поэтому не зависят от размера таблиц; регистрации
+        за сутки считаются по индексу idx_users_registration_date.
+        """
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute('''
+                    SELECT SUM(s.total_users)::bigint as total_users, SUM(s.total_referrals)::bigint as total_referrals,
+                           SUM(s.unpaid_bonuses)::bigint as unpaid_bonuses, SUM(s.paid_bonuses)::bigint as total_bonus_paid,
+                           SUM(s.total_bonus_balance) as total_bonus_balance,
+                           (SELECT COUNT(*) FROM users
+                            WHERE registration_date > LOCALTIMESTAMP - INTERVAL '24 hours') as registrations_24h
+                    FROM stats_counters s
+                ''')
+                stats = dict(cursor.fetchone())
+            stats['pending_bonus_amount'] = stats['unpaid_bonuses'] * self.referral_bonus_amount
+            return stats
         except Exception as e:
             logger.error(f"Error getting admin stats: {e}")
             # Возвращаем значения по умолчанию в случае ошибки
-            stats = {
+            return {
                 'total_users': 0,
                 'total_referrals': 0,
                 'unpaid_bonuses': 0,
-                'total_bonus_paid': 0
+                'total_bonus_paid': 0,
+                'total_bonus_balance': 0,
+                'registrations_24h': 0,
+                'pending_bonus_amount': 0
             }
-        return stats
 
-    def export_to_excel(self):
+    def iter_query_chunks(self, query, params=None, chunk_size=5000):
+        """
+        Читает результат запроса серверным (именованным) курсором порциями.
+        Отдает пары (описание колонок cursor.description, список строк-кортежей); первая пара
+        отдается всегда, даже если строк нет. Соединение занято, пока идет чтение.
+        """
+        conn = self.pool.getconn()
+        cursor = None
+        broken = False
+        try:
+            cursor = conn.cursor(name=f"export_{secrets.token_hex(4)}", cursor_factory=psycopg2.extensions.cursor)
+            cursor.itersize = chunk_size
+            cursor.execute(query, params)
+            rows = cursor.fetchmany(chunk_size)
+            columns = list(cursor.description)
+            yield columns, rows
+            while rows:
+                rows = cursor.fetchmany(chunk_size)
+                if rows:
+                    yield columns, rows
+            cursor.close()
+            conn.commit()
+        except Exception as e:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                broken = True
+            logger.error(f"Database error while streaming query: {e}")
+            raise
+        finally:
+            if cursor is not None and not cursor.closed:
+                try:
+                    cursor.close()
+                except psycopg2.Error:
+                    broken = True
+            self.pool.putconn(conn, discard=broken)
+
+    def get_export_watermark(self, admin_telegram_id, export_format):
         try:
             with self.get_cursor() as cursor:
-                workbook = openpyxl.Workbook()
-
-                users_sheet = workbook.active
-                users_sheet.title = "Пользователи"
-                cursor.execute('SELECT * FROM users ORDER BY registration_date DESC')
-                users = cursor.fetchall()
-                if users:
-                    users_sheet.append(list(users[0].keys()))
-                    for user in users:
-                        users_sheet.append(list(user.values()))
-
-                referrals_sheet = workbook.create_sheet("Рефералы")
                 cursor.execute('''
-                    SELECT r.*, u1.username as referrer_name, u2.username as referred_name 
-                    FROM referrals r
-                    JOIN users u1 ON r.referrer_id = u1.id
-                    JOIN users u2 ON r.referred_user_id = u2.id
-                    ORDER BY r.referral_date DESC
-                ''')
-                referrals = cursor.fetchall()
-                if referrals:
-                    referrals_sheet.append(list(referrals[0].keys()))
-                    for referral in referrals:
-                        referrals_sheet.append(list(referral.values()))
+                    SELECT exported_until FROM export_watermarks
+                    WHERE admin_telegram_id = %s AND export_format = %s
+                ''', (admin_telegram_id, export_format))
+                row = cursor.fetchone()
+                return row['exported_until'] if row else None
+        except Exception as e:
+            logger.error(f"Error getting export watermark: {e}")
+            raise
 
-                excel_file = BytesIO()
-                workbook.save(excel_file)
-                excel_file.seek(0)
-                return excel_file
+    def set_export_watermark(self, admin_telegram_id, export_format, exported_until):
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO export_watermarks (admin_telegram_id, export_format, exported_until)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (admin_telegram_id, export_format)
+                    DO UPDATE SET exported_until = EXCLUDED.exported_until, updated_at = CURRENT_TIMESTAMP
+                ''', (admin_telegram_id, export_format, exported_until))
+                return True
+        except Exception as e:
+            logger.error(f"Error setting export watermark: {e}")
+            return False
+
+    def get_delta_export_until(self, lag_seconds):
+        """
+        Верхняя граница инкрементального экспорта. Отступаем на lag_seconds назад,
+        чтобы не пропустить строки транзакций, которые начались раньше, но еще не завершились.
+        """
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT LOCALTIMESTAMP - make_interval(secs => %s) as exported_until', (lag_seconds,))
+            return cursor.fetchone()['exported_until']
+
+    def get_export_fingerprint(self):
+        """
+        Версия экспортируемых данных: сумма stats_counters.data_version по слотам, которую триггеры
+        увеличивают при любом изменении строк users и referrals (см. миграцию 009).
+        """
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute('SELECT SUM(data_version)::bigint as data_version FROM stats_counters')
+                row = cursor.fetchone()
+            return row['data_version'] if row else None
+        except Exception as e:
+            logger.error(f"Error getting export fingerprint: {e}")
+            return None
+
+    def export_to_excel(self):
+        try:
+            return exports.write_excel(self)[0].file
         except Exception as e:
             logger.error(f"Error exporting to Excel: {e}")
             raise
 
+    def export(self, export_format='xlsx', progress=None, since=None, until=None):
+        """
+        Экспорт в одном из форматов exports.EXPORT_FORMATS; возвращает список ExportFile.
+        Если задан период (since, until] — выгружаются только изменения за него.
+        """
+        try:
+            return exports.export_data(self, export_format, progress=progress, since=since, until=until)
+        except Exception as e:
+            logger.error(f"Error exporting to {export_format}: {e}")
+            raise
+
+
+class AsyncDatabaseManager:
+    """
+    Асинхронный интерфейс к DatabaseManager для обработчиков бота.
+    Каждый метод DatabaseManager доступен как корутина: вызов выполняется в ограниченном
+    пуле потоков (по одному потоку на соединение пула), поэтому медленный запрос
+    не блокирует цикл событий.
+    """
+
+    def __init__(self, manager, max_workers=None):
+        self.manager = manager
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or manager.pool.max_size,
+            thread_name_prefix='db'
+        )
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.manager, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return wrapper
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.manager.close()
+
 
 # Создаем глобальный экземпляр менеджера БД
-db_manager = DatabaseManager()
\ No newline at end of file
+db_manager = DatabaseManager()
+async_db = AsyncDatabaseManager(db_manager)
\ No newline at end of file
@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведенное время"""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений PostgreSQL с проверкой и переиспользованием соединений"""
+
+    def __init__(self, connect, min_size=2, max_size=10, max_lifetime=1800.0, max_idle=300.0,
+                 checkout_timeout=10.0, health_check_after=30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.checkout_timeout = checkout_timeout
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        # Свободные соединения: (conn, время возврата в пул)
+        self._idle = []
+        # Время создания каждого открытого соединения
+        self._created_at = {}
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._metrics = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'connections_recycled': 0,
+            'health_check_failures': 0,
+            'exhausted': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'peak_in_use': 0,
+        }
+
+    def warmup(self):
+        """Открываем минимальное количество соединений заранее"""
+        conns = []
+        try:
+            while True:
+                with self._cond:
+                    if self._size >= self.min_size:
+                        break
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        waited = False
+
+        while True:
+            conn = None
+            create = False
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                while not self._idle and self._size >= self.max_size:
+                    if not waited:
+                        waited = True
+                        self._metrics['exhausted'] += 1
+                        logger.warning(f"Connection pool exhausted ({self.max_size} connections in use)")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._metrics['timeouts'] += 1
+                        raise PoolTimeout(f"No free connection within {self.checkout_timeout}s")
+                    self._cond.wait(remaining)
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                else:
+                    self._size += 1
+                    create = True
+
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._created_at[id(conn)] = time.monotonic()
+                    self._metrics['connections_created'] += 1
+            elif not self._is_usable(conn, returned_at):
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._in_use += 1
+                self._metrics['checkouts'] += 1
+                self._metrics['wait_time_total'] += time.monotonic() - started
+                self._metrics['peak_in_use'] = max(self._metrics['peak_in_use'], self._in_use)
+            return conn
+
+    def putconn(self, conn, discard=False):
+        with self._cond:
+            self._in_use -= 1
+
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard or conn.closed or self._closed:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _is_usable(self, conn, returned_at):
+        """Проверка соединения при выдаче из пула"""
+        if conn.closed:
+            return False
+
+        now = time.monotonic()
+        created_at = self._created_at.get(id(conn), now)
+        if now - created_at > self.max_lifetime or now - returned_at > self.max_idle:
+            with self._cond:
+                self._metrics['connections_recycled'] += 1
+            return False
+
+        # Пингуем только соединения, которые долго простаивали — остальным доверяем
+        if now - returned_at > self.health_check_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error as e:
+                logger.warning(f"Pooled connection failed health check: {e}")
+                with self._cond:
+                    self._metrics['health_check_failures'] += 1
+                return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._size -= 1
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+        logger.info("Connection pool closed")
+
+    def stats(self):
+        """Метрики пула для мониторинга"""
+        with self._cond:
+            stats = dict(self._metrics)
+            stats.update({
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            })
+        return stats
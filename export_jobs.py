@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import TelegramError
+
+import exports
+from config import EXPORT_CONFIG
+from database import db_manager, async_db
+
+logger = logging.getLogger(__name__)
+
+
+class ExportJob:
+    def __init__(self, key, export_format, delta_admin_id=None):
+        self.key = key
+        self.export_format = export_format
+        # Для инкрементального экспорта — админ, чья отметка (watermark) используется
+        self.delta_admin_id = delta_admin_id
+        # Кому доставить результат: (chat_id, message_id сообщения с прогрессом)
+        self.requesters = []
+        self.rows_written = 0
+        self.task = None
+
+
+class ExportJobManager:
+    """
+    Фоновые задачи экспорта: задача ставится в очередь, выполняется вне цикла событий,
+    прогресс показывается редактированием сообщения, файл отправляется по готовности.
+    Одновременные запросы одного и того же экспорта объединяются в одну задачу,
+    а если данные не менялись — повторно отправляется последний результат по file_id.
+    Инкрементальный экспорт выгружает только изменения с отметки прошлого экспорта админа.
+    """
+
+    def __init__(self, max_concurrent=1, progress_interval=3.0, delta_lag=60.0):
+        self.progress_interval = progress_interval
+        self.delta_lag = delta_lag
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._jobs = {}
+        # key -> (отпечаток данных, [(имя файла, file_id документа), ...])
+        self._last_results = {}
+
+    async def submit(self, bot, chat_id, export_format='xlsx', delta_admin_id=None):
+        if export_format not in exports.EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {export_format}")
+        key = export_format if delta_admin_id is None else f"{export_format}:delta:{delta_admin_id}"
+        job = self._jobs.get(key)
+        if job:
+            message = await bot.send_message(
+                chat_id=chat_id,
+                text="⏳ Этот экспорт уже выполняется — файл придет, как только он будет готов."
+            )
+            job.requesters.append((chat_id, message.message_id))
+            return
+
+        # Задача регистрируется до первого await: одновременный запрос того же экспорта
+        # должен присоединиться к ней, а не запустить второй экспорт
+        job = ExportJob(key, export_format, delta_admin_id)
+        self._jobs[key] = job
+        try:
+            message = await bot.send_message(chat_id=chat_id, text="⏳ Экспорт поставлен в очередь...")
+        except Exception:
+            # Те, кто уже присоединился к задаче, все равно получат файл
+            if job.requesters:
+                job.task = asyncio.create_task(self._run(bot, job))
+            else:
+                self._forget(job)
+            raise
+        job.requesters.insert(0, (chat_id, message.message_id))
+        job.task = asyncio.create_task(self._run(bot, job))
+
+    def _forget(self, job):
+        """Убирает задачу из списка выполняемых, если под ее ключом не зарегистрирована уже другая"""
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+
+    async def _run(self, bot, job):
+        try:
+            async with self._semaphore:
+                if job.delta_admin_id is not None:
+                    await self._run_delta(bot, job)
+                    return
+
+                fingerprint = await async_db.get_export_fingerprint()
+                last_result = self._last_results.get(job.key)
+                if fingerprint is not None and last_result and last_result[0] == fingerprint:
+                    logger.info(f"Export {job.key}: data unchanged, reusing last file")
+                    await self._deliver(bot, job, last_result[1], reused=True)
+                    return
+
+                reporter = asyncio.create_task(self._report_progress(bot, job))
+                try:
+                    export_files = await async_db.run(db_manager.export, job.export_format,
+                                                      progress=self._progress(job))
+                finally:
+                    reporter.cancel()
+
+                try:
+                    documents = [(export_file.filename, export_file.file) for export_file in export_files]
+                    file_ids = await self._deliver(bot, job, documents)
+                finally:
+                    for export_file in export_files:
+                        export_file.file.close()
+                if fingerprint is not None and all(file_id for _, file_id in file_ids):
+                    self._last_results[job.key] = (fingerprint, file_ids)
+        except Exception as e:
+            logger.error(f"Export job {job.key} failed: {e}")
+            await self._edit_all(bot, job, f"❌ Ошибка при экспорте: {e}")
+        finally:
+            self._forget(job)
+
+    async def _run_delta(self, bot, job):
+        since = await async_db.get_export_watermark(job.delta_admin_id, job.export_format)
+        until = await async_db.get_delta_export_until(self.delta_lag)
+        logger.info(f"Delta export {job.key}: changes after {since} up to {until}")
+
+        reporter = asyncio.create_task(self._report_progress(bot, job))
+        try:
+            export_files = await async_db.run(db_manager.export, job.export_format,
+                                              progress=self._progress(job), since=since, until=until)
+        finally:
+            reporter.cancel()
+
+        try:
+            documents = [(export_file.filename, export_file.file) for export_file in export_files]
+            await self._deliver(bot, job, documents, since=since)
+        finally:
+            for export_file in export_files:
+                export_file.file.close()
+        # Отметку сдвигаем только после успешной доставки, чтобы при ошибке изменения не потерялись
+        await async_db.set_export_watermark(job.delta_admin_id, job.export_format, until)
+
+    @staticmethod
+    def _progress(job):
+        # Вызывается из рабочего потока: только сохраняем счетчик, сообщения редактирует цикл событий
+        def callback(rows_written):
+            job.rows_written = rows_written
+        return callback
+
+    async def _report_progress(self, bot, job):
+        reported = None
+        started = time.monotonic()
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            if job.rows_written != reported:
+                reported = job.rows_written
+                elapsed = int(time.monotonic() - started)
+                await self._edit_all(bot, job, f"⏳ Экспорт: записано строк — {reported} ({elapsed} сек.)")
+
+    async def _edit_all(self, bot, job, text):
+        for chat_id, message_id in list(job.requesters):
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+            except TelegramError as e:
+                logger.debug(f"Could not update export progress message: {e}")
+
+    async def _deliver(self, bot, job, documents, reused=False, since=None):
+        """
+        Отправляет файлы всем, кто ждет эту задачу. documents — список (имя файла, файл или file_id).
+        Первому получателю файлы загружаются, остальным отправляются по file_id.
+        Возвращает список (имя файла, file_id).
+        """
+        caption = f"📊 Экспорт данных ({exports.EXPORT_FORMATS[job.export_format][1]})"
+        if reused:
+            caption += " — данные не изменились с прошлого экспорта"
+        elif job.delta_admin_id is not None:
+            caption += f" — изменения с {since.strftime('%d.%m.%Y %H:%M') if since else 'начала'}"
+
+        # Список может пополниться во время отправки — новые получатели тоже получат файлы
+        index = 0
+        while index < len(job.requesters):
+            chat_id, message_id = job.requesters[index]
+            index += 1
+            sent = []
+            for filename, document in documents:
+                message = await bot.send_document(
+                    chat_id=chat_id,
+                    document=document,
+                    filename=filename,
+                    caption=caption
+                )
+                sent.append((filename, message.document.file_id if message.document else document))
+            documents = sent
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="✅ Экспорт готов")
+            except TelegramError:
+                pass
+        return documents
+
+
+export_jobs = ExportJobManager(
+    max_concurrent=EXPORT_CONFIG['max_concurrent_jobs'],
+    progress_interval=EXPORT_CONFIG['progress_interval'],
+    delta_lag=EXPORT_CONFIG['delta_lag']
+)
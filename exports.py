@@ -0,0 +1,216 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import tempfile
+from collections import namedtuple
+from datetime import datetime
+
+import openpyxl
+
+from config import EXPORT_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Готовый файл экспорта: имя для отправки и временный файл, открытый с начала
+ExportFile = namedtuple('ExportFile', ['filename', 'file'])
+
+# Наборы данных для экспорта: (имя файла, название листа, запрос, условие для инкрементального экспорта).
+# Условия инкрементального экспорта опираются на индексы по датам и отбирают только строки за период
+# (since, until]; для рефералов учитывается и время выплаты бонуса.
+EXPORT_DATASETS = [
+    ('users', "Пользователи", '''
+        SELECT * FROM users
+        {where}
+        ORDER BY registration_date DESC
+    ''', 'registration_date > %(since)s AND registration_date <= %(until)s'),
+    ('referrals', "Рефералы", '''
+        SELECT r.*, u1.username as referrer_name, u2.username as referred_name
+        FROM referrals r
+        JOIN users u1 ON r.referrer_id = u1.id
+        JOIN users u2 ON r.referred_user_id = u2.id
+        {where}
+        ORDER BY r.referral_date DESC
+    ''', '''(r.referral_date > %(since)s AND r.referral_date <= %(until)s)
+           OR (r.bonus_paid_at > %(since)s AND r.bonus_paid_at <= %(until)s)'''),
+]
+
+
+def _temp_file(suffix):
+    return tempfile.TemporaryFile(suffix=suffix, dir=EXPORT_CONFIG['tmp_dir'] or None)
+
+
+def iter_datasets(db, chunk_size=None, progress=None, since=None, until=None):
+    """
+    Общий источник строк для всех форматов: для каждого набора данных отдает
+    (имя, название, итератор порций (колонки, строки)). Порции читаются серверным курсором.
+    Если задан until — отдаются только строки, изменившиеся в периоде (since, until].
+    """
+    chunk_size = chunk_size or EXPORT_CONFIG['chunk_size']
+    counter = {'rows': 0}
+
+    def chunks(query, params):
+        for columns, rows in db.iter_query_chunks(query, params, chunk_size=chunk_size):
+            yield columns, rows
+            counter['rows'] += len(rows)
+            if progress:
+                progress(counter['rows'])
+
+    for name, title, query, delta_condition in EXPORT_DATASETS:
+        if until is None:
+            yield name, title, chunks(query.format(where=''), None)
+        else:
+            params = {'since': since or datetime.min, 'until': until}
+            yield name, title, chunks(query.format(where=f'WHERE {delta_condition}'), params)
+
+
+def write_excel(db, chunk_size=None, progress=None, since=None, until=None):
+    """
+    Потоковый экспорт в Excel: строки читаются серверным курсором порциями и сразу
+    пишутся в книгу в режиме write-only, поэтому расход памяти не зависит от числа строк.
+    progress — необязательная функция, которой передается число записанных строк после каждой порции.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+
+    for name, title, chunks in iter_datasets(db, chunk_size, progress, since, until):
+        sheet = workbook.create_sheet(title)
+        header_written = False
+        for columns, rows in chunks:
+            if not header_written:
+                sheet.append([column.name for column in columns])
+                header_written = True
+            for row in rows:
+                sheet.append(row)
+
+    excel_file = _temp_file('.xlsx')
+    try:
+        workbook.save(excel_file)
+    except Exception:
+        excel_file.close()
+        raise
+    excel_file.seek(0)
+    return [ExportFile("referral_data.xlsx", excel_file)]
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def write_csv(db, chunk_size=None, progress=None, since=None, until=None):
+    """Потоковый экспорт в CSV, сжатый gzip: по одному файлу на набор данных"""
+    files = []
+    try:
+        for name, title, chunks in iter_datasets(db, chunk_size, progress, since, until):
+            csv_file = _temp_file('.csv.gz')
+            files.append(ExportFile(f"{name}.csv.gz", csv_file))
+            # GzipFile не закрывает переданный fileobj, поэтому временный файл остается открытым
+            with gzip.GzipFile(fileobj=csv_file, mode='wb', compresslevel=6) as gz, \
+                    io.TextIOWrapper(gz, encoding='utf-8', newline='') as text:
+                writer = csv.writer(text)
+                header_written = False
+                for columns, rows in chunks:
+                    if not header_written:
+                        writer.writerow([column.name for column in columns])
+                        header_written = True
+                    writer.writerows([_csv_value(value) for value in row] for row in rows)
+            csv_file.seek(0)
+    except Exception:
+        for export_file in files:
+            export_file.file.close()
+        raise
+    return files
+
+
+def _parquet_schema(pa, columns):
+    """Схема Parquet по типам колонок PostgreSQL (OID из cursor.description)"""
+    fields = []
+    for column in columns:
+        type_code = column.type_code
+        if type_code == 16:
+            arrow_type = pa.bool_()
+        elif type_code in (20, 21, 23):
+            arrow_type = pa.int64()
+        elif type_code == 1700 and column.precision:
+            arrow_type = pa.decimal128(column.precision, column.scale or 0)
+        elif type_code in (700, 701):
+            arrow_type = pa.float64()
+        elif type_code == 1114:
+            arrow_type = pa.timestamp('us')
+        elif type_code == 1184:
+            arrow_type = pa.timestamp('us', tz='UTC')
+        elif type_code == 1082:
+            arrow_type = pa.date32()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+def write_parquet(db, chunk_size=None, progress=None, since=None, until=None):
+    """Потоковый экспорт в Parquet: каждая порция строк записывается отдельной группой строк"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Для экспорта в Parquet установите пакет pyarrow")
+
+    files = []
+    try:
+        for name, title, chunks in iter_datasets(db, chunk_size, progress, since, until):
+            parquet_file = _temp_file('.parquet')
+            files.append(ExportFile(f"{name}.parquet", parquet_file))
+            writer = None
+            try:
+                for columns, rows in chunks:
+                    if writer is None:
+                        schema = _parquet_schema(pa, columns)
+                        writer = pq.ParquetWriter(parquet_file, schema, compression='snappy')
+                    arrays = []
+                    column_values = list(zip(*rows)) if rows else [()] * len(schema)
+                    for field, values in zip(schema, column_values):
+                        if pa.types.is_string(field.type):
+                            values = [None if value is None else str(_csv_value(value)) for value in values]
+                        arrays.append(pa.array(values, type=field.type))
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            finally:
+                if writer is not None:
+                    writer.close()
+            parquet_file.seek(0)
+    except Exception:
+        for export_file in files:
+            export_file.file.close()
+        raise
+    return files
+
+
+# Поддерживаемые форматы экспорта: код -> (функция, подпись)
+EXPORT_FORMATS = {
+    'xlsx': (write_excel, "Excel"),
+    'csv': (write_csv, "CSV (gzip)"),
+    'parquet': (write_parquet, "Parquet"),
+}
+
+
+def export_data(db, export_format='xlsx', chunk_size=None, progress=None, since=None, until=None):
+    """
+    Экспорт в выбранном формате; возвращает список ExportFile.
+    Если задан until — инкрементальный экспорт изменений за период (since, until].
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    writer, label = EXPORT_FORMATS[export_format]
+    files = writer(db, chunk_size=chunk_size, progress=progress, since=since, until=until)
+    if until is not None:
+        files = [ExportFile(_delta_filename(export_file.filename), export_file.file) for export_file in files]
+    logger.info(f"{label} export finished: {', '.join(export_file.filename for export_file in files)}")
+    return files
+
+
+def _delta_filename(filename):
+    base, _, extension = filename.partition('.')
+    return f"{base}_delta.{extension}"
@@ -1,15 +1,23 @@
+import asyncio
 import logging
 import re
-import qrcode
+import secrets
 from io import BytesIO
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
 
-from config import ADMIN_ID
-from database import db_manager
+from config import ADMIN_ID, SESSION_CONFIG
+from database import async_db
+from export_jobs import export_jobs
+from exports import EXPORT_FORMATS
+from outbox import outbox
+from qr_codes import qr_cache
+from referral_codes import normalize_referral_code
+from session_store import session_store
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -20,28 +28,22 @@ logger = logging.getLogger(__name__)
 # Состояния разговора
 START, NAME, EMAIL, PHONE, COMPLETE = range(5)
 
+# Рефералов на одной странице /referrals
+REFERRALS_PAGE_SIZE = 10
+# Невыплаченных бонусов на одной странице админ-панели
+UNPAID_PAGE_SIZE = 10
+
 
 class BotHandlers:
     def __init__(self, application):
         self.application = application
         self.bot = application.bot
+        # Фоновая задача предварительной генерации QR-кодов (одна на процесс)
+        self._qr_prerender_task = None
 
-    def generate_qr_code(self, data):
-        """Генерация QR-кода"""
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(data)
-        qr.make(fit=True)
-
-        img = qr.make_image(fill_color="black", back_color="white")
-        bio = BytesIO()
-        img.save(bio, 'PNG')
-        bio.seek(0)
-        return bio
+    async def generate_qr_code(self, data):
+        """Генерация QR-кода (с кэшированием по содержимому, в пуле процессов)"""
+        return BytesIO(await qr_cache.get_png_async(data))
 
     def generate_referral_link(self, referral_code):
         """Генерация реферальной ссылки"""
@@ -59,7 +61,7 @@ class BotHandlers:
                 referral_code = context.args[0]
 
             # Если пользователь уже зарегистрирован
-            if db_manager.user_exists(telegram_id):
+            if await async_db.user_exists(telegram_id):
                 if referral_code:
                     # Обрабатываем реферальный код для уже зарегистрированного пользователя
                     await self.process_referral_code(update, context, referral_code, telegram_id)
@@ -78,21 +80,18 @@ class BotHandlers:
             # Если у пользователя есть username — регистрируем автоматически (только username)
             if user.username:
                 try:
-                    # При создании мы передаём username и минимум данных; db_manager должен принять такие значения
-                    user_id, user_referral_code = db_manager.create_user(
+                    # Создаем пользователя только с username и сразу привязываем referral,
+                    # если был код в параметрах /start — одной транзакцией
+                    registered = await async_db.register_user(
                         telegram_id=telegram_id,
                         username=user.username,
-                        first_name=None,
-                        last_name=None,
-                        patronymic=None,
-                        email=None,
-                        phone=None
+                        referral_code_used=referral_code
                     )
-                    # Привязываем referral, если был код в параметрах /start
-                    if referral_code and user_id:
-                        referrer = db_manager.get_user_by_referral_code(referral_code)
-                        if referrer and referrer['telegram_id'] != telegram_id:
-                            db_manager.create_referral(referrer['id'], user_id, referral_code)
+                    if not registered:
+                        raise RuntimeError("register_user failed")
+                    # Строку в user_sessions удалил register_user; брошенная ручная регистрация
+                    # могла остаться в быстром уровне хранилища
+                    await session_store.delete(telegram_id, persistent=False)
 
                     await update.message.reply_text(
                         "🎉 Вы успешно зарегистрированы автоматически по username! 🎉\n\n"
@@ -114,11 +113,10 @@ class BotHandlers:
                 return ConversationHandler.END
 
             # Если username нет — используем сессию и просим ФИО
-            if not db_manager.get_user_session(telegram_id):
-                db_manager.create_user_session(telegram_id)
-
-            if referral_code:
-                db_manager.update_user_session(telegram_id, registration_data={'referral_code': referral_code})
+            await session_store.update(
+                telegram_id,
+                registration_data={'referral_code': referral_code} if referral_code else None
+            )
 
             await update.message.reply_text(
                 f"Привет, {user.first_name}! 🎉\n\n"
@@ -141,17 +139,22 @@ class BotHandlers:
                                     telegram_id: int):
         """Обработка реферального кода для существующего пользователя"""
         try:
-            referrer = db_manager.get_user_by_referral_code(referral_code)
+            # Один и тот же нормализованный код и для поиска пригласившего, и для записи в referrals
+            referral_code = normalize_referral_code(referral_code)
+            referrer = await async_db.get_user_by_referral_code(referral_code)
             if referrer and referrer['telegram_id'] != telegram_id:
                 # Создаем реферальную связь
-                user = db_manager.get_user_by_telegram_id(telegram_id)
-                db_manager.create_referral(referrer['id'], user['id'], referral_code)
+                user = await async_db.get_user_by_telegram_id(telegram_id)
+                referral = await async_db.create_referral(referrer['id'], user['id'], referral_code)
 
-                await update.message.reply_text(
-                    "✅ Реферальный код успешно применен!\n\n"
-                    f"Вы были приглашены пользователем: {referrer.get('username')}\n"
-                    "Бонус будет начислен после подтверждения администратором."
-                )
+                if referral:
+                    await update.message.reply_text(
+                        "✅ Реферальный код успешно применен!\n\n"
+                        f"Вы были приглашены пользователем: {referrer.get('username')}\n"
+                        "Бонус будет начислен после подтверждения администратором."
+                    )
+                else:
+                    await update.message.reply_text("ℹ️ Вы уже были приглашены по реферальному коду.")
             else:
                 await update.message.reply_text("❌ Неверный реферальный код")
         except Exception as e:
@@ -175,11 +178,8 @@ class BotHandlers:
                 'patronymic': name_parts[2] if len(name_parts) > 2 else ''
             }
 
-            # Берём текущую сессию, аккуратно мёрджим данные
-            session = db_manager.get_user_session(telegram_id) or {}
-            current_reg = session.get('registration_data', {})
-            current_reg.update(registration_piece)
-            db_manager.update_user_session(telegram_id, current_step=EMAIL, registration_data=current_reg)
+            # Хранилище само дописывает данные к сессии
+            await session_store.update(telegram_id, current_step=EMAIL, registration_data=registration_piece)
 
             await update.message.reply_text(
                 "📧 Укажите ваш email (необязательно):\n"
@@ -204,11 +204,10 @@ class BotHandlers:
                     )
                     return EMAIL
 
-            # Обновляем сессию аккуратно
-            session = db_manager.get_user_session(telegram_id) or {}
-            current_reg = session.get('registration_data', {})
-            current_reg.update({'email': email_input if email_input != '-' else None})
-            db_manager.update_user_session(telegram_id, current_step=PHONE, registration_data=current_reg)
+            await session_store.update(
+                telegram_id, current_step=PHONE,
+                registration_data={'email': email_input if email_input != '-' else None}
+            )
 
             await update.message.reply_text(
                 "📞 Укажите ваш номер телефона (необязательно):\n"
@@ -233,13 +232,11 @@ class BotHandlers:
                     )
                     return PHONE
 
-            # Обновляем сессию аккуратно
-            session = db_manager.get_user_session(telegram_id) or {}
-            current_reg = session.get('registration_data', {})
-            current_reg.update({'phone': phone_input if phone_input != '-' else None})
-            db_manager.update_user_session(telegram_id, current_step=COMPLETE, registration_data=current_reg)
-
-            user_session = db_manager.get_user_session(telegram_id) or {'registration_data': current_reg}
+            # update возвращает сессию уже с объединенными данными
+            user_session = await session_store.update(
+                telegram_id, current_step=COMPLETE,
+                registration_data={'phone': phone_input if phone_input != '-' else None}
+            )
 
             # Проверяем есть ли реферальный код в сессии
             referral_info = ""
@@ -267,7 +264,7 @@ class BotHandlers:
         try:
             telegram_id = update.effective_user.id
             user_input = update.message.text.strip().lower()
-            user_session = db_manager.get_user_session(telegram_id) or {}
+            user_session = await session_store.get(telegram_id) or {}
 
             if user_input == 'нет':
                 await update.message.reply_text(
@@ -275,7 +272,7 @@ class BotHandlers:
                     "Как вас зовут? (Фамилия Имя Отчество):"
                 )
                 # Сбрасываем шаг в сессии
-                db_manager.update_user_session(telegram_id, current_step=NAME, registration_data={})
+                await session_store.update(telegram_id, current_step=NAME)
                 return NAME
 
             elif user_input == 'да':
@@ -284,34 +281,23 @@ class BotHandlers:
                 # Если у пользователя в Telegram есть username — используй его как username по умолчанию
                 username = update.effective_user.username or f"user_{telegram_id}"
 
-                try:
-                    user_id, referral_code = db_manager.create_user(
-                        telegram_id=telegram_id,
-                        username=username,
-                        first_name=registration_data.get('first_name'),
-                        last_name=registration_data.get('last_name'),
-                        patronymic=registration_data.get('patronymic'),
-                        email=registration_data.get('email'),
-                        phone=registration_data.get('phone')
-                    )
-                except Exception as e:
-                    logger.error(f"Error creating user in DB: {e}")
-                    user_id = None
-                    referral_code = None
-
-                if user_id:
-                    # Обрабатываем реферальный код, если он есть
-                    referral_code_used = registration_data.get('referral_code')
-                    if referral_code_used:
-                        try:
-                            referrer = db_manager.get_user_by_referral_code(referral_code_used)
-                            if referrer and referrer['telegram_id'] != telegram_id:
-                                db_manager.create_referral(referrer['id'], user_id, referral_code_used)
-                        except Exception as e:
-                            logger.error(f"Error creating referral relation: {e}")
+                # Пользователь, реферальная связь и удаление сессии — одной транзакцией
+                registered = await async_db.register_user(
+                    telegram_id=telegram_id,
+                    username=username,
+                    first_name=registration_data.get('first_name'),
+                    last_name=registration_data.get('last_name'),
+                    patronymic=registration_data.get('patronymic'),
+                    email=registration_data.get('email'),
+                    phone=registration_data.get('phone'),
+                    referral_code_used=registration_data.get('referral_code')
+                )
 
+                if registered:
+                    referral_code = registered['referral_code']
                     try:
-                        db_manager.delete_user_session(telegram_id)
+                        # Сессия в PostgreSQL уже удалена; здесь — быстрый уровень хранилища (память или Redis)
+                        await session_store.delete(telegram_id, persistent=False)
                     except Exception:
                         pass
 
@@ -355,7 +341,7 @@ class BotHandlers:
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             telegram_id = update.effective_user.id
-            db_manager.delete_user_session(telegram_id)
+            await session_store.delete(telegram_id)
 
             await update.message.reply_text(
                 "Регистрация отменена. 😔\n\n"
@@ -369,7 +355,7 @@ class BotHandlers:
     async def my_referral_code(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             telegram_id = update.effective_user.id
-            user = db_manager.get_user_by_telegram_id(telegram_id)
+            user = await async_db.get_user_by_telegram_id(telegram_id)
 
             if user:
                 await update.message.reply_text(
@@ -391,7 +377,7 @@ class BotHandlers:
         """Показывает реферальную ссылку и QR-код"""
         try:
             telegram_id = update.effective_user.id
-            user = db_manager.get_user_by_telegram_id(telegram_id)
+            user = await async_db.get_user_by_telegram_id(telegram_id)
 
             if not user:
                 await update.message.reply_text(
@@ -403,9 +389,6 @@ class BotHandlers:
             referral_code = user['referral_code']
             referral_link = self.generate_referral_link(referral_code)
 
-            # Генерируем QR-код
-            qr_code = self.generate_qr_code(referral_link)
-
             message_text = (
                 "🎁 Ваши реферальные материалы:\n\n"
                 f"🔗 **Ссылка:**\n`{referral_link}`\n\n"
@@ -416,12 +399,29 @@ class BotHandlers:
                 "• Вы получите бонус после подтверждения администратором"
             )
 
-            # Отправляем QR-код как фото и текст
-            await update.message.reply_photo(
+            # Если этот QR-код уже отправлялся — переиспользуем file_id без генерации и загрузки
+            file_id = qr_cache.get_file_id(referral_link)
+            if file_id:
+                try:
+                    await update.message.reply_photo(
+                        photo=file_id,
+                        caption=message_text,
+                        parse_mode='Markdown'
+                    )
+                    return
+                except BadRequest as e:
+                    logger.warning(f"Cached QR file_id rejected, re-uploading: {e}")
+                    qr_cache.forget_file_id(referral_link)
+
+            # Генерируем QR-код и отправляем как фото и текст
+            qr_code = await self.generate_qr_code(referral_link)
+            message = await update.message.reply_photo(
                 photo=qr_code,
                 caption=message_text,
                 parse_mode='Markdown'
             )
+            if message and message.photo:
+                qr_cache.set_file_id(referral_link, message.photo[-1].file_id)
         except Exception as e:
             logger.error(f"Error in my_referral_link: {e}")
             await update.message.reply_text("❌ Ошибка при генерации ссылки.")
@@ -429,14 +429,14 @@ class BotHandlers:
     async def balance(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             telegram_id = update.effective_user.id
-            user = db_manager.get_user_by_telegram_id(telegram_id)
+            user = await async_db.get_user_balance_summary(telegram_id)
 
             if user:
-                referrals_count = db_manager.get_user_referrals(user['id'])
-
                 await update.message.reply_text(
                     f"💰 Ваш баланс: {user.get('bonus_balance', 0)} руб.\n\n"
-                    f"👥 Приведено друзей: {len(referrals_count)}\n"
+                    f"👥 Приведено друзей: {user['total_referrals']}\n"
+                    f"✅ Бонусов выплачено: {user['paid_referrals']}\n"
+                    f"⏳ Ожидают выплаты: {user['unpaid_referrals']} ({user['pending_bonus_amount']} руб.)\n"
                     f"💎 Реферальный код: `{user['referral_code']}`"
                 )
             else:
@@ -451,18 +451,14 @@ class BotHandlers:
     async def my_referrals(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             telegram_id = update.effective_user.id
-            user = db_manager.get_user_by_telegram_id(telegram_id)
+            user = await async_db.get_user_by_telegram_id(telegram_id)
 
             if user:
-                referrals = db_manager.get_user_referrals(user['id'])
-
-                if referrals:
-                    referrals_text = "👥 Ваши рефералы:\n\n"
-                    for i, referral in enumerate(referrals, 1):
-                        status = "✅ Бонус выплачен" if referral.get('bonus_paid') else "⏳ Ожидает выплаты"
-                        referrals_text += f"{i}. {referral.get('referred_username')} - {status}\n"
+                page = await self.render_referrals_page(user)
 
-                    await update.message.reply_text(referrals_text)
+                if page:
+                    referrals_text, reply_markup = page
+                    await update.message.reply_text(referrals_text, reply_markup=reply_markup)
                 else:
                     await update.message.reply_text(
                         "😔 У вас пока нет рефералов.\n\n"
@@ -479,36 +475,197 @@ class BotHandlers:
             logger.error(f"Error in my_referrals: {e}")
             await update.message.reply_text("❌ Ошибка при получении списка рефералов.")
 
+    @staticmethod
+    def _slice_page(rows, page_size, after_id=None, before_id=None):
+        """
+        Страница из page_size + 1 строк, прочитанных по ключу (см. get_user_referrals):
+        (строки страницы, has_prev, has_next, id строки перед страницей или None).
+        Лишняя строка показывает, есть ли страница дальше в направлении чтения.
+        """
+        if before_id is not None:
+            has_prev = len(rows) > page_size
+            page_anchor = rows[0]['id'] if has_prev else None
+            return rows[-page_size:], has_prev, True, page_anchor
+        return rows[:page_size], after_id is not None, len(rows) > page_size, after_id
+
+    @staticmethod
+    def _page_navigation(prefix, rows, has_prev, has_next):
+        """Кнопки листания: в callback_data передается id крайней строки страницы"""
+        buttons = []
+        if has_prev:
+            buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{prefix}_prev_{rows[0]['id']}"))
+        if has_next:
+            buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"{prefix}_next_{rows[-1]['id']}"))
+        return buttons
+
+    async def render_referrals_page(self, user, after_id=None, before_id=None):
+        """
+        Страница списка рефералов: (текст, клавиатура) или None, если рефералов нет.
+        Кнопки листания передают в callback_data id крайнего реферала страницы.
+        """
+        referrals = await async_db.get_user_referrals(user['id'], REFERRALS_PAGE_SIZE + 1, after_id, before_id)
+        referrals, has_prev, has_next, _ = self._slice_page(referrals, REFERRALS_PAGE_SIZE, after_id, before_id)
+
+        if not referrals:
+            # Крайний реферал мог исчезнуть — начинаем с первой страницы
+            if after_id is not None or before_id is not None:
+                return await self.render_referrals_page(user)
+            return None
+
+        lines = ["👥 Ваши рефералы:\n"]
+        for referral in referrals:
+            status = "✅ Бонус выплачен" if referral.get('bonus_paid') else "⏳ Ожидает выплаты"
+            referral_date = referral.get('referral_date')
+            date_text = f" ({referral_date.strftime('%d.%m.%Y')})" if referral_date else ""
+            lines.append(f"• {referral.get('referred_username')}{date_text} - {status}")
+
+        buttons = self._page_navigation("refs", referrals, has_prev, has_next)
+        reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+        return "\n".join(lines), reply_markup
+
+    async def referrals_page_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Листание списка рефералов"""
+        query = update.callback_query
+        await query.answer()
+
+        try:
+            _, direction, referral_id = query.data.split('_')
+            referral_id = int(referral_id)
+            user = await async_db.get_user_by_telegram_id(query.from_user.id)
+            if not user:
+                await query.edit_message_text("❌ Вы еще не зарегистрированы.")
+                return
+
+            if direction == 'next':
+                page = await self.render_referrals_page(user, after_id=referral_id)
+            else:
+                page = await self.render_referrals_page(user, before_id=referral_id)
+
+            if page:
+                referrals_text, reply_markup = page
+                await query.edit_message_text(referrals_text, reply_markup=reply_markup)
+            else:
+                await query.edit_message_text("😔 У вас пока нет рефералов.")
+        except Exception as e:
+            logger.error(f"Error in referrals_page_handler: {e}")
+            await query.edit_message_text("❌ Ошибка при получении списка рефералов.")
+
+    async def render_unpaid_page(self, after_id=None, before_id=None, notice=None):
+        """
+        Страница невыплаченных бонусов: (текст, клавиатура) или None, если бонусов нет.
+        На странице до UNPAID_PAGE_SIZE бонусов с кнопками выплаты и кнопки листания.
+        Кнопки выплаты передают id реферала перед страницей, чтобы после выплаты
+        перерисовать ту же страницу.
+        """
+        referrals = await async_db.get_unpaid_referrals(UNPAID_PAGE_SIZE + 1, after_id, before_id)
+        referrals, has_prev, has_next, page_anchor = self._slice_page(
+            referrals, UNPAID_PAGE_SIZE, after_id, before_id
+        )
+
+        if not referrals:
+            # Крайний реферал мог исчезнуть или страница опустела после выплат — начинаем с первой
+            if after_id is not None or before_id is not None:
+                return await self.render_unpaid_page(notice=notice)
+            return None
+
+        lines = [f"{notice}\n" if notice else "", "📋 Невыплаченные бонусы:\n"]
+        keyboard = []
+        for i, referral in enumerate(referrals, 1):
+            referral_date = referral.get('referral_date')
+            if hasattr(referral_date, 'strftime'):
+                date_str = referral_date.strftime('%d.%m.%Y %H:%M')
+            else:
+                date_str = str(referral_date)
+            lines.append(
+                f"{i}. 👤 {referral.get('referrer_name')}\n"
+                f"   👥 Привел: {referral.get('referred_name')}\n"
+                f"   📅 {date_str}  [ID: {referral.get('id')}]"
+            )
+            callback_data = f"pay_{referral['id']}" + (f"_{page_anchor}" if page_anchor is not None else "")
+            keyboard.append([InlineKeyboardButton(
+                f"💸 {i}. Выплатить бонус {referral.get('referrer_name')}",
+                callback_data=callback_data
+            )])
+
+        navigation = self._page_navigation("admin_unpaid", referrals, has_prev, has_next)
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("🔧 Админ-панель", callback_data="admin_refresh")])
+        return "\n".join(line for line in lines if line), InlineKeyboardMarkup(keyboard)
+
+    async def prerender_qr_codes(self, bot, chat_id, message_id):
+        """Фоновая генерация QR-кодов порциями; прогресс показывается редактированием сообщения"""
+        total = rendered = 0
+        after_id = 0
+        try:
+            while True:
+                rows = await async_db.get_referral_codes_batch(after_id, qr_cache.prerender_batch_size)
+                if not rows:
+                    break
+                after_id = rows[-1]['id']
+                links = [self.generate_referral_link(row['referral_code']) for row in rows]
+                rendered += await qr_cache.prerender(links)
+                total += len(rows)
+                await self._edit_progress(bot, chat_id, message_id,
+                                          f"🖼 Генерация QR-кодов: обработано {total}, новых {rendered}...")
+
+            logger.info(f"Pre-rendered {rendered} QR codes for {total} users")
+            await self._edit_progress(bot, chat_id, message_id,
+                                      "🖼 QR-коды подготовлены\n\n"
+                                      f"Всего пользователей: {total}\n"
+                                      f"Сгенерировано новых: {rendered}")
+        except Exception as e:
+            logger.error(f"QR pre-render failed: {e}")
+            await self._edit_progress(bot, chat_id, message_id, f"❌ Ошибка при генерации QR-кодов: {e}")
+
+    @staticmethod
+    async def _edit_progress(bot, chat_id, message_id, text):
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+        except TelegramError as e:
+            logger.debug(f"Could not update progress message: {e}")
+
+    def format_admin_stats(self, title, stats):
+        """Текст админ-панели со статистикой"""
+        return (
+            f"{title}\n\n"
+            f"👥 Всего пользователей: {stats.get('total_users', 0)}\n"
+            f"🆕 Регистраций за 24 ч: {stats.get('registrations_24h', 0)}\n"
+            f"📊 Всего рефералов: {stats.get('total_referrals', 0)}\n"
+            f"💰 Невыплаченные бонусы: {stats.get('unpaid_bonuses', 0)} "
+            f"({stats.get('pending_bonus_amount', 0)} руб.)\n"
+            f"✅ Выплаченные бонусы: {stats.get('total_bonus_paid', 0)}\n"
+            f"💵 Сумма на балансах: {stats.get('total_bonus_balance', 0)} руб.\n\n"
+        )
+
+    def admin_panel_markup(self):
+        """Клавиатура админ-панели"""
+        keyboard = [
+            [InlineKeyboardButton("📊 Обновить статистику", callback_data="admin_refresh")],
+            [InlineKeyboardButton("📋 Список невыплаченных", callback_data="admin_unpaid")],
+            [InlineKeyboardButton("💸 Выплатить все бонусы", callback_data="admin_payall")],
+            [InlineKeyboardButton("📤 Экспорт данных", callback_data="admin_export")],
+            [InlineKeyboardButton("👥 Список пользователей", callback_data="admin_users")],
+            [InlineKeyboardButton("🖼 Подготовить QR-коды", callback_data="admin_qr_prerender")]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+
     async def admin_panel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             telegram_id = update.effective_user.id
 
-            if not db_manager.is_admin(telegram_id):
+            if not await async_db.is_admin(telegram_id):
                 await update.message.reply_text(
                     "❌ У вас нет доступа к админ-панели.\n"
                     "Обратитесь к администратору системы."
                 )
                 return
 
-            stats = db_manager.get_admin_stats()
-
-            admin_text = (
-                "🔧 Админ Панель\n\n"
-                f"👥 Всего пользователей: {stats.get('total_users', 0)}\n"
-                f"📊 Всего рефералов: {stats.get('total_referrals', 0)}\n"
-                f"💰 Невыплаченные бонусы: {stats.get('unpaid_bonuses', 0)}\n"
-                f"✅ Выплаченные бонусы: {stats.get('total_bonus_paid', 0)}\n\n"
-            )
+            stats = await async_db.get_admin_stats()
 
-            keyboard = [
-                [InlineKeyboardButton("📊 Обновить статистику", callback_data="admin_refresh")],
-                [InlineKeyboardButton("📋 Список невыплаченных", callback_data="admin_unpaid")],
-                [InlineKeyboardButton("📤 Экспорт в Excel", callback_data="admin_export")],
-                [InlineKeyboardButton("👥 Список пользователей", callback_data="admin_users")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            admin_text = self.format_admin_stats("🔧 Админ Панель", stats)
 
-            await update.message.reply_text(admin_text, reply_markup=reply_markup)
+            await update.message.reply_text(admin_text, reply_markup=self.admin_panel_markup())
         except Exception as e:
             logger.error(f"Error in admin_panel: {e}")
             await update.message.reply_text("❌ Ошибка при открытии админ-панели.")
@@ -521,7 +678,7 @@ class BotHandlers:
 
             telegram_id = query.from_user.id
 
-            if not db_manager.is_admin(telegram_id):
+            if not await async_db.is_admin(telegram_id):
                 await query.edit_message_text("❌ Нет доступа")
                 return
 
@@ -529,90 +686,132 @@ class BotHandlers:
             logger.info(f"Admin button pressed: {data}")
 
             if data == "admin_refresh":
-                stats = db_manager.get_admin_stats()
-                admin_text = (
-                    "🔧 Админ Панель (обновлено)\n\n"
-                    f"👥 Всего пользователей: {stats.get('total_users', 0)}\n"
-                    f"📊 Всего рефералов: {stats.get('total_referrals', 0)}\n"
-                    f"💰 Невыплаченные бонусы: {stats.get('unpaid_bonuses', 0)}\n"
-                    f"✅ Выплаченные бонусы: {stats.get('total_bonus_paid', 0)}\n\n"
-                )
-
-                keyboard = [
-                    [InlineKeyboardButton("📊 Обновить статистику", callback_data="admin_refresh")],
-                    [InlineKeyboardButton("📋 Список невыплаченных", callback_data="admin_unpaid")],
-                    [InlineKeyboardButton("📤 Экспорт в Excel", callback_data="admin_export")],
-                    [InlineKeyboardButton("👥 Список пользователей", callback_data="admin_users")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-
-                await query.edit_message_text(admin_text, reply_markup=reply_markup)
-
-            elif data == "admin_unpaid":
-                unpaid_referrals = db_manager.get_unpaid_referrals()
+                stats = await async_db.get_admin_stats()
+                admin_text = self.format_admin_stats("🔧 Админ Панель (обновлено)", stats)
+
+                await query.edit_message_text(admin_text, reply_markup=self.admin_panel_markup())
+
+            elif data == "admin_unpaid" or data.startswith("admin_unpaid_"):
+                # Формат callback: admin_unpaid, admin_unpaid_next_<id> или admin_unpaid_prev_<id>
+                direction, _, referral_id = data.replace("admin_unpaid", "").strip("_").partition("_")
+                if direction == "next":
+                    page = await self.render_unpaid_page(after_id=int(referral_id))
+                elif direction == "prev":
+                    page = await self.render_unpaid_page(before_id=int(referral_id))
+                else:
+                    page = await self.render_unpaid_page()
 
-                if not unpaid_referrals:
+                if not page:
                     await query.edit_message_text(
                         "📋 Нет невыплаченных бонусов\n\n"
-                        "Все рефералы уже обработаны! ✅"
+                        "Все рефералы уже обработаны! ✅",
+                        reply_markup=self.admin_panel_markup()
                     )
                     return
 
-                # Отправляем отдельное сообщение со списком
-                unpaid_text = "📋 Невыплаченные бонусы:\n\n"
-                for i, referral in enumerate(unpaid_referrals, 1):
-                    referral_date = referral.get('referral_date')
-                    if hasattr(referral_date, 'strftime'):
-                        date_str = referral_date.strftime('%d.%m.%Y %H:%M')
-                    else:
-                        date_str = str(referral_date)
-                    unpaid_text += (
-                        f"{i}. 👤 {referral.get('referrer_name')}\n"
-                        f"   👥 Привел: {referral.get('referred_name')}\n"
-                        f"   📅 {date_str}\n"
-                        f"   [ID: {referral.get('id')}]\n\n"
-                    )
+                unpaid_text, reply_markup = page
+                await query.edit_message_text(unpaid_text, reply_markup=reply_markup)
 
-                await context.bot.send_message(
-                    chat_id=telegram_id,
-                    text=unpaid_text
-                )
+            elif data == "admin_payall" or data.startswith("admin_payall_confirm_"):
+                if not await async_db.has_admin_permission(telegram_id, 'full'):
+                    await query.edit_message_text("❌ Выплаты доступны только админам с полными правами.")
+                    return
+
+                if data == "admin_payall":
+                    # Сводка без изменений в БД; подтверждение выплатит ровно эти бонусы (по снимку max id)
+                    preview = await async_db.get_payout_preview()
+                    if not preview or not preview['referral_count']:
+                        await query.edit_message_text(
+                            "📋 Нет невыплаченных бонусов\n\n"
+                            "Все рефералы уже обработаны! ✅",
+                            reply_markup=self.admin_panel_markup()
+                        )
+                        return
+
+                    token = secrets.token_hex(8)
+                    keyboard = [
+                        [InlineKeyboardButton(
+                            "✅ Подтвердить выплату",
+                            callback_data=f"admin_payall_confirm_{preview['max_referral_id']}_{token}"
+                        )],
+                        [InlineKeyboardButton("❌ Отмена", callback_data="admin_refresh")]
+                    ]
+                    await query.edit_message_text(
+                        "💸 Пакетная выплата бонусов\n\n"
+                        f"🎁 Бонусов к выплате: {preview['referral_count']}\n"
+                        f"👥 Получателей: {preview['referrer_count']}\n"
+                        f"💰 Общая сумма: {preview['total_amount']} руб.\n\n"
+                        "Подтвердите выплату.",
+                        reply_markup=InlineKeyboardMarkup(keyboard)
+                    )
+                    return
 
-                # Отправляем кнопки для выплат
-                for referral in unpaid_referrals:
-                    keyboard = [[InlineKeyboardButton(
-                        f"💸 Выплатить бонус {referral.get('referrer_name')}",
-                        callback_data=f"pay_{referral.get('id')}"
-                    )]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-
-                    await context.bot.send_message(
-                        chat_id=telegram_id,
-                        text=f"Бонус для {referral.get('referrer_name')} - {referral.get('referred_name')}",
-                        reply_markup=reply_markup
+                # Формат callback: admin_payall_confirm_<max_referral_id>_<token>
+                max_referral_id, token = data.replace("admin_payall_confirm_", "").split("_")
+                result = await async_db.pay_bonuses_batch(telegram_id, token, int(max_referral_id))
+                if result is None:
+                    text = "❌ Ошибка при выплате бонусов. Ничего не выплачено."
+                elif result['already_processed']:
+                    text = "ℹ️ Эта выплата уже была выполнена."
+                elif not result['referral_count']:
+                    text = "📋 Нет невыплаченных бонусов — выплачивать нечего."
+                else:
+                    text = (
+                        "✅ Бонусы выплачены!\n\n"
+                        f"🎁 Бонусов: {result['referral_count']}\n"
+                        f"👥 Получателей: {result['referrer_count']}\n"
+                        f"💰 Сумма: {result['total_amount']} руб."
                     )
+                await query.edit_message_text(text, reply_markup=self.admin_panel_markup())
 
             elif data == "admin_export":
+                # Выбор формата экспорта
+                keyboard = [
+                    [
+                        InlineKeyboardButton(f"📤 {label}", callback_data=f"admin_export_{export_format}"),
+                        InlineKeyboardButton("🔄 Только изменения", callback_data=f"admin_export_{export_format}_delta")
+                    ]
+                    for export_format, (_, label) in EXPORT_FORMATS.items()
+                ]
+                await query.edit_message_text("📤 Выберите формат экспорта:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+            elif data.startswith("admin_export_"):
+                export_format, _, mode = data.replace("admin_export_", "").partition("_")
                 try:
-                    excel_file = db_manager.export_to_excel()
-                    await context.bot.send_document(
-                        chat_id=telegram_id,
-                        document=excel_file,
-                        filename="referral_data.xlsx",
-                        caption="📊 Экспорт данных в Excel"
+                    await export_jobs.submit(
+                        context.bot, telegram_id, export_format,
+                        delta_admin_id=telegram_id if mode == "delta" else None
                     )
                 except Exception as e:
                     await query.edit_message_text(f"❌ Ошибка при экспорте: {e}")
 
+            elif data == "admin_qr_prerender":
+                # Заранее генерируем QR-коды для всех пользователей (например, перед рекламной кампанией)
+                if not qr_cache.cache_dir:
+                    await query.edit_message_text(
+                        "❌ Каталог для QR-кодов (QR_CACHE_DIR) не задан.\n"
+                        "Без него подготовленные QR-коды негде хранить."
+                    )
+                    return
+                if self._qr_prerender_task and not self._qr_prerender_task.done():
+                    await query.edit_message_text("⏳ Генерация QR-кодов уже выполняется.")
+                    return
+
+                await query.edit_message_text("🖼 Генерация QR-кодов запущена...")
+                # Генерация идет в фоне, чтобы следующие обновления админа не ждали ее завершения
+                self._qr_prerender_task = asyncio.create_task(
+                    self.prerender_qr_codes(context.bot, query.message.chat_id, query.message.message_id)
+                )
+
             elif data == "admin_users":
                 # Получаем список пользователей и показываем краткую карточку с кнопками
-                users = db_manager.get_all_users()
+                # Ограничим вывод последних 30 пользователей (не перегружать чат)
+                users = await async_db.get_all_users(limit=30)
                 if not users:
                     await query.edit_message_text("👥 Пользователи не найдены.")
                     return
 
-                # Ограничим вывод первых 30 пользователей (не перегружать чат)
-                for u in users[:30]:
+                for u in users:
                     username = u.get('username') or f"user_{u.get('telegram_id')}"
                     text = (
                         f"👤 @{username}\n"
@@ -625,7 +824,7 @@ class BotHandlers:
                         [InlineKeyboardButton("Ввести номер вручную", callback_data=f"admin_user_enternum_{u.get('telegram_id')}")]
                     ]
                     reply_markup = InlineKeyboardMarkup(kb)
-                    await context.bot.send_message(chat_id=telegram_id, text=text, reply_markup=reply_markup)
+                    outbox.send_message(telegram_id, text, reply_markup=reply_markup)
 
         except Exception as e:
             logger.error(f"Error in admin_button_handler: {e}")
@@ -641,29 +840,41 @@ class BotHandlers:
             await query.answer()
 
             telegram_id = query.from_user.id
+            permissions = await async_db.get_admin_permissions(telegram_id)
 
-            if not db_manager.is_admin(telegram_id):
+            if not permissions:
                 await query.edit_message_text("❌ Нет доступа")
                 return
 
             data = query.data
 
-            # Выплата бонуса
+            # Выплата бонуса (только для админов с полными правами)
             if data.startswith("pay_"):
-                referral_id = int(data.replace("pay_", ""))
+                if permissions != 'full':
+                    await query.edit_message_text("❌ Выплаты доступны только админам с полными правами.")
+                    return
+                # Формат callback: pay_<referral_id> или pay_<referral_id>_<id реферала перед страницей>
+                referral_id, _, page_anchor = data.replace("pay_", "").partition("_")
+                referral_id = int(referral_id)
+                page_anchor = int(page_anchor) if page_anchor else None
                 logger.info(f"Paying bonus for referral: {referral_id}")
 
-                success = db_manager.mark_bonus_paid(referral_id, telegram_id)
+                success = await async_db.mark_bonus_paid(referral_id, telegram_id)
 
                 if success:
-                    await query.edit_message_text(
-                        "✅ Бонус успешно выплачен!\n\n"
-                        "Статус обновлен в системе."
-                    )
+                    notice = "✅ Бонус успешно выплачен!"
+                else:
+                    notice = "❌ Ошибка при выплате бонуса. Возможно, бонус уже был выплачен."
+
+                # Перерисовываем ту же страницу списка: выплаченный бонус исчезает из нее
+                page = await self.render_unpaid_page(after_id=page_anchor, notice=notice)
+                if page:
+                    unpaid_text, reply_markup = page
+                    await query.edit_message_text(unpaid_text, reply_markup=reply_markup)
                 else:
                     await query.edit_message_text(
-                        "❌ Ошибка при выплате бонуса.\n"
-                        "Возможно, бонус уже был выплачен."
+                        f"{notice}\n\n📋 Больше нет невыплаченных бонусов ✅",
+                        reply_markup=self.admin_panel_markup()
                     )
                 return
 
@@ -695,16 +906,24 @@ class BotHandlers:
         try:
             telegram_id = update.effective_user.id
 
-            if not db_manager.is_admin(telegram_id):
+            if not await async_db.is_admin(telegram_id):
                 await update.message.reply_text("❌ У вас нет доступа к этой команде.")
                 return
 
             try:
-                excel_file = db_manager.export_to_excel()
-                await update.message.reply_document(
-                    document=excel_file,
-                    filename="referral_data.xlsx",
-                    caption="📊 Экспорт данных в Excel"
+                # Формат и режим можно указать аргументами: /export csv или /export csv delta
+                args = [arg.lower() for arg in context.args or []]
+                export_format = args[0] if args else 'xlsx'
+                delta = len(args) > 1 and args[1] == 'delta'
+                if export_format not in EXPORT_FORMATS:
+                    await update.message.reply_text(
+                        f"❌ Неизвестный формат. Доступные форматы: {', '.join(EXPORT_FORMATS)}\n"
+                        "Для выгрузки только изменений добавьте delta: /export csv delta"
+                    )
+                    return
+                await export_jobs.submit(
+                    context.bot, update.effective_chat.id, export_format,
+                    delta_admin_id=telegram_id if delta else None
                 )
             except Exception as e:
                 await update.message.reply_text(f"❌ Ошибка при экспорте: {e}")
@@ -750,7 +969,7 @@ class BotHandlers:
         """
         try:
             telegram_id = update.effective_user.id
-            if not db_manager.is_admin(telegram_id):
+            if not await async_db.has_admin_permission(telegram_id, 'full'):
                 await update.message.reply_text("❌ У вас нет прав для этой команды.")
                 return
 
@@ -773,31 +992,13 @@ class BotHandlers:
                 await update.message.reply_text("❌ Неправильный формат номера.")
                 return
 
-            # Попытка обновить номер в БД — предполагаем, что db_manager имеет метод для этого
+            # Обновляем номер в БД (кэш профиля пользователя сбрасывается там же)
             try:
-                updated = False
-                # Пробуем несколько возможных имён функции в db_manager (на случай, если в вашей реализации кот. другое имя)
-                if hasattr(db_manager, 'update_user_phone'):
-                    updated = db_manager.update_user_phone(target_telegram_id, number_digits)
-                elif hasattr(db_manager, 'set_user_phone'):
-                    updated = db_manager.set_user_phone(target_telegram_id, number_digits)
-                elif hasattr(db_manager, 'update_user_by_telegram_id'):
-                    # общий метод, передаём словарь полей
-                    updated = db_manager.update_user_by_telegram_id(target_telegram_id, {'phone': number_digits})
-                else:
-                    # Если нет подходящих методов — пробуем получить user и сохранить через create_user (рискованно)
-                    user = db_manager.get_user_by_telegram_id(target_telegram_id)
-                    if user:
-                        db_manager.update_user_phone_in_record = True  # no-op marker; реальная функция может отсутствовать
-                        # если нет метода, сообщим админу
-                        await update.message.reply_text("❌ На стороне db_manager нет метода для обновления телефона. Пожалуйста, добавьте update_user_phone(telegram_id, phone).")
-                        return
-
+                updated = await async_db.update_user_phone(target_telegram_id, number_digits)
                 if updated:
                     await update.message.reply_text("✅ Номер успешно обновлён.")
                 else:
-                    # Если метод вернул False или None — всё равно сообщим
-                    await update.message.reply_text("✅ Попытка обновления выполнена (проверьте, применился ли номер в БД).")
+                    await update.message.reply_text("❌ Пользователь с таким telegram_id не найден.")
             except Exception as e:
                 logger.error(f"Error updating phone in DB: {e}")
                 await update.message.reply_text("❌ Ошибка при обновлении номера в БД.")
@@ -818,6 +1019,14 @@ class BotHandlers:
         except Exception as e:
             logger.error(f"Error in error_handler: {e}")
 
+    async def sweep_expired_sessions(self, context: ContextTypes.DEFAULT_TYPE):
+        """Периодическое удаление брошенных сессий регистрации"""
+        try:
+            removed = await session_store.purge_expired()
+            logger.info(f"Session sweeper removed {removed} expired sessions")
+        except Exception as e:
+            logger.error(f"Error in sweep_expired_sessions: {e}")
+
     def setup_handlers(self):
         """Настройка всех обработчиков"""
         # Обработчик регистрации
@@ -848,11 +1057,23 @@ class BotHandlers:
         self.application.add_handler(CommandHandler("setphone", self.set_phone_command))
 
         # Обработчики кнопок
-        self.application.add_handler(CallbackQueryHandler(self.admin_button_handler, pattern="^admin_"))
+        self.application.add_handler(CallbackQueryHandler(self.admin_button_handler, pattern="^admin_(?!user_enternum_)"))
         self.application.add_handler(CallbackQueryHandler(self.button_handler, pattern="^(pay_|admin_user_enternum_)"))
+        self.application.add_handler(CallbackQueryHandler(self.referrals_page_handler, pattern=r"^refs_(next|prev)_\d+$"))
 
         # Обработчик любых сообщений (должен быть последним)
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
 
         # Обработчик ошибок
         self.application.add_error_handler(self.error_handler)
+
+        # Фоновые задачи
+        if self.application.job_queue:
+            self.application.job_queue.run_repeating(
+                self.sweep_expired_sessions,
+                interval=SESSION_CONFIG['sweep_interval'],
+                first=60,
+                name="session_sweeper"
+            )
+        else:
+            logger.warning("JobQueue is not available: install python-telegram-bot[job-queue] to sweep expired sessions")
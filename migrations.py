@@ -0,0 +1,103 @@
+import logging
+import os
+import re
+from collections import namedtuple
+
+import psycopg2.errors
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+# Имя файла миграции: <номер версии>_<описание>.sql, например 002_referrals_indexes.sql
+MIGRATION_FILENAME = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+# Ключ advisory-блокировки: одновременно миграции применяет только один экземпляр бота
+MIGRATIONS_LOCK_ID = 727140031
+
+Migration = namedtuple('Migration', ['version', 'name', 'path'])
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Миграции из каталога, упорядоченные по номеру версии"""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILENAME.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+    migrations.sort()
+
+    versions = [migration.version for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Duplicate migration versions in {directory}")
+    return migrations
+
+
+def get_schema_version(cursor):
+    """Текущая версия схемы одним запросом; 0, если миграции еще не применялись"""
+    try:
+        cursor.execute('SELECT COALESCE(MAX(version), 0) as version FROM schema_version')
+        return cursor.fetchone()['version']
+    except psycopg2.errors.UndefinedTable:
+        # В транзакции был только этот запрос — откатываем ее, чтобы продолжить работу
+        cursor.connection.rollback()
+        return 0
+
+
+def migrate(cursor, migrations=None):
+    """
+    Приводит схему к последней версии. Если она уже актуальна, выполняется один SELECT и никакого DDL.
+    Иначе берется advisory-блокировка транзакции: экземпляры, запущенные одновременно,
+    ждут, пока первый применит миграции, и затем видят их в schema_version.
+    Возвращает список примененных миграций.
+    """
+    migrations = load_migrations() if migrations is None else migrations
+    latest_version = migrations[-1].version if migrations else 0
+
+    version = get_schema_version(cursor)
+    if version > latest_version:
+        logger.warning(f"Database schema version {version} is newer than the latest known migration {latest_version}")
+        return []
+    if version == latest_version:
+        logger.info(f"Database schema is up to date (version {version})")
+        return []
+
+    cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATIONS_LOCK_ID,))
+    return apply_migrations(cursor, migrations)
+
+
+def apply_migrations(cursor, migrations=None):
+    """
+    Применяет миграции, которых еще нет в таблице schema_version, в порядке версий.
+    Выполняется в транзакции курсора: при ошибке откатываются все миграции этого запуска.
+    Вызывающий отвечает за блокировку (см. migrate). Возвращает список примененных миграций.
+    """
+    migrations = load_migrations() if migrations is None else migrations
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(200) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('SELECT version FROM schema_version')
+    applied_versions = {row['version'] for row in cursor.fetchall()}
+
+    applied = []
+    for migration in migrations:
+        if migration.version in applied_versions:
+            continue
+        logger.info(f"Applying migration {migration.version}: {migration.name}")
+        with open(migration.path, encoding='utf-8') as sql_file:
+            cursor.execute(sql_file.read())
+        cursor.execute(
+            'INSERT INTO schema_version (version, name) VALUES (%s, %s)',
+            (migration.version, migration.name)
+        )
+        applied.append(migration)
+
+    if applied:
+        logger.info(f"Database schema migrated to version {applied[-1].version}")
+    else:
+        logger.info("Database schema is up to date")
+    return applied
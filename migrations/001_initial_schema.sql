@@ -0,0 +1,60 @@
+-- Исходная схема. Все операторы идемпотентны: миграция применяется и к новой базе,
+-- и к базам, созданным до появления миграций (create_tables + upgrade_schema).
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    telegram_id BIGINT UNIQUE NOT NULL,
+    username VARCHAR(100) NOT NULL,
+    first_name VARCHAR(100),
+    last_name VARCHAR(100),
+    patronymic VARCHAR(100),
+    email VARCHAR(120),
+    phone VARCHAR(20),
+    referral_code VARCHAR(50) UNIQUE NOT NULL,
+    registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    bonus_balance DECIMAL(10,2) DEFAULT 0.00,
+    is_active BOOLEAN DEFAULT TRUE
+);
+
+CREATE TABLE IF NOT EXISTS referrals (
+    id SERIAL PRIMARY KEY,
+    referrer_id INTEGER NOT NULL REFERENCES users(id),
+    referred_user_id INTEGER NOT NULL REFERENCES users(id),
+    referral_code_used VARCHAR(50) NOT NULL,
+    discount_applied BOOLEAN DEFAULT FALSE,
+    bonus_paid BOOLEAN DEFAULT FALSE,
+    referral_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS admins (
+    id SERIAL PRIMARY KEY,
+    telegram_id BIGINT UNIQUE NOT NULL,
+    username VARCHAR(100),
+    full_name VARCHAR(200),
+    permissions VARCHAR(50) DEFAULT 'view',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_active BOOLEAN DEFAULT TRUE
+);
+
+CREATE TABLE IF NOT EXISTS payouts (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    amount DECIMAL(10,2) NOT NULL,
+    status VARCHAR(20) DEFAULT 'pending',
+    payout_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    admin_telegram_id BIGINT
+);
+
+CREATE TABLE IF NOT EXISTS user_sessions (
+    id SERIAL PRIMARY KEY,
+    telegram_id BIGINT NOT NULL,
+    current_step VARCHAR(50) DEFAULT 'start',
+    registration_data JSONB,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Администратор по умолчанию (только в пустой таблице admins)
+INSERT INTO admins (telegram_id, username, full_name, permissions)
+SELECT 5321942267, 'm3irzoev_f1', 'Мирзоев Фирдавс', 'full'
+WHERE NOT EXISTS (SELECT 1 FROM admins);
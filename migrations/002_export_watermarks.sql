@@ -0,0 +1,16 @@
+-- Инкрементальный экспорт: время выплаты бонуса, чтобы экспорт видел изменения bonus_paid,
+-- индексы по датам для отбора изменений за период и отметки последнего экспорта.
+-- IF NOT EXISTS — для баз, созданных до появления миграций
+ALTER TABLE referrals ADD COLUMN IF NOT EXISTS bonus_paid_at TIMESTAMP;
+CREATE INDEX IF NOT EXISTS idx_users_registration_date ON users(registration_date);
+CREATE INDEX IF NOT EXISTS idx_referrals_referral_date ON referrals(referral_date);
+CREATE INDEX IF NOT EXISTS idx_referrals_bonus_paid_at ON referrals(bonus_paid_at);
+
+-- Отметки последнего инкрементального экспорта для каждого админа и формата
+CREATE TABLE IF NOT EXISTS export_watermarks (
+    admin_telegram_id BIGINT NOT NULL,
+    export_format VARCHAR(20) NOT NULL,
+    exported_until TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (admin_telegram_id, export_format)
+);
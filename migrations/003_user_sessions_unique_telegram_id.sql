@@ -0,0 +1,14 @@
+-- Одна сессия на пользователя: нужна для upsert (ON CONFLICT) в upsert_user_session
+DO $$
+BEGIN
+    IF to_regclass('uq_user_sessions_telegram_id') IS NULL THEN
+        -- Оставляем только последнюю сессию каждого пользователя
+        DELETE FROM user_sessions a
+        USING user_sessions b
+        WHERE a.telegram_id = b.telegram_id AND a.id < b.id;
+        CREATE UNIQUE INDEX uq_user_sessions_telegram_id ON user_sessions(telegram_id);
+    END IF;
+END
+$$;
+-- Уникальный индекс заменяет обычный индекс исходной схемы
+DROP INDEX IF EXISTS idx_user_sessions_telegram_id;
@@ -0,0 +1,2 @@
+-- Для удаления брошенных сессий по времени последней активности (delete_expired_sessions)
+CREATE INDEX IF NOT EXISTS idx_user_sessions_updated_at ON user_sessions(updated_at);
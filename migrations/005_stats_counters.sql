@@ -0,0 +1,120 @@
+-- Счетчики для админ-панели, поддерживаемые триггерами.
+-- Триггеры уровня оператора: изменения оператора агрегируются по таблицам переходов и применяются
+-- к счетчикам одним UPDATE, поэтому массовая вставка или пакетная выплата обновляет строку счетчиков
+-- один раз, а не на каждую строку. Таблицы переходов нельзя задать для триггера с несколькими
+-- событиями или списком колонок, поэтому на каждое событие свой триггер, а функция различает их по TG_OP.
+-- Счетчики разнесены по 16 строкам-слотам, а читатели суммируют их: с одной строкой каждая транзакция,
+-- меняющая users или referrals, ждала бы блокировку этой строки до фиксации предыдущей. Слот выбирается
+-- по номеру серверного процесса, поэтому все триггеры одной транзакции обновляют одну и ту же строку
+-- и взаимоблокировок между слотами нет.
+CREATE OR REPLACE FUNCTION stats_counters_slot() RETURNS integer AS $fn$
+    SELECT pg_backend_pid() % 16;
+$fn$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION stats_counters_users() RETURNS trigger AS $fn$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE stats_counters s
+        SET total_users = s.total_users + d.row_count,
+            total_bonus_balance = s.total_bonus_balance + d.bonus_balance
+        FROM (SELECT COUNT(*) as row_count, COALESCE(SUM(bonus_balance), 0) as bonus_balance
+              FROM new_rows) d
+        WHERE s.id = stats_counters_slot() AND d.row_count > 0;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE stats_counters s
+        SET total_users = s.total_users - d.row_count,
+            total_bonus_balance = s.total_bonus_balance - d.bonus_balance
+        FROM (SELECT COUNT(*) as row_count, COALESCE(SUM(bonus_balance), 0) as bonus_balance
+              FROM old_rows) d
+        WHERE s.id = stats_counters_slot() AND d.row_count > 0;
+    ELSE
+        UPDATE stats_counters s
+        SET total_bonus_balance = s.total_bonus_balance + d.bonus_balance
+        FROM (SELECT (SELECT COALESCE(SUM(bonus_balance), 0) FROM new_rows)
+                     - (SELECT COALESCE(SUM(bonus_balance), 0) FROM old_rows) as bonus_balance) d
+        WHERE s.id = stats_counters_slot() AND d.bonus_balance <> 0;
+    END IF;
+    RETURN NULL;
+END;
+$fn$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_counters_referrals() RETURNS trigger AS $fn$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE stats_counters s
+        SET total_referrals = s.total_referrals + d.row_count,
+            unpaid_bonuses = s.unpaid_bonuses + d.unpaid,
+            paid_bonuses = s.paid_bonuses + d.paid
+        FROM (SELECT COUNT(*) as row_count,
+                     COUNT(*) FILTER (WHERE bonus_paid IS NOT TRUE) as unpaid,
+                     COUNT(*) FILTER (WHERE bonus_paid IS TRUE) as paid
+              FROM new_rows) d
+        WHERE s.id = stats_counters_slot() AND d.row_count > 0;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE stats_counters s
+        SET total_referrals = s.total_referrals - d.row_count,
+            unpaid_bonuses = s.unpaid_bonuses - d.unpaid,
+            paid_bonuses = s.paid_bonuses - d.paid
+        FROM (SELECT COUNT(*) as row_count,
+                     COUNT(*) FILTER (WHERE bonus_paid IS NOT TRUE) as unpaid,
+                     COUNT(*) FILTER (WHERE bonus_paid IS TRUE) as paid
+              FROM old_rows) d
+        WHERE s.id = stats_counters_slot() AND d.row_count > 0;
+    ELSE
+        -- При UPDATE число строк не меняется: достаточно разницы выплаченных бонусов
+        UPDATE stats_counters s
+        SET unpaid_bonuses = s.unpaid_bonuses - d.paid,
+            paid_bonuses = s.paid_bonuses + d.paid
+        FROM (SELECT (SELECT COUNT(*) FROM new_rows WHERE bonus_paid IS TRUE)
+                     - (SELECT COUNT(*) FROM old_rows WHERE bonus_paid IS TRUE) as paid) d
+        WHERE s.id = stats_counters_slot() AND d.paid <> 0;
+    END IF;
+    RETURN NULL;
+END;
+$fn$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF to_regclass('stats_counters') IS NULL THEN
+        CREATE TABLE stats_counters (
+            id INTEGER PRIMARY KEY CHECK (id >= 0 AND id < 16),
+            total_users BIGINT NOT NULL DEFAULT 0,
+            total_referrals BIGINT NOT NULL DEFAULT 0,
+            unpaid_bonuses BIGINT NOT NULL DEFAULT 0,
+            paid_bonuses BIGINT NOT NULL DEFAULT 0,
+            total_bonus_balance DECIMAL(14,2) NOT NULL DEFAULT 0
+        );
+
+        -- Триггеры создаются до подсчета начальных значений: CREATE TRIGGER блокирует запись
+        -- в таблицы до конца транзакции, поэтому подсчет и триггеры согласованы
+        CREATE TRIGGER trg_stats_counters_users_insert
+        AFTER INSERT ON users REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_users();
+        CREATE TRIGGER trg_stats_counters_users_update
+        AFTER UPDATE ON users REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_users();
+        CREATE TRIGGER trg_stats_counters_users_delete
+        AFTER DELETE ON users REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_users();
+
+        CREATE TRIGGER trg_stats_counters_referrals_insert
+        AFTER INSERT ON referrals REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_referrals();
+        CREATE TRIGGER trg_stats_counters_referrals_update
+        AFTER UPDATE ON referrals REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_referrals();
+        CREATE TRIGGER trg_stats_counters_referrals_delete
+        AFTER DELETE ON referrals REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_referrals();
+
+        INSERT INTO stats_counters (id, total_users, total_referrals, unpaid_bonuses, paid_bonuses, total_bonus_balance)
+        SELECT 0,
+               (SELECT COUNT(*) FROM users),
+               (SELECT COUNT(*) FROM referrals),
+               (SELECT COUNT(*) FROM referrals WHERE bonus_paid = FALSE),
+               (SELECT COUNT(*) FROM referrals WHERE bonus_paid = TRUE),
+               (SELECT COALESCE(SUM(bonus_balance), 0) FROM users);
+        INSERT INTO stats_counters (id) SELECT generate_series(1, 15);
+    END IF;
+END
+$$;
@@ -0,0 +1,40 @@
+-- Индексы и ограничения таблицы referrals
+
+-- telegram_id и referral_code уже уникальны, поэтому проиндексированы — отдельные индексы лишние
+DROP INDEX IF EXISTS idx_users_telegram_id;
+DROP INDEX IF EXISTS idx_users_referral_code;
+DROP INDEX IF EXISTS idx_admins_telegram_id;
+
+-- Пользователь не может пригласить сам себя
+DELETE FROM referrals WHERE referrer_id = referred_user_id;
+ALTER TABLE referrals ADD CONSTRAINT chk_referrals_not_self CHECK (referrer_id <> referred_user_id);
+
+-- Пользователя приглашают один раз: из повторов оставляем связь с выплаченным бонусом, иначе самую раннюю
+DELETE FROM referrals r
+USING (
+    SELECT id, ROW_NUMBER() OVER (
+        PARTITION BY referred_user_id
+        ORDER BY bonus_paid IS TRUE DESC, referral_date, id
+    ) as position
+    FROM referrals
+) duplicates
+WHERE r.id = duplicates.id AND duplicates.position > 1;
+CREATE UNIQUE INDEX uq_referrals_referred_user_id ON referrals(referred_user_id);
+
+-- Без NULL в bonus_paid частичный индекс ниже покрывает все невыплаченные бонусы
+UPDATE referrals SET bonus_paid = FALSE WHERE bonus_paid IS NULL;
+ALTER TABLE referrals ALTER COLUMN bonus_paid SET NOT NULL;
+
+-- Рефералы пользователя по страницам (get_user_referrals): (referral_date, id) от новых к старым
+CREATE INDEX idx_referrals_referrer_date ON referrals(referrer_id, referral_date DESC, id DESC);
+
+-- Невыплаченные бонусы (get_unpaid_referrals): индекс содержит только строки, ожидающие выплаты
+CREATE INDEX idx_referrals_unpaid ON referrals(referral_date DESC, id DESC) WHERE bonus_paid = FALSE;
+
+-- Пересчитываем счетчики: триггер считает NULL в bonus_paid невыплаченным бонусом,
+-- а замена NULL на FALSE выше выглядит для него как переход из выплаченных в невыплаченные.
+-- Итог записывается в слот 0, остальные слоты обнуляются
+UPDATE stats_counters
+SET total_referrals = CASE WHEN id = 0 THEN (SELECT COUNT(*) FROM referrals) ELSE 0 END,
+    unpaid_bonuses = CASE WHEN id = 0 THEN (SELECT COUNT(*) FROM referrals WHERE bonus_paid = FALSE) ELSE 0 END,
+    paid_bonuses = CASE WHEN id = 0 THEN (SELECT COUNT(*) FROM referrals WHERE bonus_paid = TRUE) ELSE 0 END;
@@ -0,0 +1,5 @@
+-- Заранее зарезервированные реферальные коды (блоки кодов для массовой регистрации)
+CREATE TABLE referral_code_reservations (
+    referral_code VARCHAR(50) PRIMARY KEY,
+    reserved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,10 @@
+-- Пакетные выплаты бонусов: одна строка на пакет, токен защищает от повторной отправки
+CREATE TABLE payout_batches (
+    id SERIAL PRIMARY KEY,
+    token VARCHAR(64) UNIQUE NOT NULL,
+    admin_telegram_id BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE payouts ADD COLUMN batch_id INTEGER REFERENCES payout_batches(id);
+CREATE INDEX idx_payouts_batch_id ON payouts(batch_id) WHERE batch_id IS NOT NULL;
@@ -0,0 +1,50 @@
+-- Версия данных для экспорта: увеличивается триггерами при любом изменении users и referrals.
+-- Счетчик обновляется в той же транзакции, что и данные, поэтому версия и содержимое таблиц согласованы.
+-- Триггеры уровня оператора срабатывают и на операторы без строк (повторная выплата уже выплаченного
+-- бонуса, повторный токен пакетной выплаты), поэтому строки оператора проверяются по таблицам переходов,
+-- чтобы не сбрасывать кэш экспорта зря. Версия — сумма по слотам stats_counters: каждое изменение
+-- увеличивает один слот, поэтому сумма только растет. Для TRUNCATE таблиц переходов нет — версия увеличивается всегда.
+ALTER TABLE stats_counters ADD COLUMN data_version BIGINT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION stats_counters_data_version() RETURNS trigger AS $fn$
+BEGIN
+    -- Таблицы переходов читаются только в ветке своего события: в остальных триггерах их нет
+    IF TG_OP = 'DELETE' THEN
+        IF NOT EXISTS (SELECT 1 FROM old_rows) THEN
+            RETURN NULL;
+        END IF;
+    ELSIF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF NOT EXISTS (SELECT 1 FROM new_rows) THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    UPDATE stats_counters SET data_version = data_version + 1 WHERE id = stats_counters_slot();
+    RETURN NULL;
+END;
+$fn$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_stats_counters_users_version_insert
+AFTER INSERT ON users REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_data_version();
+CREATE TRIGGER trg_stats_counters_users_version_update
+AFTER UPDATE ON users REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_data_version();
+CREATE TRIGGER trg_stats_counters_users_version_delete
+AFTER DELETE ON users REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_data_version();
+CREATE TRIGGER trg_stats_counters_users_version_truncate
+AFTER TRUNCATE ON users
+FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_data_version();
+
+CREATE TRIGGER trg_stats_counters_referrals_version_insert
+AFTER INSERT ON referrals REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_data_version();
+CREATE TRIGGER trg_stats_counters_referrals_version_update
+AFTER UPDATE ON referrals REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_data_version();
+CREATE TRIGGER trg_stats_counters_referrals_version_delete
+AFTER DELETE ON referrals REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_data_version();
+CREATE TRIGGER trg_stats_counters_referrals_version_truncate
+AFTER TRUNCATE ON referrals
+FOR EACH STATEMENT EXECUTE FUNCTION stats_counters_data_version();
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from cache import LRUCache
+from config import OUTBOX_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничение частоты: rate токенов в секунду, не больше capacity накопленных"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений: обработчик ставит сообщения в очередь и сразу завершается,
+    а отправка идет в фоне с ограничением частоты (на бота и на каждый чат).
+    При ответе 429 отправка всех сообщений приостанавливается на retry_after секунд и повторяется.
+    Сообщения одного чата отправляются по порядку.
+    """
+
+    def __init__(self, global_rate=25, global_burst=25, chat_rate=1, chat_burst=3, workers=4, max_retries=5):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.workers = max(1, workers)
+        # chat_id -> TokenBucket; давно не использованные чаты вытесняются
+        self._chat_buckets = LRUCache(10000)
+        self._queues = []
+        self._tasks = []
+        self._paused_until = 0
+        self.bot = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self, bot):
+        """Запускает обработчики очереди (нужен работающий цикл событий)"""
+        if self._tasks:
+            return
+        self.bot = bot
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        logger.info(f"Outbox started with {self.workers} workers")
+
+    async def stop(self, timeout=10.0):
+        """Дожидается отправки поставленных сообщений (не дольше timeout) и останавливает обработчики"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            pending = sum(queue.qsize() for queue in self._queues)
+            logger.warning(f"Outbox stopped with {pending} unsent messages")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(f"Outbox stats: {self.stats()}")
+
+    def enqueue(self, chat_id, method='send_message', **kwargs):
+        """Ставит вызов bot.<method>(chat_id=chat_id, **kwargs) в очередь"""
+        if not self._tasks:
+            raise RuntimeError("Outbox is not started")
+        self._queues[hash(chat_id) % len(self._queues)].put_nowait((chat_id, method, kwargs))
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.enqueue(chat_id, 'send_message', text=text, **kwargs)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _worker(self, queue):
+        while True:
+            chat_id, method, kwargs = await queue.get()
+            try:
+                await self._send(chat_id, method, kwargs)
+            except Exception as e:
+                logger.error(f"Outbox worker error: {e}")
+            finally:
+                queue.task_done()
+
+    async def _send(self, chat_id, method, kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            # Пауза после 429 общая для всех обработчиков: лимит Telegram считается на бота
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                await getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                retry_after = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after
+                logger.warning(f"Outbox: flood limit hit, retrying in {retry_after} s")
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            except BadRequest as e:
+                # BadRequest наследует NetworkError, но повторять его бессмысленно
+                logger.error(f"Outbox: could not send to {chat_id}: {e}")
+                self.failed += 1
+                return
+            except NetworkError as e:
+                # Таймауты и обрывы соединения — повторяем с растущей задержкой
+                logger.warning(f"Outbox: network error sending to {chat_id}: {e}")
+                if attempt < self.max_retries:
+                    await asyncio.sleep(min(2 ** attempt, 30))
+            except TelegramError as e:
+                # Ошибки запроса (чат не найден, бот заблокирован и т.п.) повторять бессмысленно
+                logger.error(f"Outbox: could not send to {chat_id}: {e}")
+                self.failed += 1
+                return
+            if attempt < self.max_retries:
+                self.retried += 1
+
+        logger.error(f"Outbox: giving up on message to {chat_id} after {self.max_retries} retries")
+        self.failed += 1
+
+    def stats(self):
+        return {
+            'queued': sum(queue.qsize() for queue in self._queues),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+        }
+
+
+outbox = Outbox(**OUTBOX_CONFIG)
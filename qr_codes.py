@@ -0,0 +1,284 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import qrcode
+
+from cache import LRUCache
+from config import QR_CACHE_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+ERROR_CORRECTION_LEVELS = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+
+# Параметры render_qr_png по умолчанию; входят в ключ кэша вместе с переданными явно
+DEFAULT_RENDER_OPTIONS = {
+    'box_size': 10,
+    'border': 4,
+    'error_correction': 'L',
+    'image_mode': '1',
+    'optimize': False,
+}
+
+# После очистки на диске остается такая доля max_disk_items, чтобы каталог не сканировался на каждой записи
+DISK_EVICTION_TARGET = 0.9
+
+
+def render_qr_png(data, box_size=10, border=4, error_correction='L', image_mode='1', optimize=False):
+    """
+    Генерация PNG с QR-кодом.
+    image_mode: '1' — однобитное изображение (самый маленький файл), 'P' — палитра, 'RGB' — полноцветное.
+    Функция выполняется в отдельном процессе, поэтому зависит только от своих аргументов.
+    """
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=ERROR_CORRECTION_LEVELS[error_correction],
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white").get_image()
+    if img.mode != image_mode:
+        img = img.convert(image_mode)
+    bio = BytesIO()
+    img.save(bio, 'PNG', optimize=optimize)
+    return bio.getvalue()
+
+
+class QRCodeCache:
+    """
+    Кэш QR-кодов по содержимому: PNG хранится в памяти (LRU) и, при необходимости, на диске.
+    Дополнительно запоминается file_id, который Telegram вернул после первой отправки,
+    чтобы повторно отправлять картинку без генерации и загрузки.
+    """
+
+    def __init__(self, max_items=1024, cache_dir=None, workers=2, prerender_batch_size=500, render_options=None,
+                 max_disk_items=100000):
+        self.render_options = {**DEFAULT_RENDER_OPTIONS, **(render_options or {})}
+        if self.render_options['error_correction'] not in ERROR_CORRECTION_LEVELS:
+            raise ValueError(f"Unknown QR error correction level: {self.render_options['error_correction']}")
+        self.cache_dir = cache_dir or None
+        self.max_disk_items = max_disk_items
+        self.workers = workers
+        self.prerender_batch_size = prerender_batch_size
+        self.images = LRUCache(max_items)
+        self.file_ids = LRUCache(max_items * 4)
+        # Пул процессов создается при первой генерации
+        self._executor = None
+        # Примерное число PNG в каталоге: точное значение пересчитывается при очистке
+        self._disk_items = 0
+        self._evicting = False
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._disk_items = sum(1 for name in os.listdir(self.cache_dir) if name.endswith('.png'))
+
+    def key(self, data):
+        options = ':'.join(f"{name}={value}" for name, value in sorted(self.render_options.items()))
+        signature = f"{options}:{data}"
+        return hashlib.sha256(signature.encode('utf-8')).hexdigest()
+
+    def _get_executor(self):
+        if self._executor is None:
+            # Пул создается лениво, когда уже работают потоки пула БД: fork скопировал бы их
+            # состояние (в том числе захваченные блокировки), поэтому процессы запускаются через forkserver/spawn
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(start_method)
+            )
+        return self._executor
+
+    def _reset_executor(self, executor):
+        """Отбрасывает сломанный пул (рабочий процесс упал); следующая генерация создаст новый"""
+        if self._executor is executor:
+            logger.warning("QR render process pool is broken, starting a new one")
+            self._executor = None
+            executor.shutdown(wait=False)
+
+    async def _render(self, data):
+        """Генерация в пуле процессов; после BrokenProcessPool пул пересоздается и попытка повторяется один раз"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                return await loop.run_in_executor(executor, self._render_job(data))
+            except BrokenProcessPool:
+                self._reset_executor(executor)
+                if attempt:
+                    raise
+
+    def _lookup(self, key):
+        png = self.images.get(key)
+        if png is None:
+            png = self._read_file(key, '.png')
+            if png is not None:
+                self.images.set(key, png)
+        return png
+
+    async def _store(self, key, png):
+        await self._write_png(key, png)
+        self.images.set(key, png)
+
+    async def _write_png(self, key, png):
+        if not self.cache_dir:
+            return
+        if not os.path.exists(self._path(key, '.png')):
+            self._disk_items += 1
+        self._write_file(key, '.png', png)
+        if self.max_disk_items and self._disk_items > self.max_disk_items and not self._evicting:
+            # Сканирование каталога — в потоке, чтобы не останавливать цикл событий
+            self._evicting = True
+            try:
+                await asyncio.to_thread(self.evict_files)
+            finally:
+                self._evicting = False
+
+    def evict_files(self):
+        """
+        Удаляет с диска PNG, которые дольше всего не читались (время изменения файла обновляется
+        при каждом чтении), вместе с их file_id, пока их не останется DISK_EVICTION_TARGET от max_disk_items.
+        Возвращает количество удаленных картинок.
+        """
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.png'):
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.name[:-len('.png')]))
+                    except FileNotFoundError:
+                        pass
+        entries.sort()
+        evict = max(len(entries) - int(self.max_disk_items * DISK_EVICTION_TARGET), 0)
+        for _, key in entries[:evict]:
+            for suffix in ('.png', '.file_id'):
+                try:
+                    os.remove(self._path(key, suffix))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"Error removing QR cache file: {e}")
+        self._disk_items = len(entries) - evict
+        if evict:
+            logger.info(f"QR disk cache: evicted {evict} images, {self._disk_items} left")
+        return evict
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, f"{key}{suffix}")
+
+    def _read_file(self, key, suffix):
+        if not self.cache_dir:
+            return None
+        path = self._path(key, suffix)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            if suffix == '.png':
+                # Время изменения — время последнего чтения: по нему evict_files находит давно не нужные
+                os.utime(path)
+            return content
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Error reading QR cache file: {e}")
+            return None
+
+    def _write_file(self, key, suffix, content):
+        if not self.cache_dir:
+            return
+        path = self._path(key, suffix)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Error writing QR cache file: {e}")
+
+    async def get_png_async(self, data):
+        """PNG для данных: из памяти, с диска или сгенерированный в пуле процессов (не держит GIL цикла событий)"""
+        key = self.key(data)
+        png = self._lookup(key)
+        if png is None:
+            png = await self._render(data)
+            await self._store(key, png)
+        return png
+
+    def _render_job(self, data):
+        # functools.partial от функции модуля сериализуется для передачи в дочерний процесс
+        return functools.partial(render_qr_png, data, **self.render_options)
+
+    async def prerender(self, items, concurrency=None):
+        """
+        Пакетная генерация QR-кодов заранее (например, перед рекламной рассылкой) — одна порция items.
+        Картинки сохраняются только на диск, чтобы не вытеснять из LRU часто запрашиваемые.
+        Возвращает количество сгенерированных картинок; уже сохраненные пропускаются.
+        """
+        if not self.cache_dir:
+            # Без каталога результат некуда сохранить, кроме LRU, где он вытеснил бы нужные картинки
+            raise RuntimeError("QR_CACHE_DIR is not set: pre-rendering QR codes is disabled")
+
+        semaphore = asyncio.Semaphore(concurrency or self.workers * 2)
+        rendered = 0
+
+        async def render_one(data):
+            nonlocal rendered
+            key = self.key(data)
+            if self.images.get(key) is not None or os.path.exists(self._path(key, '.png')):
+                return
+            async with semaphore:
+                png = await self._render(data)
+            await self._write_png(key, png)
+            rendered += 1
+
+        await asyncio.gather(*(render_one(data) for data in items))
+        return rendered
+
+    def get_file_id(self, data):
+        key = self.key(data)
+        file_id = self.file_ids.get(key)
+        if file_id is None:
+            content = self._read_file(key, '.file_id')
+            if content:
+                file_id = content.decode('utf-8')
+                self.file_ids.set(key, file_id)
+        return file_id
+
+    def set_file_id(self, data, file_id):
+        key = self.key(data)
+        self.file_ids.set(key, file_id)
+        self._write_file(key, '.file_id', file_id.encode('utf-8'))
+
+    def forget_file_id(self, data):
+        """Сбрасываем file_id, если Telegram перестал его принимать"""
+        key = self.key(data)
+        self.file_ids.pop(key)
+        if self.cache_dir:
+            try:
+                os.remove(self._path(key, '.file_id'))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'images': self.images.stats(), 'file_ids': self.file_ids.stats()}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+qr_cache = QRCodeCache(**QR_CACHE_CONFIG)
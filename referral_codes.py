@@ -0,0 +1,53 @@
+import secrets
+import threading
+
+from config import REFERRAL_CODE_CONFIG
+
+# Base32 Крокфорда: цифры и заглавные буквы без I, L, O и U, которые легко перепутать
+CROCKFORD_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+# Символы, которые при вводе кода Крокфорда читаются как похожие цифры
+CROCKFORD_ALIASES = str.maketrans('OIL', '011')
+
+
+def generate_referral_code(length=None, alphabet=None):
+    """Случайный код из криптографически стойкого генератора"""
+    length = length or REFERRAL_CODE_CONFIG['length']
+    alphabet = alphabet or REFERRAL_CODE_CONFIG['alphabet']
+    return ''.join(secrets.choice(alphabet) for _ in range(length))
+
+
+def normalize_referral_code(referral_code, alphabet=None):
+    """Приводит введенный пользователем код к виду, в котором он хранится в БД"""
+    alphabet = alphabet or REFERRAL_CODE_CONFIG['alphabet']
+    referral_code = referral_code.strip().upper()
+    if alphabet == CROCKFORD_ALPHABET:
+        referral_code = referral_code.replace('-', '').translate(CROCKFORD_ALIASES)
+    return referral_code
+
+
+class ReferralCodeBlock:
+    """
+    Блок заранее зарезервированных кодов: коды резервируются пачкой одним запросом
+    (reserve — функция, возвращающая список из не более чем n свободных кодов) и выдаются по одному.
+    Выданный код гарантированно не совпадает с существующими, поэтому вставка пользователя
+    не конфликтует по уникальному индексу.
+    """
+
+    def __init__(self, reserve, block_size):
+        self._reserve = reserve
+        self.block_size = block_size
+        self._codes = []
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Следующий зарезервированный код или None, если зарезервировать не удалось"""
+        with self._lock:
+            if not self._codes:
+                self._codes = list(self._reserve(self.block_size))
+            return self._codes.pop() if self._codes else None
+
+    def drain(self):
+        """Забирает невыданные коды (например, чтобы снять с них резерв при остановке)"""
+        with self._lock:
+            codes, self._codes = self._codes, []
+            return codes
@@ -0,0 +1,209 @@
+import json
+import logging
+from abc import ABC, abstractmethod
+
+from cache import LRUCache
+from config import SESSION_CONFIG
+from database import async_db
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore(ABC):
+    """
+    Хранилище состояния регистрации. Сессия — словарь с ключами
+    telegram_id, current_step и registration_data.
+    update() создает сессию, если ее нет, и дописывает registration_data к уже сохраненным данным.
+    delete(persistent=False) удаляет сессию только из быстрого уровня (память или Redis) —
+    когда строку в user_sessions уже удалил register_user.
+    """
+
+    @abstractmethod
+    async def get(self, telegram_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update(self, telegram_id, current_step=None, registration_data=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, telegram_id, persistent=True):
+        raise NotImplementedError
+
+    async def purge_expired(self):
+        """Удаляет просроченные сессии; возвращает их количество (если хранилище его знает)"""
+        return 0
+
+
+class MemorySessionStore(SessionStore):
+    """Сессии в памяти процесса: LRU ограниченного размера с временем жизни каждой записи"""
+
+    def __init__(self, max_size=10000, ttl=86400):
+        self.sessions = LRUCache(max_size, ttl=ttl)
+
+    async def get(self, telegram_id):
+        session = self.sessions.get(telegram_id)
+        return _copy_session(session) if session else None
+
+    async def update(self, telegram_id, current_step=None, registration_data=None):
+        # Нет await между чтением и записью — в пределах цикла событий обновление атомарно
+        session = self.sessions.get(telegram_id) or _new_session(telegram_id)
+        session = _merge_session(session, current_step, registration_data)
+        self.sessions.set(telegram_id, session)
+        return _copy_session(session)
+
+    async def delete(self, telegram_id, persistent=True):
+        self.sessions.pop(telegram_id)
+
+    async def purge_expired(self):
+        return self.sessions.purge_expired()
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Сессии в Redis (или совместимом сервере) — общие для нескольких экземпляров бота.
+    Слияние данных выполняется Lua-скриптом на сервере, поэтому оно атомарно.
+    """
+
+    MERGE_SCRIPT = """
+        local current = redis.call('GET', KEYS[1])
+        local session
+        if current then
+            session = cjson.decode(current)
+        else
+            session = {telegram_id = tonumber(ARGV[1]), current_step = 'start', registration_data = {}}
+        end
+        local patch = cjson.decode(ARGV[2])
+        if patch.current_step ~= nil and patch.current_step ~= cjson.null then
+            session.current_step = patch.current_step
+        end
+        if type(patch.registration_data) == 'table' then
+            if type(session.registration_data) ~= 'table' then
+                session.registration_data = {}
+            end
+            for key, value in pairs(patch.registration_data) do
+                session.registration_data[key] = value
+            end
+        end
+        local encoded = cjson.encode(session)
+        redis.call('SET', KEYS[1], encoded, 'EX', tonumber(ARGV[3]))
+        return encoded
+    """
+
+    def __init__(self, url, ttl=86400, prefix='referral_bot:session:'):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("Для SESSION_BACKEND=redis установите пакет redis")
+        self.client = redis.from_url(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self._merge = self.client.register_script(self.MERGE_SCRIPT)
+
+    def _key(self, telegram_id):
+        return f"{self.prefix}{telegram_id}"
+
+    async def get(self, telegram_id):
+        value = await self.client.get(self._key(telegram_id))
+        return _copy_session(json.loads(value)) if value else None
+
+    async def update(self, telegram_id, current_step=None, registration_data=None):
+        patch = json.dumps({'current_step': current_step, 'registration_data': registration_data or {}})
+        value = await self._merge(keys=[self._key(telegram_id)], args=[telegram_id, patch, self.ttl])
+        # cjson может закодировать пустую таблицу как массив — приводим registration_data к словарю
+        return _copy_session(json.loads(value))
+
+    async def delete(self, telegram_id, persistent=True):
+        await self.client.delete(self._key(telegram_id))
+
+
+class PostgresSessionStore(SessionStore):
+    """Сессии в таблице user_sessions"""
+
+    async def get(self, telegram_id):
+        session = await async_db.get_user_session(telegram_id)
+        return dict(session) if session else None
+
+    async def update(self, telegram_id, current_step=None, registration_data=None):
+        session = await async_db.upsert_user_session(telegram_id, current_step, registration_data)
+        return dict(session) if session else None
+
+    async def delete(self, telegram_id, persistent=True):
+        if persistent:
+            await async_db.delete_user_session(telegram_id)
+
+    async def purge_expired(self):
+        return await async_db.delete_expired_sessions(SESSION_CONFIG['ttl'], SESSION_CONFIG['sweep_batch_size'])
+
+
+class TieredSessionStore(SessionStore):
+    """
+    Быстрое хранилище (память или Redis) с записью в PostgreSQL в качестве постоянного уровня:
+    чтение идет из быстрого уровня, при промахе — из PostgreSQL.
+    """
+
+    def __init__(self, primary, persistent):
+        self.primary = primary
+        self.persistent = persistent
+
+    async def get(self, telegram_id):
+        session = await self.primary.get(telegram_id)
+        if session is None:
+            session = await self.persistent.get(telegram_id)
+            if session:
+                session = await self.primary.update(
+                    telegram_id, session.get('current_step'), session.get('registration_data')
+                )
+        return session
+
+    async def update(self, telegram_id, current_step=None, registration_data=None):
+        session = await self.primary.update(telegram_id, current_step, registration_data)
+        await self.persistent.update(telegram_id, current_step, registration_data)
+        return session
+
+    async def delete(self, telegram_id, persistent=True):
+        await self.primary.delete(telegram_id)
+        if persistent:
+            await self.persistent.delete(telegram_id)
+
+    async def purge_expired(self):
+        return await self.primary.purge_expired() + await self.persistent.purge_expired()
+
+
+def _new_session(telegram_id):
+    return {'telegram_id': telegram_id, 'current_step': 'start', 'registration_data': {}}
+
+
+def _merge_session(session, current_step=None, registration_data=None):
+    merged = _copy_session(session)
+    if current_step is not None:
+        merged['current_step'] = current_step
+    if registration_data:
+        merged['registration_data'].update(registration_data)
+    return merged
+
+
+def _copy_session(session):
+    copied = dict(session)
+    copied['registration_data'] = dict(session.get('registration_data') or {})
+    return copied
+
+
+def create_session_store(config=SESSION_CONFIG):
+    backend = config['backend']
+    if backend == 'memory':
+        store = MemorySessionStore(config['cache_size'], config['ttl'])
+    elif backend == 'redis':
+        store = RedisSessionStore(config['redis_url'], config['ttl'])
+    elif backend == 'postgres':
+        return PostgresSessionStore()
+    else:
+        raise ValueError(f"Unknown session backend: {backend}")
+
+    if config['persist']:
+        store = TieredSessionStore(store, PostgresSessionStore())
+    logger.info(f"Session store: {backend}{' + postgres' if config['persist'] else ''}")
+    return store
+
+
+session_store = create_session_store()
@@ -0,0 +1,78 @@
+"""Кэш таблицы admins в DatabaseManager с поддельным курсором вместо БД"""
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+import database
+from database import DatabaseManager
+
+
+class FakeAdminsCursor:
+    """Отдает строки admins и считает запросы; при fail=True запрос падает, как при недоступной БД"""
+
+    def __init__(self, rows, delay=0):
+        self.rows = rows
+        self.delay = delay
+        self.fail = False
+        self.queries = 0
+
+    def execute(self, query, params=None):
+        self.queries += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise psycopg2.OperationalError("could not connect to server")
+
+    def fetchall(self):
+        return self.rows
+
+
+def make_manager(monkeypatch, cursor):
+    manager = DatabaseManager()
+
+    @contextmanager
+    def get_cursor():
+        yield cursor
+
+    monkeypatch.setattr(manager, 'get_cursor', get_cursor)
+    return manager
+
+
+def test_admins_are_loaded_once_per_ttl(monkeypatch):
+    cursor = FakeAdminsCursor([{'telegram_id': 1, 'permissions': 'full'}, {'telegram_id': 2, 'permissions': None}])
+    manager = make_manager(monkeypatch, cursor)
+
+    assert manager.get_admin_permissions(1) == 'full'
+    assert manager.get_admin_permissions(2) == 'view'
+    assert manager.get_admin_permissions(3) is None
+    assert cursor.queries == 1
+
+
+def test_concurrent_checks_load_admins_once(monkeypatch):
+    cursor = FakeAdminsCursor([{'telegram_id': 1, 'permissions': 'full'}], delay=0.05)
+    manager = make_manager(monkeypatch, cursor)
+    results = []
+
+    threads = [threading.Thread(target=lambda: results.append(manager.is_admin(1))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [True] * 8
+    assert cursor.queries == 1
+
+
+def test_failed_load_keeps_snapshot_and_backs_off(monkeypatch):
+    monkeypatch.setattr(database, 'ADMIN_CACHE_TTL', 0)
+    monkeypatch.setattr(database, 'ADMIN_CACHE_RETRY', 60)
+    cursor = FakeAdminsCursor([{'telegram_id': 1, 'permissions': 'full'}])
+    manager = make_manager(monkeypatch, cursor)
+    assert manager.is_admin(1)
+
+    cursor.fail = True
+    assert manager.is_admin(1)
+    assert manager.is_admin(1)
+    # После ошибки следующая попытка загрузки откладывается на ADMIN_CACHE_RETRY секунд
+    assert cursor.queries == 2
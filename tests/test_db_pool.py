@@ -0,0 +1,245 @@
+"""Пул соединений с поддельными соединениями вместо psycopg2 (без БД)"""
+import threading
+import time
+
+import psycopg2
+import pytest
+from psycopg2 import extensions
+
+from db_pool import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params=None):
+        self.conn.queries.append(query)
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+class FakeConnection:
+    """Поддельное соединение: закрытие, откат и состояние транзакции, как у psycopg2"""
+
+    def __init__(self, number):
+        self.number = number
+        self.closed = 0
+        self.broken = False
+        self.in_transaction = False
+        self.rollbacks = 0
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        if self.in_transaction:
+            return extensions.TRANSACTION_STATUS_INTRANS
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeConnect:
+    """Фабрика соединений для пула: запоминает все созданные соединения"""
+
+    def __init__(self):
+        self.created = []
+
+    def __call__(self):
+        conn = FakeConnection(len(self.created))
+        self.created.append(conn)
+        return conn
+
+
+def make_pool(**options):
+    connect = FakeConnect()
+    options.setdefault('min_size', 0)
+    options.setdefault('health_check_after', 60)
+    return ConnectionPool(connect, **options), connect
+
+
+def test_idle_connection_is_reused():
+    pool, connect = make_pool(max_size=2)
+    conn = pool.getconn()
+    pool.putconn(conn)
+
+    assert pool.getconn() is conn
+    assert len(connect.created) == 1
+    assert pool.stats()['checkouts'] == 2
+
+
+def test_warmup_opens_min_size_connections():
+    pool, connect = make_pool(min_size=3, max_size=5)
+    pool.warmup()
+
+    assert len(connect.created) == 3
+    assert pool.stats()['idle'] == 3
+    assert pool.stats()['in_use'] == 0
+
+
+def test_checkout_times_out_when_pool_is_exhausted():
+    pool, _ = make_pool(max_size=1, checkout_timeout=0.05)
+    pool.getconn()
+
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+    assert time.monotonic() - started >= 0.05
+    stats = pool.stats()
+    assert stats['exhausted'] == 1
+    assert stats['timeouts'] == 1
+    assert stats['in_use'] == 1
+
+
+def test_waiter_gets_connection_returned_by_another_thread():
+    pool, connect = make_pool(max_size=1, checkout_timeout=5)
+    conn = pool.getconn()
+    threading.Timer(0.05, pool.putconn, args=(conn,)).start()
+
+    assert pool.getconn() is conn
+    stats = pool.stats()
+    assert stats['exhausted'] == 1
+    assert stats['timeouts'] == 0
+    assert len(connect.created) == 1
+
+
+def test_connection_is_recycled_after_max_lifetime():
+    pool, connect = make_pool(max_size=1, max_lifetime=0.05)
+    old = pool.getconn()
+    pool.putconn(old)
+    time.sleep(0.1)
+
+    new = pool.getconn()
+    assert new is not old
+    assert old.closed
+    assert pool.stats()['connections_recycled'] == 1
+    assert pool.stats()['size'] == 1
+    assert len(connect.created) == 2
+
+
+def test_connection_is_recycled_after_max_idle():
+    pool, connect = make_pool(max_size=1, max_idle=0.05)
+    old = pool.getconn()
+    pool.putconn(old)
+    time.sleep(0.1)
+
+    assert pool.getconn() is not old
+    assert old.closed
+    assert pool.stats()['connections_recycled'] == 1
+    assert len(connect.created) == 2
+
+
+def test_failed_health_check_replaces_connection():
+    pool, _ = make_pool(max_size=1, health_check_after=0)
+    old = pool.getconn()
+    pool.putconn(old)
+    old.broken = True
+
+    new = pool.getconn()
+    assert new is not old
+    assert old.closed
+    assert old.queries == ['SELECT 1']
+    assert pool.stats()['health_check_failures'] == 1
+
+
+def test_healthy_connection_passes_health_check():
+    pool, _ = make_pool(max_size=1, health_check_after=0)
+    conn = pool.getconn()
+    pool.putconn(conn)
+
+    assert pool.getconn() is conn
+    assert conn.queries == ['SELECT 1']
+    assert pool.stats()['health_check_failures'] == 0
+
+
+def test_putconn_with_discard_closes_connection():
+    pool, _ = make_pool(max_size=1)
+    conn = pool.getconn()
+    pool.putconn(conn, discard=True)
+
+    assert conn.closed
+    assert pool.stats()['size'] == 0
+    assert pool.getconn() is not conn
+
+
+def test_closed_connection_is_not_returned_to_pool():
+    pool, _ = make_pool(max_size=1)
+    conn = pool.getconn()
+    conn.close()
+    pool.putconn(conn)
+
+    stats = pool.stats()
+    assert stats['size'] == 0
+    assert stats['idle'] == 0
+    assert pool.getconn() is not conn
+
+
+def test_open_transaction_is_rolled_back_on_return():
+    pool, _ = make_pool(max_size=1)
+    conn = pool.getconn()
+    conn.in_transaction = True
+    pool.putconn(conn)
+
+    assert conn.rollbacks == 1
+    assert pool.getconn() is conn
+
+
+def test_failed_connect_frees_slot():
+    calls = []
+
+    def connect():
+        calls.append(None)
+        if len(calls) == 1:
+            raise psycopg2.OperationalError("could not connect to server")
+        return FakeConnection(len(calls))
+
+    pool = ConnectionPool(connect, min_size=0, max_size=1)
+    with pytest.raises(psycopg2.OperationalError):
+        pool.getconn()
+
+    assert pool.stats()['size'] == 0
+    assert pool.getconn() is not None
+
+
+def test_closeall_wakes_waiters():
+    pool, _ = make_pool(max_size=1, checkout_timeout=5)
+    conn = pool.getconn()
+    errors = []
+
+    def wait_for_connection():
+        try:
+            pool.getconn()
+        except PoolTimeout as e:
+            errors.append((e, time.monotonic()))
+
+    waiter = threading.Thread(target=wait_for_connection)
+    waiter.start()
+    time.sleep(0.05)
+    closed_at = time.monotonic()
+    pool.closeall()
+    waiter.join(timeout=1)
+
+    assert not waiter.is_alive()
+    assert len(errors) == 1
+    assert errors[0][1] - closed_at < 1
+    assert 'closed' in str(errors[0][0])
+
+    # Соединение, возвращенное после закрытия пула, закрывается
+    pool.putconn(conn)
+    assert conn.closed
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
@@ -0,0 +1,88 @@
+"""Объединение одновременных запросов экспорта в одну фоновую задачу (поддельные Bot и БД)"""
+import asyncio
+from types import SimpleNamespace
+
+import export_jobs
+from export_jobs import ExportJobManager
+
+
+class FakeBot:
+    """Поддельный Bot: каждый вызов API уступает цикл событий, как настоящий сетевой запрос"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0.01)
+        self.messages.append((chat_id, text))
+        return SimpleNamespace(message_id=len(self.messages))
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await asyncio.sleep(0)
+
+
+class FakeAsyncDb:
+    """Вместо async_db: экспорт только записывает формат и длится duration секунд"""
+
+    def __init__(self, duration=0.05):
+        self.duration = duration
+        self.runs = []
+
+    async def get_export_fingerprint(self):
+        return None
+
+    async def run(self, func, export_format, **kwargs):
+        self.runs.append(export_format)
+        await asyncio.sleep(self.duration)
+        return []
+
+
+def run_scenario(monkeypatch, scenario):
+    fake_db = FakeAsyncDb()
+    monkeypatch.setattr(export_jobs, 'async_db', fake_db)
+
+    async def main():
+        manager = ExportJobManager(max_concurrent=2, progress_interval=10)
+        await scenario(manager, FakeBot())
+        for _ in range(100):
+            if not manager._jobs:
+                break
+            await asyncio.sleep(0.01)
+        return manager
+
+    manager = asyncio.run(main())
+    return fake_db.runs, manager
+
+
+def test_concurrent_requests_share_one_export(monkeypatch):
+    async def scenario(manager, bot):
+        await asyncio.gather(manager.submit(bot, 1, 'csv'), manager.submit(bot, 2, 'csv'))
+
+    runs, manager = run_scenario(monkeypatch, scenario)
+    assert runs == ['csv']
+    assert manager._jobs == {}
+
+
+def test_finished_job_does_not_remove_newer_job(monkeypatch):
+    async def scenario(manager, bot):
+        await asyncio.gather(manager.submit(bot, 1, 'csv'), manager.submit(bot, 2, 'csv'))
+        first = manager._jobs['csv']
+        await first.task
+        # Новый запрос после завершения — новая задача; повторный запрос присоединяется к ней
+        await manager.submit(bot, 3, 'csv')
+        await manager.submit(bot, 4, 'csv')
+        assert manager._jobs['csv'] is not first
+        assert [chat_id for chat_id, _ in manager._jobs['csv'].requesters] == [3, 4]
+
+    runs, manager = run_scenario(monkeypatch, scenario)
+    assert runs == ['csv', 'csv']
+
+
+def test_forget_keeps_job_registered_under_same_key():
+    manager = ExportJobManager()
+    old, new = export_jobs.ExportJob('csv', 'csv'), export_jobs.ExportJob('csv', 'csv')
+    manager._jobs['csv'] = new
+    manager._forget(old)
+    assert manager._jobs['csv'] is new
+    manager._forget(new)
+    assert manager._jobs == {}
@@ -0,0 +1,162 @@
+"""Очередь исходящих сообщений с поддельным Bot, который имитирует лимиты Telegram (без сети и БД)"""
+import asyncio
+import time
+from collections import defaultdict
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from outbox import Outbox, TokenBucket
+
+
+class FakeBot:
+    """
+    Поддельный Bot: записывает отправленные сообщения.
+    errors — chat_id -> список исключений, которые выбрасываются по одному на попытки отправки в этот чат.
+    flood_limit — сколько сообщений в секунду принимается, сверх лимита — RetryAfter(retry_after).
+    """
+
+    def __init__(self, errors=None, flood_limit=None, retry_after=1):
+        self.errors = {chat_id: list(chat_errors) for chat_id, chat_errors in (errors or {}).items()}
+        self.flood_limit = flood_limit
+        self.retry_after = retry_after
+        self.sent = []
+        self.calls = defaultdict(int)
+        self.floods = 0
+        self._accepted = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls[chat_id] += 1
+        now = time.monotonic()
+        if self.errors.get(chat_id):
+            raise self.errors[chat_id].pop(0)
+        if self.flood_limit is not None:
+            self._accepted = [moment for moment in self._accepted if moment > now - 1]
+            if len(self._accepted) >= self.flood_limit:
+                self.floods += 1
+                raise RetryAfter(self.retry_after)
+            self._accepted.append(now)
+        self.sent.append((chat_id, text, now))
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def deliver(outbox, bot, messages, timeout=30):
+    outbox.start(bot)
+    for chat_id, text in messages:
+        outbox.send_message(chat_id, text)
+    await outbox.stop(timeout=timeout)
+
+
+def texts_by_chat(bot):
+    result = defaultdict(list)
+    for chat_id, text, _ in bot.sent:
+        result[chat_id].append(text)
+    return result
+
+
+def test_token_bucket_paces_after_burst():
+    async def scenario():
+        bucket = TokenBucket(rate=20, capacity=2)
+        started = time.monotonic()
+        for _ in range(6):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # 2 токена сразу, остальные 4 — по одному каждые 50 мс
+    assert run(scenario()) >= 0.18
+
+
+def test_per_chat_order_is_preserved():
+    bot = FakeBot()
+    outbox = Outbox(global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000, workers=4)
+    messages = [(chat_id, f"{chat_id}:{i}") for i in range(20) for chat_id in (1, 2, 3, 4, 5)]
+    run(deliver(outbox, bot, messages))
+
+    by_chat = texts_by_chat(bot)
+    for chat_id in (1, 2, 3, 4, 5):
+        assert by_chat[chat_id] == [f"{chat_id}:{i}" for i in range(20)]
+    assert outbox.stats()['sent'] == 100
+
+
+def test_global_rate_is_respected():
+    bot = FakeBot()
+    outbox = Outbox(global_rate=20, global_burst=1, chat_rate=1000, chat_burst=1000, workers=4)
+    run(deliver(outbox, bot, [(chat_id, "hi") for chat_id in range(11)]))
+
+    moments = sorted(moment for _, _, moment in bot.sent)
+    # 11 сообщений при 20 в секунду без всплеска — не быстрее 0.5 с
+    assert moments[-1] - moments[0] >= 0.45
+
+
+def test_per_chat_rate_is_respected():
+    bot = FakeBot()
+    outbox = Outbox(global_rate=1000, global_burst=1000, chat_rate=10, chat_burst=1, workers=2)
+    run(deliver(outbox, bot, [(1, str(i)) for i in range(5)] + [(2, "other")]))
+
+    moments = [moment for chat_id, _, moment in bot.sent if chat_id == 1]
+    assert moments[-1] - moments[0] >= 0.35
+    assert texts_by_chat(bot)[1] == ["0", "1", "2", "3", "4"]
+
+
+def test_retry_after_pauses_all_chats_and_retries():
+    bot = FakeBot(errors={1: [RetryAfter(1)]})
+    outbox = Outbox(global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000, workers=1)
+
+    async def scenario():
+        outbox.start(bot)
+        started = time.monotonic()
+        outbox.send_message(1, "first")
+        outbox.send_message(2, "second")
+        await outbox.stop(timeout=10)
+        return started
+
+    started = run(scenario())
+    assert [text for _, text, _ in bot.sent] == ["first", "second"]
+    # Оба сообщения ушли только после паузы retry_after
+    assert all(moment - started >= 0.95 for _, _, moment in bot.sent)
+    assert outbox.stats() == {'queued': 0, 'sent': 2, 'failed': 0, 'retried': 1}
+
+
+def test_network_error_is_retried():
+    bot = FakeBot(errors={1: [NetworkError("connection reset")]})
+    outbox = Outbox(global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000, workers=1)
+    run(deliver(outbox, bot, [(1, "hello")]))
+
+    assert bot.calls[1] == 2
+    assert texts_by_chat(bot)[1] == ["hello"]
+    assert outbox.stats()['retried'] == 1
+
+
+def test_bad_request_is_dropped_without_retry():
+    bot = FakeBot(errors={1: [BadRequest("chat not found")]})
+    outbox = Outbox(global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000, workers=1)
+    run(deliver(outbox, bot, [(1, "lost"), (1, "next")]))
+
+    assert bot.calls[1] == 2
+    assert texts_by_chat(bot)[1] == ["next"]
+    assert outbox.stats()['failed'] == 1
+
+
+def test_message_is_dropped_after_max_retries():
+    bot = FakeBot(errors={1: [RetryAfter(0) for _ in range(10)]})
+    outbox = Outbox(global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000, workers=1, max_retries=3)
+    run(deliver(outbox, bot, [(1, "never"), (2, "delivered")]))
+
+    assert bot.calls[1] == 4
+    assert texts_by_chat(bot) == {2: ["delivered"]}
+    assert outbox.stats() == {'queued': 0, 'sent': 1, 'failed': 1, 'retried': 3}
+
+
+def test_flood_limited_bot_receives_everything_in_order():
+    bot = FakeBot(flood_limit=15, retry_after=1)
+    outbox = Outbox(global_rate=100, global_burst=100, chat_rate=1000, chat_burst=1000, workers=3, max_retries=10)
+    messages = [(chat_id, f"{chat_id}:{i}") for i in range(8) for chat_id in (1, 2, 3, 4)]
+    run(deliver(outbox, bot, messages))
+
+    assert bot.floods > 0
+    by_chat = texts_by_chat(bot)
+    for chat_id in (1, 2, 3, 4):
+        assert by_chat[chat_id] == [f"{chat_id}:{i}" for i in range(8)]
+    assert outbox.stats()['failed'] == 0
@@ -0,0 +1,110 @@
+"""Кэш QR-кодов: ключ с параметрами по умолчанию, ограничение каталога на диске и пересоздание пула процессов"""
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import qr_codes
+from qr_codes import QRCodeCache
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class BrokenExecutor(Executor):
+    """Пул, рабочий процесс которого упал: каждая задача завершается BrokenProcessPool"""
+
+    def __init__(self):
+        self.shut_down = False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+        return future
+
+    def shutdown(self, wait=True, **kwargs):
+        self.shut_down = True
+
+
+@pytest.fixture
+def executors(monkeypatch):
+    """Подменяет ProcessPoolExecutor: пулы выдаются из списка по очереди"""
+    pools = []
+    monkeypatch.setattr(qr_codes, 'ProcessPoolExecutor', lambda **kwargs: pools.pop(0))
+    return pools
+
+
+def test_default_render_options_are_part_of_the_key():
+    explicit = QRCodeCache(render_options={'image_mode': '1'})
+    default = QRCodeCache()
+
+    assert default.render_options['image_mode'] == '1'
+    assert default.key('https://t.me/bot?start=ABC') == explicit.key('https://t.me/bot?start=ABC')
+    assert QRCodeCache(render_options={'image_mode': 'P'}).key('x') != default.key('x')
+
+
+def test_broken_process_pool_is_replaced(executors):
+    broken = BrokenExecutor()
+    executors.extend([broken, ThreadPoolExecutor(max_workers=1)])
+    cache = QRCodeCache()
+
+    png = run(cache.get_png_async('https://t.me/bot?start=ABC'))
+
+    assert png.startswith(b'\x89PNG')
+    assert broken.shut_down
+    assert cache._executor is not broken
+    cache.close()
+
+
+def test_render_fails_when_new_pool_breaks_too(executors):
+    executors.extend([BrokenExecutor(), BrokenExecutor(), ThreadPoolExecutor(max_workers=1)])
+    cache = QRCodeCache()
+
+    with pytest.raises(BrokenProcessPool):
+        run(cache.get_png_async('https://t.me/bot?start=ABC'))
+    # Следующий запрос получает новый пул
+    assert run(cache.get_png_async('https://t.me/bot?start=ABC')).startswith(b'\x89PNG')
+    cache.close()
+
+
+def test_disk_cache_evicts_least_recently_read_images(tmp_path, executors):
+    executors.append(ThreadPoolExecutor(max_workers=1))
+    cache = QRCodeCache(max_items=1, cache_dir=str(tmp_path), max_disk_items=10)
+
+    async def scenario():
+        for i in range(10):
+            await cache.get_png_async(f"code-{i}")
+            cache.set_file_id(f"code-{i}", f"file-{i}")
+        # Время изменения файла — время последнего чтения с диска
+        for i in range(10):
+            path = cache._path(cache.key(f"code-{i}"), '.png')
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+        cache.images.clear()
+        await cache.get_png_async('code-0')
+        await cache.get_png_async('code-10')
+
+    run(scenario())
+    cache.close()
+
+    pngs = {name for name in os.listdir(tmp_path) if name.endswith('.png')}
+    assert len(pngs) == 9
+    # Удалены картинки, которые дольше всего не читались, вместе с их file_id
+    assert f"{cache.key('code-0')}.png" in pngs
+    assert f"{cache.key('code-10')}.png" in pngs
+    assert f"{cache.key('code-1')}.png" not in pngs
+    assert f"{cache.key('code-2')}.png" not in pngs
+    assert not os.path.exists(cache._path(cache.key('code-1'), '.file_id'))
+    assert cache._disk_items == 9
+
+
+def test_existing_disk_files_are_counted(tmp_path, executors):
+    executors.append(ThreadPoolExecutor(max_workers=1))
+    first = QRCodeCache(cache_dir=str(tmp_path))
+    run(first.get_png_async('code-1'))
+    first.close()
+
+    assert QRCodeCache(cache_dir=str(tmp_path))._disk_items == 1
@@ -0,0 +1,184 @@
+"""Хранилища сессий регистрации: память, двухуровневое хранилище и Lua-скрипт Redis на заглушке fakeredis"""
+import asyncio
+import time
+
+import pytest
+
+from session_store import MemorySessionStore, RedisSessionStore, SessionStore, TieredSessionStore
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_store_without_required_methods_cannot_be_created():
+    class IncompleteStore(SessionStore):
+        async def get(self, telegram_id):
+            return None
+
+    with pytest.raises(TypeError):
+        IncompleteStore()
+
+
+def test_memory_store_merges_registration_data():
+    async def scenario():
+        store = MemorySessionStore()
+        created = await store.update(1)
+        await store.update(1, 'NAME', {'first_name': 'Иван'})
+        await store.update(1, None, {'email': 'ivan@example.com'})
+        return created, await store.get(1)
+
+    created, session = run(scenario())
+    assert created == {'telegram_id': 1, 'current_step': 'start', 'registration_data': {}}
+    assert session == {
+        'telegram_id': 1,
+        'current_step': 'NAME',
+        'registration_data': {'first_name': 'Иван', 'email': 'ivan@example.com'},
+    }
+
+
+def test_memory_store_returns_copies():
+    async def scenario():
+        store = MemorySessionStore()
+        session = await store.update(1, 'NAME', {'first_name': 'Иван'})
+        session['registration_data']['first_name'] = 'changed'
+        return await store.get(1)
+
+    assert run(scenario())['registration_data'] == {'first_name': 'Иван'}
+
+
+def test_memory_store_expires_sessions():
+    async def scenario():
+        store = MemorySessionStore(ttl=0.05)
+        await store.update(1, 'NAME')
+        await store.update(2, 'EMAIL')
+        time.sleep(0.1)
+        await store.update(3, 'PHONE')
+        return await store.get(1), await store.purge_expired(), await store.get(3)
+
+    expired, purged, fresh = run(scenario())
+    assert expired is None
+    # Сессия 1 уже удалена при чтении, purge_expired удаляет оставшуюся просроченную сессию 2
+    assert purged == 1
+    assert fresh['current_step'] == 'PHONE'
+
+
+def test_memory_store_delete():
+    async def scenario():
+        store = MemorySessionStore()
+        await store.update(1, 'NAME')
+        await store.delete(1)
+        await store.delete(2)
+        return await store.get(1)
+
+    assert run(scenario()) is None
+
+
+def test_tiered_store_writes_both_tiers():
+    async def scenario():
+        primary, persistent = MemorySessionStore(), MemorySessionStore()
+        store = TieredSessionStore(primary, persistent)
+        await store.update(1, 'NAME', {'first_name': 'Иван'})
+        return await primary.get(1), await persistent.get(1)
+
+    primary_session, persistent_session = run(scenario())
+    assert primary_session == persistent_session
+    assert persistent_session['registration_data'] == {'first_name': 'Иван'}
+
+
+def test_tiered_store_falls_back_to_persistent_tier():
+    async def scenario():
+        primary, persistent = MemorySessionStore(), MemorySessionStore()
+        # Сессия сохранилась только в постоянном уровне (например, после перезапуска бота)
+        await persistent.update(1, 'EMAIL', {'first_name': 'Иван'})
+        store = TieredSessionStore(primary, persistent)
+        return await store.get(1), await primary.get(1), await store.get(2)
+
+    session, restored, missing = run(scenario())
+    assert session['current_step'] == 'EMAIL'
+    assert session['registration_data'] == {'first_name': 'Иван'}
+    assert restored == session
+    assert missing is None
+
+
+def test_tiered_store_delete_keeps_persistent_tier_when_asked():
+    async def scenario():
+        primary, persistent = MemorySessionStore(), MemorySessionStore()
+        store = TieredSessionStore(primary, persistent)
+        await store.update(1, 'NAME')
+        await store.update(2, 'NAME')
+        await store.delete(1, persistent=False)
+        await store.delete(2)
+        return await primary.get(1), await persistent.get(1), await primary.get(2), await persistent.get(2)
+
+    primary_1, persistent_1, primary_2, persistent_2 = run(scenario())
+    assert primary_1 is None
+    assert persistent_1['current_step'] == 'NAME'
+    assert primary_2 is None
+    assert persistent_2 is None
+
+
+@pytest.fixture
+def redis_store(monkeypatch):
+    """RedisSessionStore поверх fakeredis с поддержкой Lua (пакеты fakeredis и lupa)"""
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    import redis.asyncio
+
+    client = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(redis.asyncio, 'from_url', lambda url: client)
+    return RedisSessionStore('redis://localhost:6379/0', ttl=100, prefix='test:session:')
+
+
+def test_redis_merge_script_creates_and_merges_session(redis_store):
+    async def scenario():
+        created = await redis_store.update(1)
+        await redis_store.update(1, 'NAME', {'first_name': 'Иван'})
+        merged = await redis_store.update(1, None, {'email': 'ivan@example.com'})
+        return created, merged, await redis_store.get(1)
+
+    created, merged, stored = run(scenario())
+    assert created == {'telegram_id': 1, 'current_step': 'start', 'registration_data': {}}
+    assert merged == stored == {
+        'telegram_id': 1,
+        'current_step': 'NAME',
+        'registration_data': {'first_name': 'Иван', 'email': 'ivan@example.com'},
+    }
+
+
+def test_redis_merge_script_keeps_null_values(redis_store):
+    async def scenario():
+        await redis_store.update(1, 'PHONE', {'first_name': 'Иван', 'phone': '+79001234567'})
+        return await redis_store.update(1, None, {'phone': None, 'patronymic': None})
+
+    session = run(scenario())
+    assert session['current_step'] == 'PHONE'
+    assert session['registration_data'] == {'first_name': 'Иван', 'phone': None, 'patronymic': None}
+
+
+def test_redis_merge_script_with_empty_registration_data(redis_store):
+    async def scenario():
+        await redis_store.update(1, 'NAME', {'first_name': 'Иван'})
+        unchanged = await redis_store.update(1, None, {})
+        stepped = await redis_store.update(1, 'EMAIL', None)
+        await redis_store.update(2, 'NAME', {})
+        return unchanged, stepped, await redis_store.get(2)
+
+    unchanged, stepped, empty = run(scenario())
+    assert unchanged['current_step'] == 'NAME'
+    assert unchanged['registration_data'] == {'first_name': 'Иван'}
+    assert stepped['current_step'] == 'EMAIL'
+    assert stepped['registration_data'] == {'first_name': 'Иван'}
+    assert empty['registration_data'] == {}
+
+
+def test_redis_session_has_ttl_and_can_be_deleted(redis_store):
+    async def scenario():
+        await redis_store.update(1, 'NAME')
+        ttl = await redis_store.client.ttl('test:session:1')
+        await redis_store.delete(1)
+        return ttl, await redis_store.get(1)
+
+    ttl, session = run(scenario())
+    assert 0 < ttl <= 100
+    assert session is None
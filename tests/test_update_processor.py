@@ -0,0 +1,70 @@
+"""Нагрузочная проверка PerUserUpdateProcessor на синтетических обновлениях (без сети и БД)"""
+import asyncio
+import random
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+from update_processor import PerUserUpdateProcessor
+
+USERS = 300
+UPDATES = 5000
+MAX_CONCURRENT = 32
+
+
+def make_update(update_id, user_id):
+    user = User(id=user_id, first_name=f"user{user_id}", is_bot=False)
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=user_id, type=Chat.PRIVATE),
+        from_user=user,
+        text=f"message {update_id}",
+    )
+    return Update(update_id=update_id, message=message)
+
+
+def test_replay_keeps_per_user_order_and_concurrency_limit():
+    random.seed(42)
+    updates = [make_update(update_id, random.randrange(USERS)) for update_id in range(UPDATES)]
+
+    async def scenario():
+        processor = PerUserUpdateProcessor(MAX_CONCURRENT)
+        processed = defaultdict(list)
+        active_users = set()
+        state = {'running': 0, 'max_running': 0, 'overlaps': 0}
+
+        async def handle(update):
+            user_id = update.effective_user.id
+            if user_id in active_users:
+                state['overlaps'] += 1
+            active_users.add(user_id)
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+            # Имитация ввода-вывода обработчика
+            await asyncio.sleep(random.random() * 0.002)
+            processed[user_id].append(update.update_id)
+            state['running'] -= 1
+            active_users.discard(user_id)
+
+        started = time.perf_counter()
+        async with processor:
+            # Как Application при concurrent_updates: задача на каждое обновление в порядке поступления
+            tasks = [asyncio.create_task(processor.process_update(update, handle(update))) for update in updates]
+            await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        return processed, state, elapsed, processor
+
+    processed, state, elapsed, processor = asyncio.run(scenario())
+
+    expected = defaultdict(list)
+    for update in updates:
+        expected[update.effective_user.id].append(update.update_id)
+    assert processed == expected
+    assert state['overlaps'] == 0
+    assert state['max_running'] <= MAX_CONCURRENT
+    assert not processor._user_locks
+    print(f"\n{UPDATES} updates from {USERS} users: {elapsed:.2f} s, {UPDATES / elapsed:.0f} updates/s, "
+          f"max concurrent handlers {state['max_running']}")
@@ -0,0 +1,139 @@
+"""
+Webhook-режим против локальной заглушки Telegram: заглушка Bot API отвечает на служебные
+вызовы бота, а тест отправляет обновления на webhook с правильным и неправильным секретом.
+"""
+import asyncio
+import json
+import socket
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as TornadoApplication, RequestHandler
+
+from bot import session_backend_warning, webhook_options
+
+TOKEN = '123456:TEST-TOKEN'
+SECRET = 'webhook-secret'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotApi(RequestHandler):
+    """Заглушка Bot API: getMe, setWebhook, deleteWebhook; параметры вызовов записываются"""
+
+    def initialize(self, calls):
+        self.calls = calls
+
+    def post(self, method):
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(self.request.body or b'{}')
+        else:
+            params = {key: values[0].decode() for key, values in self.request.body_arguments.items()}
+        self.calls.append((method, params))
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Test', 'username': 'test_bot'}
+        else:
+            result = True
+        self.write({'ok': True, 'result': result})
+
+
+def make_update(update_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 1700000000,
+            'chat': {'id': 42, 'type': 'private'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'User'},
+            'text': f'/start CODE{update_id}',
+        },
+    }
+
+
+def test_webhook_accepts_only_requests_with_secret_token():
+    async def scenario():
+        api_calls = []
+        api_port = free_port()
+        api_server = HTTPServer(TornadoApplication([(rf'/bot{TOKEN}/(\w+)', FakeBotApi, {'calls': api_calls})]))
+        api_server.listen(api_port, '127.0.0.1')
+
+        webhook_port = free_port()
+        options = webhook_options({
+            'url': 'https://bot.example.test/',
+            'listen': '127.0.0.1',
+            'port': webhook_port,
+            'path': '/telegram/',
+            'secret_token': SECRET,
+        })
+
+        received = []
+        application = Application.builder().token(TOKEN).base_url(f'http://127.0.0.1:{api_port}/bot').build()
+
+        async def record(update, context):
+            received.append(update.update_id)
+
+        application.add_handler(TypeHandler(Update, record))
+
+        client = AsyncHTTPClient()
+        url = f'http://127.0.0.1:{webhook_port}/{options["url_path"]}'
+
+        async def post(update_id, secret):
+            headers = {'Content-Type': 'application/json'}
+            if secret is not None:
+                headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+            response = await client.fetch(url, method='POST', body=json.dumps(make_update(update_id)),
+                                          headers=headers, raise_error=False)
+            return response.code
+
+        await application.initialize()
+        await application.updater.start_webhook(**options)
+        await application.start()
+        try:
+            codes = {
+                'valid': await post(1, SECRET),
+                'wrong': await post(2, 'not-the-secret'),
+                'missing': await post(3, None),
+                'valid_again': await post(4, SECRET),
+            }
+            for _ in range(50):
+                if len(received) >= 2:
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+            api_server.stop()
+        return codes, received, api_calls
+
+    codes, received, api_calls = asyncio.run(scenario())
+
+    assert codes == {'valid': 200, 'wrong': 403, 'missing': 403, 'valid_again': 200}
+    assert sorted(received) == [1, 4]
+
+    set_webhook = [params for method, params in api_calls if method == 'setWebhook']
+    assert len(set_webhook) == 1
+    assert set_webhook[0]['url'] == 'https://bot.example.test/telegram'
+    assert set_webhook[0]['secret_token'] == SECRET
+    assert str(set_webhook[0]['drop_pending_updates']).lower() == 'false'
+
+
+def test_webhook_requires_url_and_secret():
+    config = {'url': 'https://bot.example.test', 'listen': '0.0.0.0', 'port': 8443, 'path': 'telegram',
+              'secret_token': ''}
+    assert webhook_options(config) is None
+    assert webhook_options(dict(config, url='', secret_token=SECRET)) is None
+
+
+def test_in_process_session_backend_is_reported_for_webhook_mode():
+    config = {'backend': 'memory', 'persist': False}
+    assert 'SESSION_BACKEND=memory' in session_backend_warning(config)
+    assert 'stale' in session_backend_warning(dict(config, persist=True))
+    assert session_backend_warning(dict(config, backend='redis')) is None
+    assert session_backend_warning(dict(config, backend='postgres')) is None
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений от разных пользователей.
+    Обновления одного telegram_id обрабатываются строго по очереди, чтобы шаги
+    регистрации (NAME → EMAIL → PHONE → COMPLETE) не выполнялись одновременно.
+
+    Используется только публичное расширение PTB (do_process_update; версия PTB закреплена
+    в requirements.txt). Базовый process_update берет общий семафор до вызова do_process_update,
+    поэтому им ограничивается только число принятых в обработку обновлений (max_pending_updates),
+    а число одновременно выполняемых обработчиков (max_concurrent_updates) ограничивает
+    собственный семафор, который берется уже после очереди пользователя: ожидающие обновления
+    одного пользователя не занимают слоты остальных.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates=None):
+        super().__init__(max_pending_updates or max_concurrent_updates * 32)
+        self.max_running_updates = max_concurrent_updates
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # telegram_id -> [lock, количество ожидающих обновлений]
+        self._user_locks = {}
+
+    @staticmethod
+    def _user_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._user_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._user_locks:
+            logger.info(f"Update processor shut down with {len(self._user_locks)} users still queued")